@@ -1 +1 @@
-python -m treematcher.test.test_treematcher
+python -m unittest discover -s treematcher/test -t .
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''Build time and memory of the caches used by syntax functions.
+
+Compares TreePatternCache, which stores the content of every node, against
+TreeAggregateIndex, which precomputes per node aggregates in a single
+traversal (with species stored either as sets or as integer bitsets), and
+times a search using species related syntax functions.
+
+usage: python -m treematcher.benchmarks.bench_cache [n_leaves]
+'''
+
+import sys
+import time
+import tracemalloc
+
+from ete3 import PhyloTree
+from treematcher.treematcher import (TreePattern, TreePatternCache,
+                                     TreeAggregateIndex)
+
+SPECIES = ["Sp%03d" % i for i in range(200)]
+PATTERN = """ ('n_species(@) > 10', 'contains_species(@, ["Sp001", "Sp002"])')'n_duplications(@) >= 0' ; """
+
+
+def measure(func):
+    '''Returns the value, elapsed time and peak memory (MB) of calling func'''
+    tracemalloc.start()
+    t1 = time.time()
+    value = func()
+    elapsed = time.time() - t1
+    peak = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+    tracemalloc.stop()
+    return value, elapsed, peak
+
+
+def run(n_leaves=100000):
+    tree = PhyloTree()
+    tree.populate(n_leaves, names_library=["%s_%d" % (SPECIES[i % len(SPECIES)], i)
+                                           for i in range(n_leaves)])
+    pattern = TreePattern(PATTERN, quoted_node_names=True)
+
+    caches = [("TreePatternCache", lambda: TreePatternCache(tree)),
+              ("TreeAggregateIndex", lambda: TreeAggregateIndex(tree)),
+              ("species bitsets", lambda: TreeAggregateIndex(tree, species_bitsets=True))]
+    for label, build in caches:
+        cache, elapsed, peak = measure(build)
+        _, search_time, _ = measure(
+            lambda cache=cache: list(pattern.find_match(tree, cache=cache)))
+        print("%-20s build %8.3fs %10.1fMB   search %8.3fs" %(
+            label, elapsed, peak, search_time))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
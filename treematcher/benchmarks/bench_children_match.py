@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''Scaling of children_match() with and without a memo.
+
+Searches nested patterns in balanced, caterpillar and deep trees of
+increasing size. Every pattern node expects a child matching a sub-pattern
+that succeeds and another one that only fails at the leaves.
+
+Children are assigned with a bipartite matching (see assign_children), so a
+single search reaches every (tree node, pattern node) subproblem at most
+once, and searches don't use a memo. The memo only pays off when it is kept
+across searches, as IncrementalMatcher does after tree edits: the search is
+timed without memo, filling a memo, and repeated with the filled memo.
+
+usage: python -m treematcher.benchmarks.bench_children_match [pattern_depth]
+'''
+
+import sys
+import time
+
+from ete3 import Tree
+from treematcher.treematcher import (TreePattern, compute_match_matrix,
+                                     children_match)
+
+
+def balanced_tree(depth, arity=3):
+    tree = Tree()
+    nodes = [tree]
+    for _ in range(depth):
+        nodes = [n.add_child(name="a") for n in nodes for _ in range(arity)]
+    return tree
+
+
+def caterpillar_tree(n_leaves):
+    tree = Tree()
+    node = tree
+    for _ in range(n_leaves - 1):
+        node.add_child(name="a")
+        node = node.add_child(name="a")
+    return tree
+
+
+def deep_tree(depth):
+    '''A long spine where each node also has two cherries as children'''
+    tree = Tree()
+    node = tree
+    for _ in range(depth):
+        for _ in range(2):
+            cherry = node.add_child()
+            cherry.add_child(name="a")
+            cherry.add_child(name="a")
+        node = node.add_child()
+    return tree
+
+
+def success_pattern(k, suffix=""):
+    if k == 0:
+        return "'@%s'" % suffix
+    return "(%s, '@*')'@%s'" % (success_pattern(k - 1, "+"), suffix)
+
+
+def failure_pattern(k, suffix=""):
+    if k == 0:
+        return "'@.name == \"x\"%s'" % suffix
+    return "(%s, %s, '@*')'@%s'" % (success_pattern(k - 1, "+"),
+                                    failure_pattern(k - 1), suffix)
+
+
+def search(c2nodes, pattern, memo=None):
+    '''Runs children_match for all root candidates and returns elapsed time
+    and number of matches'''
+    t1 = time.time()
+    found = 0
+    for n in c2nodes[pattern.constraint]:
+        found += children_match(n, pattern, c2nodes, memo=memo)
+    return time.time() - t1, found
+
+
+def run(pattern_depth=4):
+    pattern = TreePattern(failure_pattern(pattern_depth) + ";",
+                          quoted_node_names=True)
+    for n in pattern.traverse("postorder"):
+        n.init_controller()
+
+    shapes = [("balanced", balanced_tree, (4, 5, 6, 7)),
+              ("caterpillar", caterpillar_tree, (250, 500, 1000, 2000)),
+              ("deep", deep_tree, (100, 200, 400, 800))]
+    print("%-12s %8s %12s %12s %12s %12s" %("shape", "nodes", "no memo (s)",
+                                            "memo (s)", "repeated (s)",
+                                            "subproblems"))
+    for label, generator, sizes in shapes:
+        for size in sizes:
+            tree = generator(size)
+            n_nodes = len(list(tree.traverse()))
+            c2nodes = compute_match_matrix(pattern, tree)
+            memo = {}
+            elapsed_nomemo, _ = search(c2nodes, pattern)
+            elapsed, _ = search(c2nodes, pattern, memo)
+            elapsed_repeated, _ = search(c2nodes, pattern, memo)
+            print("%-12s %8d %12.4f %12.4f %12.4f %12d" %(label, n_nodes,
+                                                          elapsed_nomemo, elapsed,
+                                                          elapsed_repeated, len(memo)))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
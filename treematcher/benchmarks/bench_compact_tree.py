@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''Memory and search time of ETE trees and CompactTrees.
+
+Memory is measured with tracemalloc in the same way for both
+representations: each one is built from the same newick, so node names are
+included in both figures (the ETE tree parsed to build a CompactTree is
+freed). The memory of a CompactTree is given before and after a full
+traversal, which creates the view of every node. For a tree of 20000 leaves,
+an ETE tree takes about 510 bytes per node, and a CompactTree about 100
+bytes per node (5x less) without views, and 220 bytes per node (2.3x less)
+once the views of all nodes are created.
+
+usage: python -m treematcher.benchmarks.bench_compact_tree [n_leaves]
+'''
+
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+from ete3 import PhyloTree
+from treematcher.treematcher import PatternSet
+from treematcher.compact_tree import CompactTree
+from treematcher.benchmarks.bench_ete_search import SPECIES, random_patterns
+
+
+def traced_size(func):
+    '''Returns the result of func() and the memory it keeps allocated'''
+    # Temporary trees are freed by the garbage collector, as nodes and their
+    # parents refer to each other
+    gc.collect()
+    start = tracemalloc.get_traced_memory()[0]
+    result = func()
+    gc.collect()
+    return result, tracemalloc.get_traced_memory()[0] - start
+
+
+def search(pattern_set, tree, repeat=3):
+    t1 = time.time()
+    for _ in range(repeat):
+        n_matches = sum(len(m) for m in pattern_set.find_matches(tree))
+    return n_matches, (time.time() - t1) / repeat
+
+
+def run(n_leaves=20000):
+    random.seed(0)
+    names = ["%s_%d" %(random.choice(SPECIES), i) for i in range(n_leaves)]
+    t = PhyloTree()
+    t.populate(n_leaves, names_library=names)
+    nw = t.write()
+    n_nodes = len(list(t.traverse()))
+
+    tracemalloc.start()
+    t, ete_size = traced_size(lambda: PhyloTree(nw))
+    compact, compact_size = traced_size(lambda: CompactTree(PhyloTree(nw)))
+    _, views_size = traced_size(lambda: [n.children for n in compact.traverse()])
+    tracemalloc.stop()
+
+    print("%d nodes, bytes per node:" %n_nodes)
+    print("%20s %10.1f" %("ete", ete_size / float(n_nodes)))
+    print("%20s %10.1f" %("compact", compact_size / float(n_nodes)))
+    print("%20s %10.1f" %("compact + views", (compact_size + views_size) / float(n_nodes)))
+
+    print("%10s %12s %12s" %("patterns", "ete (s)", "compact (s)"))
+    for n_patterns in (1, 5, 20):
+        pattern_set = PatternSet(random_patterns(n_patterns))
+        expected, elapsed_ete = search(pattern_set, t)
+        found, elapsed_compact = search(pattern_set, compact)
+        assert found == expected
+        print("%10d %12.4f %12.4f" %(n_patterns, elapsed_ete, elapsed_compact))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
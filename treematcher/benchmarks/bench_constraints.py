@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''Per-node cost of evaluating pattern constraints.
+
+Compares three ways of evaluating the constraint of a pattern node:
+
+ - string eval: the raw constraint string is evaluated within a scope built
+   from the syntax controller for every evaluation (original approach).
+ - code object: a compiled expression is evaluated within a prebuilt scope.
+ - bound function: the function cached in every pattern node by
+   TreePattern.init_controller() is called with the target node.
+
+usage: python -m treematcher.benchmarks.bench_constraints [n_leaves]
+'''
+
+import sys
+import time
+
+from ete3 import Tree
+from treematcher.treematcher import TreePattern
+
+PATTERN = """ ('@.dist > 0.5 and @.support > 0.2', '@.name.startswith("a")+')'^' ; """
+
+
+def evaluate(pattern, tree, mode):
+    '''Evaluates every pattern node against every tree node and returns the
+    number of evaluations performed.'''
+    syntax = pattern.syntax
+    pnodes = list(pattern.traverse())
+    codes = [compile(cn.constraint, '<bench>', 'eval') for cn in pnodes]
+    prebuilt_scope = {attr_name: getattr(syntax, attr_name)
+                      for attr_name in dir(syntax)}
+    evaluations = 0
+    for n in tree.traverse():
+        for cn, code in zip(pnodes, codes):
+            if mode == "string eval":
+                constraint_scope = {attr_name: getattr(syntax, attr_name)
+                                    for attr_name in dir(syntax)}
+                constraint_scope["__target_node"] = n
+                eval(cn.constraint, constraint_scope)
+            elif mode == "code object":
+                prebuilt_scope["__target_node"] = n
+                eval(code, prebuilt_scope)
+            else:
+                cn.constraint_func(n)
+            evaluations += 1
+    return evaluations
+
+
+def run(n_leaves=5000):
+    tree = Tree()
+    tree.populate(n_leaves, random_branches=True)
+    pattern = TreePattern(PATTERN, quoted_node_names=True)
+    for n in pattern.traverse():
+        n.init_controller()
+
+    for mode in ("string eval", "code object", "bound function"):
+        t1 = time.time()
+        evaluations = evaluate(pattern, tree, mode)
+        elapsed = time.time() - t1
+        print("%-15s %8d evaluations %8.3fs %8.2f us/evaluation" %(
+            mode, evaluations, elapsed, (elapsed / evaluations) * 1e6))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
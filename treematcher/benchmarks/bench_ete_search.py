@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''Pattern-major vs tree-major search of N patterns in M trees.
+
+The pattern-major loop is the one ete_search used to run: every target
+newick is parsed again for every pattern. The tree-major loop parses each
+tree once and searches all patterns in it with a PatternSet, sharing the
+evaluation of identical constraints.
+
+usage: python -m treematcher.benchmarks.bench_ete_search [n_trees]
+'''
+
+import random
+import sys
+import time
+
+from ete3 import PhyloTree
+from treematcher.treematcher import TreePattern, PatternSet
+
+SPECIES = ["Hsa", "Ptr", "Mmu", "Rno", "Dme", "Cel"]
+
+
+def random_newicks(n_trees, n_leaves=100):
+    newicks = []
+    for _ in range(n_trees):
+        t = PhyloTree()
+        t.populate(n_leaves, names_library=["%s_%d" %(random.choice(SPECIES), i)
+                                            for i in range(n_leaves)])
+        newicks.append(t.write())
+    return newicks
+
+
+def random_patterns(n_patterns):
+    templates = [""" ('@.species == "%s"', '@.species == "%s"') ;""",
+                 """ ('@.species == "%s"', ('@.species == "%s"', '@')'@') ;""",
+                 """ ('@.species == "%s"', '@.species == "%s"')'^' ;""",
+                 """ '@.species == "%s" or @.species == "%s"' ;"""]
+    return [random.choice(templates) %(random.choice(SPECIES), random.choice(SPECIES))
+            for _ in range(n_patterns)]
+
+
+def pattern_major(patterns, newicks):
+    n_matches = 0
+    for p in patterns:
+        pattern = TreePattern(p)
+        for nw in newicks:
+            t = PhyloTree(nw)
+            n_matches += len(list(pattern.find_match(t)))
+    return n_matches
+
+
+def tree_major(patterns, newicks):
+    pattern_set = PatternSet(patterns)
+    n_matches = 0
+    for nw in newicks:
+        t = PhyloTree(nw)
+        n_matches += sum(len(m) for m in pattern_set.find_matches(t))
+    return n_matches
+
+
+def run(n_trees=50):
+    random.seed(0)
+    newicks = random_newicks(n_trees)
+    print("%10s %8s %16s %16s" %("patterns", "trees", "pattern-major (s)",
+                                 "tree-major (s)"))
+    for n_patterns in (1, 5, 20, 50):
+        patterns = random_patterns(n_patterns)
+        t1 = time.time()
+        expected = pattern_major(patterns, newicks)
+        elapsed_pattern = time.time() - t1
+
+        t1 = time.time()
+        found = tree_major(patterns, newicks)
+        elapsed_tree = time.time() - t1
+        assert found == expected
+
+        print("%10d %8d %16.4f %16.4f" %(n_patterns, n_trees, elapsed_pattern,
+                                         elapsed_tree))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''Combination of loose sub-pattern matches with and without Cartesian
+product.
+
+Searches a pattern made of two sub-patterns connected through a loose
+connection, (a, b)^ and (c, d)^, in random trees where the number of cherries
+matching each sub-pattern grows. The product baseline tests every pair of
+matches calling get_common_ancestor(), as find_matches() used to do.
+
+usage: python -m treematcher.benchmarks.bench_loose [max_hits]
+'''
+
+import itertools
+import random
+import sys
+import time
+
+from ete3 import Tree
+from treematcher.treematcher import (TreeAncestorIndex, combine_loose_matches,
+                                     compute_match_matrix, children_match)
+from treematcher.treematcher import TreePattern
+
+
+def random_tree(n_hits):
+    '''Random tree with n_hits (a, b) and (c, d) cherries'''
+    tree = Tree()
+    tree.populate(n_hits * 2)
+    for i, leaf in enumerate(tree.get_leaves()):
+        names = ("a", "b") if i % 2 else ("c", "d")
+        leaf.name = ""
+        leaf.add_child(name=names[0])
+        leaf.add_child(name=names[1])
+    return tree
+
+
+def product_combinations(tree, root2matches, expected_groups):
+    roots = list(root2matches)
+    ancestors = []
+    for nodes in itertools.product(*root2matches.values()):
+        if len(nodes) != len(set(nodes)):
+            continue
+        lcas = [tree.get_common_ancestor([nodes[roots.index(r)] for r in g])
+                for g in expected_groups]
+        if len(lcas) == len(set(lcas)):
+            ancestors.append(lcas[-1])
+    return ancestors
+
+
+def run(max_hits=400):
+    pattern = TreePattern("((a, b), (c, d))^;")
+    plan = pattern.get_plan()
+    print("%8s %8s %12s %12s %10s" %("hits", "nodes", "combiner (s)",
+                                     "product (s)", "ancestors"))
+    hits = 25
+    while hits <= max_hits:
+        random.seed(hits)
+        tree = random_tree(hits)
+        c2nodes = compute_match_matrix(pattern, tree)
+        root2matches = {r: [n for n in c2nodes[r.constraint]
+                            if children_match(n, r, c2nodes)]
+                        for r in plan.roots}
+
+        t1 = time.time()
+        found = list(combine_loose_matches(root2matches, plan.expected_groups,
+                                           TreeAncestorIndex(tree)))
+        elapsed = time.time() - t1
+
+        t1 = time.time()
+        product_combinations(tree, root2matches, plan.expected_groups)
+        elapsed_product = time.time() - t1
+
+        print("%8d %8d %12.4f %12.4f %10d" %(hits, len(list(tree.traverse())),
+                                             elapsed, elapsed_product, len(found)))
+        hits *= 2
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
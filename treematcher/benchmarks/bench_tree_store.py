@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''Searching a corpus of trees from newick and from a tree store.
+
+The newick loop parses every tree with PhyloTree before searching it, as
+ete_search does with tree files. The store loop reads the same trees from a
+memory-mapped tree store, converted once in advance.
+
+usage: python -m treematcher.benchmarks.bench_tree_store [n_trees]
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from ete3 import PhyloTree
+from treematcher.treematcher import PatternSet
+from treematcher.tools.tree_store import TreeStore, TreeStoreWriter
+from treematcher.benchmarks.bench_ete_search import random_newicks, random_patterns
+
+
+def search_newicks(pattern_set, newicks):
+    n_matches = 0
+    for nw in newicks:
+        t = PhyloTree(nw)
+        n_matches += sum(len(m) for m in pattern_set.find_matches(t))
+    return n_matches
+
+
+def search_store(pattern_set, store):
+    n_matches = 0
+    for _, t in store:
+        n_matches += sum(len(m) for m in pattern_set.find_matches(t))
+    return n_matches
+
+
+def run(n_trees=200):
+    random.seed(0)
+    newicks = random_newicks(n_trees)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "trees.tms")
+        t1 = time.time()
+        with TreeStoreWriter(path) as writer:
+            for nw in newicks:
+                writer.add(PhyloTree(nw))
+        print("conversion of %d trees: %.4fs" %(n_trees, time.time() - t1))
+
+        print("%10s %8s %12s %12s" %("patterns", "trees", "newick (s)", "store (s)"))
+        with TreeStore(path) as store:
+            for n_patterns in (1, 5, 20):
+                pattern_set = PatternSet(random_patterns(n_patterns))
+                t1 = time.time()
+                expected = search_newicks(pattern_set, newicks)
+                elapsed_newick = time.time() - t1
+
+                t1 = time.time()
+                found = search_store(pattern_set, store)
+                elapsed_store = time.time() - t1
+                assert found == expected
+
+                print("%10d %8d %12.4f %12.4f" %(n_patterns, n_trees, elapsed_newick,
+                                                 elapsed_store))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+'''Node by node vs vectorized evaluation of simple attribute constraints.
+
+Fills the match matrix of a pattern whose constraints only compare node
+attributes, evaluating them node by node and as numpy masks over all the
+nodes of the tree (see get_vector_constraint). Columns are built from the
+nodes of ETE trees, and read from the arrays of CompactTrees.
+
+usage: python -m treematcher.benchmarks.bench_vector [n_leaves]
+'''
+
+import random
+import sys
+import time
+
+from ete3 import Tree
+from treematcher import treematcher
+from treematcher.treematcher import TreePattern, TreeAttributeIndex, compute_match_matrix
+from treematcher.compact_tree import CompactTree
+
+PATTERNS = [""" ('@.support > 0.9 and @.dist < 0.5', '@.dist >= 0.5')'@' ; """,
+            """ ('len(@.children) == 2 and 0.2 < @.dist < 0.8', '@.is_leaf()')'@.support > 0.5' ; """]
+
+
+def fill_matrix(pattern, tree, vectorized):
+    min_nodes = treematcher.VECTOR_MIN_NODES
+    if not vectorized:
+        treematcher.VECTOR_MIN_NODES = float('inf')
+    try:
+        index = TreeAttributeIndex(tree)
+        t1 = time.time()
+        c2nodes = compute_match_matrix(pattern, tree, index=index)
+        return c2nodes, time.time() - t1
+    finally:
+        treematcher.VECTOR_MIN_NODES = min_nodes
+
+
+def run(n_leaves=50000):
+    random.seed(0)
+    tree = Tree()
+    tree.populate(n_leaves, random_branches=True)
+    for n in tree.traverse():
+        n.support = random.random()
+
+    compact = CompactTree(tree)
+    print("%10s %10s %14s %14s" %("tree", "nodes", "node by node", "vectorized"))
+    for p in PATTERNS:
+        pattern = TreePattern(p)
+        for name, target in (("ete", tree), ("compact", compact)):
+            expected, elapsed = fill_matrix(pattern, target, False)
+            found, elapsed_vector = fill_matrix(pattern, target, True)
+            assert found == expected
+            print("%10s %10d %14.4f %14.4f" %(name, len(list(target.traverse())),
+                                             elapsed, elapsed_vector))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
@@ -0,0 +1,107 @@
+'''Synthetic target trees for benchmarks.
+
+Trees are PhyloTrees of a given number of leaves, with different shapes:
+
+ - balanced: binary tree where all leaves are at (nearly) the same depth.
+ - caterpillar: every internal node has a leaf and another internal node as
+   children, so the depth of the tree grows with its size.
+ - polytomy: wide multifurcations of up to max_width children per node.
+
+Leaf names start with a species code (e.g. Hsa_12), so species are parsed
+by ETE, and internal nodes are annotated with an evoltype (D or S).
+Branch lengths and supports are random. Trees are built without recursion,
+so deep trees of any size can be generated.
+'''
+
+import random
+
+from ete3 import PhyloTree
+
+SPECIES = ["Hsa", "Ptr", "Mmu", "Rno", "Dme", "Cel"]
+
+# Fraction of internal nodes annotated as duplications
+DUPLICATION_RATE = 0.2
+
+
+def _new_node(rng):
+    node = PhyloTree()
+    node.dist = rng.random()
+    node.support = rng.random()
+    return node
+
+
+def _leaves(n_leaves, rng):
+    leaves = []
+    for i in range(n_leaves):
+        leaf = _new_node(rng)
+        leaf.name = "%s_%d" %(rng.choice(SPECIES), i)
+        leaves.append(leaf)
+    return leaves
+
+
+def _join(children, rng):
+    parent = _new_node(rng)
+    parent.add_feature("evoltype", "D" if rng.random() < DUPLICATION_RATE else "S")
+    for child in children:
+        parent.add_child(child)
+    return parent
+
+
+def _group(nodes, widths, rng):
+    # Joins nodes bottom up in groups of the widths given by widths() until
+    # a single root is left
+    while len(nodes) > 1:
+        parents = []
+        i = 0
+        while i < len(nodes):
+            width = widths()
+            group = nodes[i:i + width]
+            parents.append(_join(group, rng) if len(group) > 1 else group[0])
+            i += width
+        nodes = parents
+    return nodes[0]
+
+
+def _species(name):
+    return name.split("_")[0]
+
+
+def _finish(tree):
+    # Species are parsed from leaf names once all nodes are in the tree
+    tree.set_species_naming_function(_species)
+    return tree
+
+
+def balanced_tree(n_leaves, seed=0):
+    rng = random.Random(seed)
+    return _finish(_group(_leaves(n_leaves, rng), lambda: 2, rng))
+
+
+def caterpillar_tree(n_leaves, seed=0):
+    rng = random.Random(seed)
+    leaves = _leaves(n_leaves, rng)
+    node = leaves.pop()
+    while leaves:
+        node = _join([leaves.pop(), node], rng)
+    return _finish(node)
+
+
+def polytomy_tree(n_leaves, seed=0, max_width=50):
+    rng = random.Random(seed)
+    return _finish(_group(_leaves(n_leaves, rng), lambda: rng.randint(3, max_width), rng))
+
+
+SHAPES = {
+    "balanced": balanced_tree,
+    "caterpillar": caterpillar_tree,
+    "polytomy": polytomy_tree,
+}
+
+
+def generate_tree(shape, n_leaves, seed=0):
+    ''' Returns a tree of the given shape (see SHAPES) and number of leaves. '''
+    try:
+        generator = SHAPES[shape]
+    except KeyError:
+        raise ValueError("Unknown tree shape: %s" % shape)
+    return generator(n_leaves, seed=seed)
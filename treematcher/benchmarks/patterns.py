@@ -0,0 +1,48 @@
+'''Corpus of patterns used by the benchmark suite.
+
+Patterns are grouped in categories exercising different parts of the
+matcher, and are written for the trees of benchmarks.generators (species
+codes in leaf names, evoltype in internal nodes):
+
+ - strict: plain topologies with attribute constraints.
+ - occurrence: children with +, * and {min,max} occurrences.
+ - loose: sub-patterns connected through loose connections (^).
+ - functions: constraints relying on syntax functions and their cache.
+'''
+
+from collections import OrderedDict
+
+CORPUS = OrderedDict([
+    ("strict", OrderedDict([
+        ("cherry", """ ('@.species == "Hsa"', '@.species == "Ptr"') ; """),
+        ("nested", """ (('@.species == "Hsa"', '@.species == "Ptr"')'@.evoltype == "S"', ('@', '@')'@')'@.support > 0.5' ; """),
+        ("name", """ ('Rno_1', '@') ; """),
+        ("attributes", """ ('@.dist > 0.5 and @.support > 0.9', '@.is_leaf()')'@.evoltype == "D"' ; """),
+    ])),
+    ("occurrence", OrderedDict([
+        ("plus", """ ('@.species == "Hsa"+', '@*') ; """),
+        ("star", """ ('@.species == "Hsa"', '@*')'@.evoltype == "S"' ; """),
+        ("range", """ ('@.is_leaf(){2,4}', '@*') ; """),
+        ("nested_star", """ (('@.species == "Mmu"+', '@*')'@+')'@.evoltype == "D"' ; """),
+    ])),
+    ("loose", OrderedDict([
+        ("pair", """ ('@.species == "Hsa"', '@.species == "Mmu"')^ ; """),
+        ("cherries", """ (('@.species == "Hsa"', '@.species == "Ptr"')'@', ('@.species == "Dme"', '@')'@')^ ; """),
+        ("nested", """ (('@.species == "Rno"', '@.species == "Cel"')^, '@.species == "Dme"')^ ; """),
+    ])),
+    ("functions", OrderedDict([
+        ("contains", """ ('@+')'n_leaves(@) > 1 and contains_species(@, ["Hsa", "Dme"])' ; """),
+        ("events", """ (('@+')'n_species(@) >= 2', ('@+')'n_speciations(@) > 0')'n_duplications(@) == 0' ; """),
+        ("leaves", """ (('@+')'contains_leaves(@, ["Rno_0", "Rno_1"])', ('@+')'@')'depth(@) > 1' ; """),
+    ])),
+])
+
+
+def iter_patterns(categories=None):
+    ''' Iterates over (category, name, pattern) tuples of the corpus, only
+    for the given categories if any. '''
+    for category, patterns in CORPUS.items():
+        if categories and category not in categories:
+            continue
+        for name, pattern in patterns.items():
+            yield category, name, pattern
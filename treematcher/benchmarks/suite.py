@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+'''Benchmark suite of the matcher, tracking performance between commits.
+
+Every pattern of the corpus (see benchmarks.patterns) is searched in
+synthetic trees of every shape and size (see benchmarks.generators), and the
+phases of the search are timed separately:
+
+ - index: building the TreeAttributeIndex of the tree (once per tree).
+ - cache: building the cache of syntax functions (once per tree).
+ - match_matrix: compute_match_matrix() of the pattern.
+ - children_match: children_match() of the candidates of every sub-pattern
+   root, given the match matrix.
+ - find_matches: a complete search with find_matches(), building everything
+   it needs.
+
+Times are the minimum of several runs. The peak memory allocated by a
+complete search is measured with tracemalloc in a separate run, so it
+doesn't slow down the timed ones. Measures taking longer than a timeout
+are interrupted (where SIGALRM is available), recorded as null, and the
+pattern is skipped in larger trees of the same shape. Results are written as
+JSON, and two result files can be compared to spot regressions:
+
+usage: python -m treematcher.benchmarks.suite [-s SHAPE ...] [-n N_LEAVES ...]
+                                              [-c CATEGORY ...] [-o results.json]
+       python -m treematcher.benchmarks.suite --compare old.json new.json
+'''
+
+from __future__ import print_function
+
+import json
+import platform
+import signal
+import subprocess
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from timeit import default_timer as timer
+
+from treematcher import treematcher
+from treematcher.treematcher import (TreePattern, PatternSyntax, TreeAttributeIndex,
+                                     compute_match_matrix, children_match,
+                                     find_matches)
+from treematcher.benchmarks.generators import SHAPES, generate_tree
+from treematcher.benchmarks.patterns import CORPUS, iter_patterns
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+PHASES = ["index", "cache", "match_matrix", "children_match", "find_matches"]
+
+# Relative slowdown reported as a regression by --compare, for times of at
+# least MIN_COMPARED_TIME seconds (shorter ones are too noisy)
+DEFAULT_THRESHOLD = 1.2
+MIN_COMPARED_TIME = 0.001
+
+# Seconds allowed to every measure
+DEFAULT_TIMEOUT = 60
+
+
+class BenchmarkTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise BenchmarkTimeout()
+
+
+def run_with_timeout(func, timeout):
+    ''' Returns the result of func(), raising BenchmarkTimeout if it takes
+    more than timeout seconds. Without SIGALRM, func() is never interrupted.'''
+    if not timeout or not hasattr(signal, "SIGALRM"):
+        return func()
+    handler = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, handler)
+
+
+def best_time(func, repeat, timeout=None):
+    ''' Returns the result of func() and its minimum run time '''
+    best = None
+    for _ in range(repeat):
+        t1 = timer()
+        result = run_with_timeout(func, timeout)
+        elapsed = timer() - t1
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def peak_memory(func):
+    ''' Returns the peak memory in bytes allocated while running func() '''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def match_roots(pattern, c2nodes):
+    ''' Runs children_match() on the candidates of every sub-pattern root,
+    as search_plan() does, and returns the number of successful roots. '''
+    found = 0
+    for proot in pattern.get_plan().roots:
+        for n in c2nodes[proot.constraint]:
+            found += children_match(n, proot, c2nodes)
+    return found
+
+
+def bench_pattern(tree, pattern, index, cache, repeat=3, timeout=None):
+    ''' Times the phases of the search of pattern in tree, given the index and
+    cache of the tree. Phases after a timeout are recorded as None. '''
+    result = {"matches": None, "root_matches": None, "peak_memory": None,
+              "timeout": False,
+              "times": dict.fromkeys(["match_matrix", "children_match",
+                                      "find_matches"])}
+    pattern_cache = cache if pattern.get_plan().uses_cache else None
+    search = lambda: list(find_matches(tree, pattern))
+    try:
+        c2nodes, result["times"]["match_matrix"] = best_time(
+            lambda: compute_match_matrix(pattern, tree, pattern_cache, index),
+            repeat, timeout)
+        result["root_matches"], result["times"]["children_match"] = best_time(
+            lambda: match_roots(pattern, c2nodes), repeat, timeout)
+        matches, result["times"]["find_matches"] = best_time(search, repeat, timeout)
+        result["matches"] = len(matches)
+        result["peak_memory"] = run_with_timeout(lambda: peak_memory(search), timeout)
+    except BenchmarkTimeout:
+        result["timeout"] = True
+    return result
+
+
+def bench_tree(shape, n_leaves, patterns, repeat=3, timeout=None):
+    ''' Times the search of (category, name, pattern) tuples in a tree of the
+    given shape and size. Returns the result of the tree and the ones of
+    every pattern. '''
+    tree = generate_tree(shape, n_leaves)
+    index, index_time = best_time(lambda: TreeAttributeIndex(tree), repeat)
+    cache, cache_time = best_time(lambda: PatternSyntax().build_cache(tree), repeat)
+    tree_result = {"shape": shape, "n_leaves": n_leaves,
+                   "n_nodes": len(index.nodes),
+                   "times": {"index": index_time, "cache": cache_time}}
+
+    results = []
+    for category, name, pattern in patterns:
+        result = bench_pattern(tree, pattern, index, cache, repeat, timeout)
+        result.update({"shape": shape, "n_leaves": n_leaves,
+                       "category": category, "pattern": name})
+        results.append(result)
+    return tree_result, results
+
+
+def _format_time(seconds):
+    return "%10s" % "timeout" if seconds is None else "%10.4f" % seconds
+
+
+def get_revision():
+    ''' Git commit of the working tree, if available '''
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(shapes=None, sizes=None, categories=None, repeat=3, timeout=DEFAULT_TIMEOUT,
+        output=None):
+    shapes = shapes or sorted(SHAPES)
+    sizes = sorted(sizes or DEFAULT_SIZES)
+    patterns = [(category, name, TreePattern(p, quoted_node_names=True))
+                for category, name, p in iter_patterns(categories)]
+
+    report = {
+        "revision": get_revision(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": treematcher.numpy is not None,
+        "repeat": repeat,
+        "timeout": timeout,
+        "trees": [],
+        "results": [],
+    }
+    print("%-12s %8s %-11s %-12s %8s %10s %10s %10s %10s" %(
+        "shape", "leaves", "category", "pattern", "matches", "matrix (s)",
+        "children", "search", "peak (MB)"))
+    for shape in shapes:
+        shape_patterns = list(patterns)
+        for n_leaves in sizes:
+            tree_result, results = bench_tree(shape, n_leaves, shape_patterns,
+                                              repeat, timeout)
+            report["trees"].append(tree_result)
+            report["results"].extend(results)
+            print("%-12s %8d index %.4fs, cache %.4fs" %(
+                shape, n_leaves, tree_result["times"]["index"],
+                tree_result["times"]["cache"]))
+            for r in results:
+                print("%-12s %8d %-11s %-12s %8s %s %s %s %10s" %(
+                    shape, n_leaves, r["category"], r["pattern"],
+                    "-" if r["matches"] is None else r["matches"],
+                    _format_time(r["times"]["match_matrix"]),
+                    _format_time(r["times"]["children_match"]),
+                    _format_time(r["times"]["find_matches"]),
+                    "" if r["peak_memory"] is None else "%.2f" % (r["peak_memory"] / 1e6)))
+            # Patterns that timed out are not searched in larger trees
+            timed_out = set((r["category"], r["pattern"]) for r in results if r["timeout"])
+            shape_patterns = [p for p in shape_patterns if p[:2] not in timed_out]
+
+    if output:
+        with open(output, "w") as handle:
+            json.dump(report, handle, indent=1, sort_keys=True)
+    return report
+
+
+def _result_keys(report):
+    keys = {}
+    for r in report["trees"]:
+        keys[(r["shape"], r["n_leaves"], None, None)] = r
+    for r in report["results"]:
+        keys[(r["shape"], r["n_leaves"], r["category"], r["pattern"])] = r
+    return keys
+
+
+def compare(old_report, new_report, threshold=DEFAULT_THRESHOLD):
+    ''' Prints the ratio between new and old times of the cases found in both
+    reports. Returns the number of regressions: phases slower than threshold
+    times the old ones, phases timing out, or a different number of matches. '''
+    old_keys, new_keys = _result_keys(old_report), _result_keys(new_report)
+    print("%s -> %s" %(old_report.get("revision"), new_report.get("revision")))
+    n_regressions = 0
+    for key in sorted(new_keys, key=lambda k: tuple(str(v) for v in k)):
+        if key not in old_keys:
+            continue
+        old, new = old_keys[key], new_keys[key]
+        shape, n_leaves, category, name = key
+        label = "%s/%d %s" %(shape, n_leaves, "%s/%s" %(category, name) if name else "tree")
+        if old.get("matches") != new.get("matches"):
+            n_regressions += 1
+            print("%-40s matches %s -> %s !" %(label, old["matches"], new["matches"]))
+        for phase in PHASES:
+            if phase not in old["times"] or phase not in new["times"]:
+                continue
+            old_time, new_time = old["times"][phase], new["times"][phase]
+            if old_time is None or new_time is None:
+                if new_time is None and old_time is not None:
+                    n_regressions += 1
+                print("%-40s %-15s %s %s" %(label, phase, _format_time(old_time),
+                                            _format_time(new_time)))
+                continue
+            ratio = new_time / old_time if old_time else float("inf")
+            mark = ""
+            if ratio > threshold and new_time >= MIN_COMPARED_TIME:
+                n_regressions += 1
+                mark = " *"
+            print("%-40s %-15s %10.4f %10.4f %8.2fx%s" %(label, phase, old_time,
+                                                         new_time, ratio, mark))
+    return n_regressions
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-s", "--shape", dest="shapes", nargs="+",
+                        choices=sorted(SHAPES), help="tree shapes (default: all)")
+    parser.add_argument("-n", "--n_leaves", dest="sizes", nargs="+", type=int,
+                        help="tree sizes in number of leaves (default: %s)"
+                        % " ".join(map(str, DEFAULT_SIZES)))
+    parser.add_argument("-c", "--category", dest="categories", nargs="+",
+                        choices=list(CORPUS), help="pattern categories (default: all)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs per measure, the best one is kept")
+    parser.add_argument("-t", "--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds allowed to every measure (0 for no limit)")
+    parser.add_argument("-o", "--output", help="JSON file with the results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two JSON result files")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="slowdown reported as a regression by --compare")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path) as handle:
+                reports.append(json.load(handle))
+        return 1 if compare(reports[0], reports[1], args.threshold) else 0
+
+    run(args.shapes, args.sizes, args.categories, args.repeat, args.timeout,
+        args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,360 @@
+'''Array-backed trees used as lightweight targets of the matcher.
+
+ETE trees keep a Python object with its own dictionary, children list and
+feature set for every node. A CompactTree keeps the same information in a
+few flat columns indexed by the preorder position of the nodes, and nodes
+are small views created the first time they are reached, so large trees
+use much less memory and searches visit contiguous arrays.
+'''
+
+import array
+import operator
+from collections import deque
+
+from ete3 import PhyloTree
+from treematcher.treematcher import numpy, get_value_column
+
+# Attributes of every node, stored in their own columns
+BASE_FEATURES = frozenset(['name', 'dist', 'support'])
+
+
+class NodeView(object):
+    ''' Methods of ETE nodes used by the matcher and syntax functions, for
+    views of nodes stored out of ETE trees (see CompactNode and
+    tree_store.StoredNode).
+
+    Subclasses provide the name, dist, support, features, up and children
+    attributes, a _tree with a get_node() method returning nodes by preorder
+    position, the _index of the node, and _get_size(), the number of nodes in
+    its subtree.
+
+    They can also provide get_column() and get_children_counts(), returning
+    numpy arrays with the values of all nodes in the tree in preorder, used by
+    TreeAttributeIndex to evaluate vectorized constraints. '''
+
+    __slots__ = ()
+
+    def __str__(self):
+        return self.get_ascii(show_internal=False)
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+    def __len__(self):
+        """ Number of leaves under the node, as in ETE """
+        return len(self.get_leaves())
+
+    def __iter__(self):
+        return self.iter_leaves()
+
+    def is_leaf(self):
+        return self._get_size() == 1
+
+    def get_positions(self, nodes):
+        """ Returns a numpy array with the preorder positions of nodes of this
+        tree, used to read their values from columns. """
+        return numpy.fromiter(map(operator.attrgetter('_index'), nodes), dtype=int,
+                              count=len(nodes))
+
+    def is_root(self):
+        return self._index == 0
+
+    def get_tree_root(self):
+        return self._tree.get_node(0)
+
+    def traverse(self, strategy="levelorder", is_leaf_fn=None):
+        """ Iterates over the node and its descendants, as in ETE """
+        if strategy == "preorder":
+            if is_leaf_fn is None:
+                # descendants are the nodes following this one in preorder
+                get_node = self._tree.get_node
+                end = self._index + self._get_size()
+                return (get_node(i) for i in range(self._index, end))
+            return self._iter_preorder(is_leaf_fn)
+        elif strategy == "levelorder":
+            return self._iter_levelorder(is_leaf_fn)
+        elif strategy == "postorder":
+            return self._iter_postorder(is_leaf_fn)
+        raise ValueError("Unknown traversal strategy: %s" % strategy)
+
+    def _iter_preorder(self, is_leaf_fn):
+        to_visit = [self]
+        while to_visit:
+            node = to_visit.pop()
+            yield node
+            if not is_leaf_fn(node):
+                to_visit.extend(reversed(node.children))
+
+    def _iter_levelorder(self, is_leaf_fn):
+        to_visit = deque([self])
+        while to_visit:
+            node = to_visit.popleft()
+            yield node
+            if is_leaf_fn is None or not is_leaf_fn(node):
+                to_visit.extend(node.children)
+
+    def _iter_postorder(self, is_leaf_fn):
+        to_visit = [(self, False)]
+        while to_visit:
+            node, visited = to_visit.pop()
+            if visited or not node.children or (is_leaf_fn and is_leaf_fn(node)):
+                yield node
+            else:
+                to_visit.append((node, True))
+                to_visit.extend((ch, False) for ch in reversed(node.children))
+
+    def iter_descendants(self, strategy="levelorder", is_leaf_fn=None):
+        nodes = self.traverse(strategy, is_leaf_fn)
+        next(nodes)
+        return nodes
+
+    def get_descendants(self, strategy="levelorder", is_leaf_fn=None):
+        return list(self.iter_descendants(strategy, is_leaf_fn))
+
+    def iter_leaves(self, is_leaf_fn=None):
+        for node in self.traverse("preorder", is_leaf_fn):
+            if not node.children or (is_leaf_fn and is_leaf_fn(node)):
+                yield node
+
+    def get_leaves(self, is_leaf_fn=None):
+        return list(self.iter_leaves(is_leaf_fn))
+
+    def get_leaf_names(self, is_leaf_fn=None):
+        return [n.name for n in self.iter_leaves(is_leaf_fn)]
+
+    def iter_ancestors(self):
+        node = self.up
+        while node is not None:
+            yield node
+            node = node.up
+
+    def get_ancestors(self):
+        return list(self.iter_ancestors())
+
+    def get_common_ancestor(self, *target_nodes):
+        """ Returns the lowest common ancestor of this node and the target
+        nodes, given as arguments or in a list. """
+        if len(target_nodes) == 1 and isinstance(target_nodes[0], (list, tuple, set)):
+            target_nodes = target_nodes[0]
+        common = [self] + self.get_ancestors()
+        for node in target_nodes:
+            path = set([node] + node.get_ancestors())
+            common = [n for n in common if n in path]
+        return common[0]
+
+    def to_tree(self):
+        """ Returns a copy of the subtree under this node as a PhyloTree,
+        including its features. If the node is not a root, the copy is
+        attached to an empty parent node, so it is written as in the original
+        tree. """
+        copies = {}
+        for node in self.traverse("preorder"):
+            new_node = PhyloTree()
+            # Stored species are kept instead of parsing them from names
+            new_node._speciesFunction = None
+            new_node.name = node.name
+            new_node.dist = node.dist
+            new_node.support = node.support
+            for feature in node.features - BASE_FEATURES:
+                new_node.add_feature(feature, getattr(node, feature, None))
+            if node is not self:
+                copies[node.up].add_child(new_node)
+            copies[node] = new_node
+        if self.up is not None:
+            PhyloTree().add_child(copies[self])
+        return copies[self]
+
+    def write(self, *args, **kargs):
+        """ Newick of the subtree, see ETE's TreeNode.write() """
+        return self.to_tree().write(*args, **kargs)
+
+    def get_ascii(self, *args, **kargs):
+        return self.to_tree().get_ascii(*args, **kargs)
+
+    def render(self, *args, **kargs):
+        return self.to_tree().render(*args, **kargs)
+
+
+class CompactNode(NodeView):
+    ''' View of a node in a CompactTree. Attributes are read from the columns
+    of the tree, and nodes can't be modified. '''
+
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._index = index
+
+    def __repr__(self):
+        return "Compact node '%s' (%s)" % (self.name, hex(id(self)))
+
+    def __getattr__(self, attr_name):
+        # Features other than name, dist and support
+        if attr_name.startswith('_'):
+            raise AttributeError(attr_name)
+        column = self._tree._feature_values.get(attr_name)
+        if column is not None:
+            k = self._tree._features.index(attr_name)
+            if self._tree._feature_mask[self._index] & (1 << k) or \
+               column[self._index] is not None:
+                return column[self._index]
+        raise AttributeError("'%s' object has no attribute '%s'" %
+                             (type(self).__name__, attr_name))
+
+    def _get_size(self):
+        return self._tree._size[self._index]
+
+    def is_leaf(self):
+        return self._tree._size[self._index] == 1
+
+    def get_column(self, attr_name):
+        return self._tree._get_column(attr_name)
+
+    def get_children_counts(self):
+        return self._tree._get_column(('children', len))
+
+    @property
+    def name(self):
+        return self._tree._names[self._index]
+
+    @property
+    def dist(self):
+        return self._tree._dist[self._index]
+
+    @property
+    def support(self):
+        return self._tree._support[self._index]
+
+    @property
+    def features(self):
+        mask = self._tree._feature_mask[self._index]
+        features = set(BASE_FEATURES)
+        for k, feature in enumerate(self._tree._features):
+            if mask & (1 << k):
+                features.add(feature)
+        return features
+
+    @property
+    def up(self):
+        parent = self._tree._parent[self._index]
+        return None if parent < 0 else self._tree.get_node(parent)
+
+    @property
+    def children(self):
+        tree, i = self._tree, self._index
+        children = tree._children[i]
+        if children is None:
+            get_node = tree.get_node
+            start, end = tree._child_start[i], tree._child_start[i + 1]
+            children = tree._children[i] = tuple(get_node(ich) for ich in
+                                                 tree._child_index[start:end])
+        return children
+
+
+class CompactTree(CompactNode):
+    ''' Array-backed copy of a tree, which can be used instead of the ETE
+    tree as target of any search. The CompactTree is the view of the root
+    node, as ETE trees are their own root.
+
+    Nodes are numbered in preorder, and the tree keeps the parent of every
+    node, the children of every node in compressed sparse row format (the
+    children of node i are child_index[child_start[i]:child_start[i + 1]]),
+    the size of every subtree, and one column per node attribute. Children
+    are returned as tuples, as nodes can't be modified. '''
+
+    __slots__ = ('_parent', '_child_start', '_child_index', '_size', '_dist',
+                 '_support', '_names', '_features', '_feature_values',
+                 '_feature_mask', '_nodes', '_children', '_columns')
+
+    def __init__(self, tree, features=None):
+        """
+        :param tree: a regular ETE tree instance
+        :param features: node features copied besides name, dist and
+            support. By default, all features found in the tree, and species
+            in PhyloTrees. Features of PhyloTree nodes that are not listed in
+            their features (e.g. species of internal nodes) are also copied.
+        """
+        nodes = list(tree.traverse("preorder"))
+        node2index = {n: i for i, n in enumerate(nodes)}
+        n_nodes = len(nodes)
+        if features is None:
+            # Species of PhyloTree nodes are always defined
+            features = set(['species']) if isinstance(tree, PhyloTree) else set()
+            for n in nodes:
+                features.update(n.features)
+            features = sorted(features - BASE_FEATURES)
+
+        self._parent = array.array('i', [-1] * n_nodes)
+        self._size = array.array('i', [1] * n_nodes)
+        self._child_start = array.array('i', [0] * (n_nodes + 1))
+        self._child_index = array.array('i')
+        for i, n in enumerate(nodes):
+            self._child_start[i] = len(self._child_index)
+            self._child_index.extend(node2index[ch] for ch in n.children)
+        self._child_start[n_nodes] = len(self._child_index)
+        for i in range(n_nodes - 1, 0, -1):
+            parent = self._parent[i] = node2index[nodes[i].up]
+            self._size[parent] += self._size[i]
+
+        self._dist = array.array('d', [n.dist for n in nodes])
+        self._support = array.array('d', [n.support for n in nodes])
+        self._names = [n.name for n in nodes]
+        self._features = list(features)
+        # Repeated values (e.g. species computed from node names) are kept
+        # only once
+        values = {}
+        self._feature_values = {}
+        for f in self._features:
+            column = self._feature_values[f] = [getattr(n, f, None) for n in nodes]
+            for i, value in enumerate(column):
+                try:
+                    column[i] = values.setdefault(value, value)
+                except TypeError:
+                    pass
+        # Listed features of each node as a bit mask. Masks are shared by
+        # nodes with the same features
+        masks = {}
+        self._feature_mask = [0] * n_nodes
+        for i, n in enumerate(nodes):
+            mask = sum(1 << k for k, f in enumerate(self._features) if f in n.features)
+            self._feature_mask[i] = masks.setdefault(mask, mask)
+
+        self._nodes = [None] * n_nodes
+        self._nodes[0] = self
+        self._children = [None] * n_nodes
+        self._columns = {}
+        CompactNode.__init__(self, self, 0)
+
+    def __repr__(self):
+        return "Compact tree '%s' (%s)" % (self.name, hex(id(self)))
+
+    def __len__(self):
+        return sum(1 for size in self._size if size == 1)
+
+    def _get_column(self, attr_name):
+        # numpy columns of the tree, in preorder (see NodeView)
+        if numpy is None:
+            return None
+        if attr_name not in self._columns:
+            if attr_name == ('children', len):
+                column = numpy.diff(numpy.array(self._child_start))
+            elif attr_name in ('dist', 'support'):
+                column = numpy.array(getattr(self, '_' + attr_name))
+            elif attr_name == 'name':
+                column = get_value_column(self._names)
+            elif attr_name in self._feature_values:
+                column = get_value_column(self._feature_values[attr_name])
+            else:
+                column = None
+            self._columns[attr_name] = column
+        return self._columns[attr_name]
+
+    def get_node(self, i):
+        """ Returns the node at position i in preorder. The same node is
+        always represented by the same object. """
+        node = self._nodes[i]
+        if node is None:
+            node = self._nodes[i] = CompactNode(self, i)
+        return node
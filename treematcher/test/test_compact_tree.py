@@ -0,0 +1,95 @@
+import unittest
+import random
+from ete3 import PhyloTree, Tree
+from treematcher.treematcher import TreePattern, PatternSet, TreeAttributeIndex, numpy
+from treematcher.compact_tree import CompactTree
+
+SPECIES = ["Hsa", "Ptr", "Mmu", "Dme"]
+
+
+def random_tree(n_leaves):
+    t = PhyloTree()
+    t.populate(n_leaves, names_library=["%s_%d" %(random.choice(SPECIES), i)
+                                        for i in range(n_leaves)],
+               random_branches=True)
+    for n in t.traverse():
+        if n.children:
+            n.name = random.choice(["", "x", "y"])
+            if random.random() < 0.5:
+                n.add_feature("evoltype", random.choice("DS"))
+    return t
+
+
+class Test_compact_tree(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        self.trees = [random_tree(random.randint(1, 40)) for _ in range(20)]
+
+    def test_nodes(self):
+        for t in self.trees:
+            compact = CompactTree(t)
+            nodes, compact_nodes = list(t.traverse()), list(compact.traverse())
+            self.assertEqual(len(nodes), len(compact_nodes))
+            node2compact = dict(zip(nodes, compact_nodes))
+            for n, c in zip(nodes, compact_nodes):
+                for attr in ("name", "dist", "support", "species", "evoltype"):
+                    self.assertEqual(getattr(n, attr, None), getattr(c, attr, None))
+                self.assertEqual(n.features, c.features)
+                self.assertEqual([node2compact[ch] for ch in n.children], list(c.children))
+                self.assertEqual(node2compact.get(n.up), c.up)
+                self.assertEqual(n.is_leaf(), c.is_leaf())
+                self.assertEqual(n.is_root(), c.is_root())
+                self.assertIs(c.get_tree_root(), compact)
+            for strategy in ("preorder", "postorder", "levelorder"):
+                self.assertEqual([node2compact[n] for n in t.traverse(strategy)],
+                                 list(compact.traverse(strategy)))
+            self.assertEqual(t.get_leaf_names(), compact.get_leaf_names())
+            self.assertEqual(len(t), len(compact))
+            self.assertEqual(t.write(features=[]), compact.write(features=[]))
+            self.assertEqual(str(t), str(compact))
+
+    def test_read_only(self):
+        compact = CompactTree(Tree("((a,b)c,d);", format=1))
+        self.assertRaises(AttributeError, setattr, compact.children[0], "name", "e")
+        self.assertRaises(AttributeError, getattr, compact.children[0], "species")
+
+    def test_search(self):
+        patterns = PatternSet([
+            """ (a, b)c; """,
+            """ ('@.species == "Hsa"', '@.species == "Ptr"'); """,
+            """ ('@.is_leaf() and @.name.startswith("Hsa")', '@.children'); """,
+            """ ('@.dist > 0.5', '@.evoltype == "D"')x; """,
+            """ ('@.species == "Hsa"', '@.species == "Mmu"')^; """,
+            """ '@.children and n_leaves(@) > 3 and contains_species(@, ["Hsa", "Dme"])'; """,
+            """ ('@', '@+')'@.evoltype == "S"'; """,
+            """ ('@.name == "Hsa_1"', '@.name == "Ptr_2"' )'depth(@) > 1'; """,
+        ])
+        for t in self.trees:
+            compact = CompactTree(t)
+            node2compact = dict(zip(t.traverse(), compact.traverse()))
+            for matches, compact_matches in zip(patterns.find_matches(t),
+                                                patterns.find_matches(compact)):
+                self.assertEqual([node2compact[n] for n in matches], compact_matches)
+
+            pattern = TreePattern(""" ('@.species == "Hsa"', '@'); """)
+            self.assertEqual([node2compact[n] for n in pattern.find_match(t)],
+                             list(pattern.find_match(compact)))
+
+    @unittest.skipIf(numpy is None, "numpy is not available")
+    def test_columns(self):
+        t = random_tree(100)
+        for leaf in t.iter_leaves():
+            leaf.add_feature("score", random.randint(0, 5))
+        index, compact_index = TreeAttributeIndex(t), TreeAttributeIndex(CompactTree(t))
+        for attr in ("name", "dist", "support", "species", "evoltype", "score"):
+            column, compact_column = index.get_column(attr), compact_index.get_column(attr)
+            if column is None:
+                self.assertIsNone(compact_column, attr)
+            else:
+                self.assertEqual(column.tolist(), compact_column.tolist(), attr)
+        self.assertEqual(index.get_children_counts().tolist(),
+                         compact_index.get_children_counts().tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
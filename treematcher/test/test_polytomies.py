@@ -0,0 +1,84 @@
+import unittest
+import itertools
+import random
+from ete3 import Tree
+from treematcher.treematcher import TreePattern, assign_children
+
+
+def brute_force_assignment(candidates, min_occur, max_occur, n_targets):
+    # try every mapping from target children to pattern children
+    for assignment in itertools.product(range(len(candidates)), repeat=n_targets):
+        if any(t not in candidates[p] for t, p in enumerate(assignment)):
+            continue
+        if all(min_occur[p] <= assignment.count(p) <= max_occur[p]
+               for p in range(len(candidates))):
+            return True
+    return False
+
+def polytomy(counts):
+    leaves = ["%s_%d" %(name, i) for name, n in sorted(counts.items())
+              for i in range(n)]
+    random.shuffle(leaves)
+    return Tree("(%s)root;" %(",".join(leaves)), format=1)
+
+
+class Test_assign_children(unittest.TestCase):
+    def test_random_equivalence(self):
+        random.seed(0)
+        for _ in range(500):
+            n_targets = random.randint(0, 6)
+            n_pattern = random.randint(1, 3)
+            candidates, min_occur, max_occur = [], [], []
+            for _ in range(n_pattern):
+                candidates.append([t for t in range(n_targets) if random.random() < 0.6])
+                min_occur.append(random.randint(0, 2))
+                max_occur.append(min_occur[-1] + random.choice([0, 1, 2, 9999999]))
+
+            self.assertEqual(assign_children(candidates, min_occur, max_occur, n_targets),
+                             brute_force_assignment(candidates, min_occur, max_occur, n_targets),
+                             (candidates, min_occur, max_occur, n_targets))
+
+    def test_alternating_paths(self):
+        # the greedy choice for the first pattern child must be revised
+        self.assertTrue(assign_children([[0, 1], [0]], [1, 1], [1, 1], 2))
+        self.assertTrue(assign_children([[0, 1, 2], [0], [1]], [1, 1, 1], [1, 1, 1], 3))
+        self.assertFalse(assign_children([[0], [0]], [1, 1], [1, 1], 1))
+        self.assertFalse(assign_children([[0, 1, 2], [0, 1]], [0, 0], [1, 1], 3))
+
+
+class Test_large_polytomies(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.t = polytomy({'a': 100, 'b': 50, 'c': 50})
+
+    def assert_match(self, pattern, expected):
+        pattern = TreePattern(pattern, quoted_node_names=True)
+        result = list(pattern.find_match(self.t))
+        self.assertEqual(result, [self.t] if expected else [])
+
+    def test_repetitions(self):
+        self.assert_match(""" ("@.name.startswith('a')+", "@.name.startswith('b')+", "@.name.startswith('c')+")root ; """, True)
+        self.assert_match(""" ("@.name.startswith('a'){100,100}", "@.name.startswith('b'){50,60}", "@.name.startswith('c')*")root ; """, True)
+        self.assert_match(""" ("@.name.startswith('a'){101,200}", "@.name.startswith('b')+", "@.name.startswith('c')+")root ; """, False)
+        self.assert_match(""" ("@.name.startswith('a')+", "@.name.startswith('b')+")root ; """, False)
+        self.assert_match(""" ("@.name.startswith('a')+", "@.name.startswith('b'){1,49}", "@.name.startswith('c')+")root ; """, False)
+
+    def test_overlapping_constraints(self):
+        self.assert_match(""" ("@.name[0] in 'ab'{120,160}", "@.name.startswith('a'){10,40}", "@.name.startswith('c')+")root ; """, True)
+        self.assert_match(""" ("@.name[0] in 'ab'{120,130}", "@.name.startswith('a'){10,19}", "@.name.startswith('c')+")root ; """, False)
+        self.assert_match(""" ("@.name[0] in 'ab'{0,99}", "@.name[0] in 'bc'*")root ; """, False)
+        self.assert_match(""" ("@.name[0] in 'ab'*", "@.name[0] in 'bc'*", "a_0")root ; """, True)
+
+    def test_nested_polytomies(self):
+        subtrees = ["(x,%s)" %(",".join(["y"] * random.randint(1, 20))) for _ in range(30)]
+        subtrees.append("(x,z)")
+        t = Tree("(%s)root;" %(",".join(subtrees)), format=1)
+
+        pattern = TreePattern(""" ((x, 'y+')'@+')root ; """, quoted_node_names=True)
+        self.assertEqual(list(pattern.find_match(t)), [])
+        pattern = TreePattern(""" ((x, 'y+')'@+', (x, z))root ; """, quoted_node_names=True)
+        self.assertEqual(list(pattern.find_match(t)), [t])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+from treematcher.treematcher import TreePattern
+from treematcher.tools import result_cache
+from treematcher.tools.result_cache import (ResultCache, get_pattern_digest,
+                                            get_tree_digest)
+
+
+class Test_result_cache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "results.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_digests(self):
+        pattern = TreePattern(""" ('@.species == "Hsa"', '@.species == "Ptr"+')'@.dist > 1' ;""")
+        same = TreePattern(""" ( '@.species == "Hsa"' , '@.species == "Ptr"+' ) '@.dist > 1' ;""")
+        self.assertEqual(get_pattern_digest(pattern), get_pattern_digest(same))
+        for other in [""" ('@.species == "Hsa"', '@.species == "Ptr"')'@.dist > 1' ;""",
+                      """ ('@.species == "Hsa"', '@.species == "Ptr"+')'^' ;""",
+                      """ ('@.species == "Ptr"+', '@.species == "Hsa"')'@.dist > 1' ;"""]:
+            self.assertNotEqual(get_pattern_digest(pattern),
+                                get_pattern_digest(TreePattern(other)))
+        self.assertNotEqual(get_pattern_digest(pattern),
+                            get_pattern_digest(pattern, first_match=True))
+
+        newick = "((a,b)c,d);"
+        self.assertEqual(get_tree_digest(newick), get_tree_digest(newick + "\n"))
+        self.assertNotEqual(get_tree_digest(newick), get_tree_digest(newick, 1))
+        path = os.path.join(self.tmpdir, "tree.nw")
+        with open(path, "w") as handle:
+            handle.write(newick)
+        self.assertEqual(get_tree_digest(path), get_tree_digest(newick))
+
+    def test_get_put(self):
+        with ResultCache(self.path) as cache:
+            self.assertEqual(cache.get("t1", ["p1", "p2"]), [None, None])
+            cache.put("t1", "p1", [3, 1])
+            cache.put("t1", "p2", [])
+            self.assertEqual(cache.get("t1", ["p1", "p2", "p3"]), [[3, 1], [], None])
+            self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+        # results are kept on disk
+        with ResultCache(self.path) as cache:
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.get("t1", ["p2", "p1"]), [[], [3, 1]])
+
+    def test_eviction(self):
+        with ResultCache(self.path, max_entries=3) as cache:
+            for tree in ["t1", "t2", "t3", "t4"]:
+                cache.put(tree, "p", [1])
+            # t1 is used again, so t2 is the least recently used
+            cache.get("t1", ["p"])
+        with ResultCache(self.path, max_entries=3) as cache:
+            self.assertEqual(len(cache), 3)
+            self.assertEqual(cache.get("t2", ["p"]), [None])
+            self.assertEqual(cache.get("t1", ["p"]), [[1]])
+
+            # size of every result: keys and matches
+            size = len("t1") + len("p") + len("[1]")
+            cache.max_size = 2 * size
+            self.assertEqual(cache.evict(), 1)
+            self.assertEqual(cache.get("t3", ["p"]), [None])
+            self.assertEqual(len(cache), 2)
+
+    def test_version(self):
+        with ResultCache(self.path) as cache:
+            cache.put("t1", "p1", [1])
+        db = sqlite3.connect(self.path)
+        db.execute("UPDATE meta SET value = ? WHERE key = 'version'",
+                   (str(result_cache.CACHE_VERSION + 1),))
+        db.commit()
+        db.close()
+        with ResultCache(self.path) as cache:
+            self.assertEqual(len(cache), 0)
+
+    def test_not_a_cache(self):
+        with open(self.path, "w") as handle:
+            handle.write("(a,b);\n" * 100)
+        self.assertRaises(ValueError, ResultCache, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import bz2
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+from ete3 import Tree
+from treematcher.tools.tree_reader import iter_trees
+
+
+class Test_tree_reader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, text, **kargs):
+        return list(iter_trees(io.StringIO(text), **kargs))
+
+    def test_newick_lines(self):
+        text = u"(a,b)c;\n((d,e),f);(g,h);\n\n  (i,\n (j,\r\n k));\n"
+        expected = [("0", "(a,b)c;"), ("1", "((d,e),f);"), ("2", "(g,h);"),
+                    ("3", "(i, (j, k));")]
+        self.assertEqual(self.read(text), expected)
+        # trees split in any position of the blocks read
+        for read_size in (1, 2, 3, 7):
+            self.assertEqual(self.read(text, read_size=read_size), expected)
+
+    def test_tree_ids(self):
+        text = (u"tree_1\t(a,b);\n"
+                u"tree_2\t((c,\n d), e);\n"
+                u"tree_3\t(f,g)\n"
+                u"(h,i);\n")
+        self.assertEqual(self.read(text, read_size=5),
+                         [("tree_1", "(a,b);"), ("tree_2", "((c, d), e);"),
+                          ("tree_3", "(f,g);"), ("3", "(h,i);")])
+
+    def test_unbalanced_rows(self):
+        text = (u"t1\t(a,b);\n"
+                u"t2\t((c,\n d), e);\n"
+                u"t3\t((broken\n"
+                u"t4\t(f,g);\n"
+                u"t5\t(h,i)\n")
+        for read_size in (3, 100):
+            self.assertEqual(self.read(text, read_size=read_size),
+                             [("t1", "(a,b);"), ("t2", "((c, d), e);"),
+                              ("t3", "((broken;"), ("t4", "(f,g);"),
+                              ("t5", "(h,i);")])
+
+        # Without tree IDs, the size of a tree is bounded
+        text = u"(a,b)\n((broken\n" + u"(c,d)\n" * 100
+        trees = iter_trees(io.StringIO(text), read_size=10, max_tree_size=50)
+        self.assertEqual(next(trees), ("0", "(a,b);"))
+        self.assertRaises(ValueError, next, trees)
+
+    def test_quotes_and_comments(self):
+        text = u"('a;b',c[&&NHX:note=x;y])'d\te';\n('(',')');"
+        trees = self.read(text, read_size=4)
+        self.assertEqual(trees, [("0", "('a;b',c[&&NHX:note=x;y])'d\te';"),
+                                 ("1", "('(',')');")])
+        t = Tree(trees[0][1], quoted_node_names=True, format=1)
+        self.assertEqual(sorted(t.get_leaf_names()), ["a;b", "c"])
+
+    def test_stdin(self):
+        stdin = sys.stdin
+        sys.stdin = io.StringIO(u"(a,b);\n(c,d);\n")
+        try:
+            self.assertEqual(list(iter_trees('-')), [("0", "(a,b);"), ("1", "(c,d);")])
+            self.assertFalse(sys.stdin.closed)
+        finally:
+            sys.stdin = stdin
+
+    def test_compressed_files(self):
+        trees = [Tree() for _ in range(20)]
+        for t in trees:
+            t.populate(10)
+        text = "".join("id_%d\t%s\n" %(i, t.write()) for i, t in enumerate(trees))
+
+        paths = []
+        for name, opener in (("trees.nw", open), ("trees.nw.gz", gzip.open),
+                             ("trees.nw.bz2", bz2.BZ2File)):
+            path = os.path.join(self.tmpdir, name)
+            handle = opener(path, 'wb')
+            handle.write(text.encode())
+            handle.close()
+            paths.append(path)
+
+        for path in paths:
+            result = list(iter_trees(path, read_size=100))
+            self.assertEqual([tree_id for tree_id, _ in result],
+                             ["id_%d" %i for i in range(20)])
+            self.assertEqual([nw for _, nw in result], [t.write() for t in trees])
+
+
+if __name__ == '__main__':
+    unittest.main()
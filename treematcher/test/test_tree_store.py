@@ -0,0 +1,156 @@
+import unittest
+import gzip
+import os
+import random
+import shutil
+import tempfile
+from ete3 import PhyloTree
+from treematcher.treematcher import TreePattern, PatternSet, TreeAttributeIndex, numpy
+from treematcher.tools.tree_store import TreeStore, TreeStoreWriter, convert
+
+SPECIES = ["Hsa", "Ptr", "Mmu", "Dme"]
+
+
+def random_tree(n_leaves):
+    t = PhyloTree()
+    t.populate(n_leaves, names_library=[u"%s_%d" %(random.choice(SPECIES), i)
+                                        for i in range(n_leaves)],
+               random_branches=True)
+    for n in t.traverse():
+        if n.children:
+            n.name = random.choice(["", "x", u"nó"])
+            if random.random() < 0.5:
+                n.add_feature("evoltype", random.choice("DS"))
+    return t
+
+
+class Test_tree_store(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "trees.tms")
+        self.trees = [random_tree(random.randint(1, 30)) for _ in range(20)]
+        with TreeStoreWriter(self.path) as writer:
+            for i, t in enumerate(self.trees):
+                writer.add(t, "tree_%d" %i if i % 2 else None)
+        self.store = TreeStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.store), len(self.trees))
+        self.assertEqual([tree_id for tree_id, _ in self.store],
+                         ["tree_%d" %i if i % 2 else str(i) for i in range(20)])
+
+        for t, root in zip(self.trees, self.store):
+            stored = root[1]
+            nodes, stored_nodes = list(t.traverse()), list(stored.traverse())
+            self.assertEqual(len(nodes), len(stored_nodes))
+            node2stored = dict(zip(nodes, stored_nodes))
+            for n, s in zip(nodes, stored_nodes):
+                for attr in ("name", "dist", "support", "species", "evoltype"):
+                    self.assertEqual(getattr(n, attr, None), getattr(s, attr, None))
+                self.assertEqual(n.features, s.features)
+                self.assertEqual([node2stored[ch] for ch in n.children], s.children)
+                self.assertEqual(node2stored.get(n.up), s.up)
+                self.assertEqual(n.is_leaf(), s.is_leaf())
+            for strategy in ("preorder", "postorder", "levelorder"):
+                self.assertEqual([node2stored[n] for n in t.traverse(strategy)],
+                                 list(stored.traverse(strategy)))
+            self.assertEqual(t.get_leaf_names(), stored.get_leaf_names())
+
+            self.assertEqual(t.write(features=[]), stored.write(features=[]))
+            self.assertEqual(t.write(format=1), stored.to_tree().write(format=1))
+            self.assertEqual(str(t), str(stored))
+            for n in t.children:
+                self.assertEqual(n.write(features=[]), node2stored[n].write(features=[]))
+
+        # nodes of a tree read from the store are always represented by the
+        # same object
+        root = self.store[0]
+        self.assertIs(root.children[0].get_tree_root(), root)
+        self.assertIs(root.children[0].up, root)
+        self.assertIs(list(root.traverse())[1], root.children[0])
+
+    def test_search(self):
+        patterns = PatternSet([
+            """ ('@.species == "Hsa"', '@.species == "Ptr"'); """,
+            """ ('@.dist > 0.5', '@.evoltype == "D"')x; """,
+            """ ('@.species == "Hsa"', '@.species == "Mmu"')^; """,
+            """ '@.children and n_leaves(@) > 3 and contains_species(@, ["Hsa", "Dme"])'; """,
+            """ ('@', '@+')'@.evoltype == "S"'; """,
+        ])
+        for t, (_, stored) in zip(self.trees, self.store):
+            preorder = {n: i for i, n in enumerate(t.traverse("preorder"))}
+            stored_preorder = {n: i for i, n in enumerate(stored.traverse("preorder"))}
+            expected = patterns.find_matches(t)
+            found = patterns.find_matches(stored)
+            for matches, stored_matches in zip(expected, found):
+                self.assertEqual([preorder[n] for n in matches],
+                                 [stored_preorder[n] for n in stored_matches])
+
+            pattern = TreePattern(""" ('@.species == "Hsa"', '@'); """)
+            self.assertEqual(len(list(pattern.find_match(t))),
+                             len(list(pattern.find_match(stored))))
+
+    @unittest.skipIf(numpy is None, "numpy is not available")
+    def test_columns(self):
+        for t, (_, stored) in zip(self.trees, self.store):
+            index, stored_index = TreeAttributeIndex(t), TreeAttributeIndex(stored)
+            for attr in ("name", "dist", "support", "species", "evoltype"):
+                column, stored_column = index.get_column(attr), stored_index.get_column(attr)
+                if column is None:
+                    self.assertIsNone(stored_column, attr)
+                else:
+                    self.assertEqual(column.tolist(), stored_column.tolist(), attr)
+            self.assertEqual(index.get_children_counts().tolist(),
+                             stored_index.get_children_counts().tolist())
+
+    def test_convert(self):
+        source = os.path.join(self.tmpdir, "trees.nw.gz")
+        handle = gzip.open(source, "wb")
+        for i, t in enumerate(self.trees):
+            handle.write(("id_%d\t%s\n" %(i, t.write(format=1))).encode("utf-8"))
+        handle.write(b"broken\t((a,b);\n")
+        handle.close()
+
+        path = os.path.join(self.tmpdir, "converted.tms")
+        self.assertEqual(convert(source, path, tree_format=1), len(self.trees))
+        with TreeStore(path) as store:
+            for i, (t, (tree_id, stored)) in enumerate(zip(self.trees, store)):
+                self.assertEqual(tree_id, "id_%d" %i)
+                self.assertEqual(stored.write(format=1), t.write(format=1))
+
+    def test_tree_digests(self):
+        digests = [self.store.get_tree_digest(i) for i in range(len(self.store))]
+        self.assertEqual(len(set(digests)), len(self.trees))
+
+        # Same digests for the same trees, whatever their ID or position
+        path = os.path.join(self.tmpdir, "copy.tms")
+        with TreeStoreWriter(path) as writer:
+            for t in reversed(self.trees):
+                writer.add(t)
+            t = self.trees[0].copy()
+            t.children[0].dist += 1
+            writer.add(t)
+        with TreeStore(path) as store:
+            self.assertEqual([store.get_tree_digest(i) for i in range(len(self.trees))],
+                             digests[::-1])
+            self.assertNotIn(store.get_tree_digest(len(self.trees)), digests)
+
+            # Stores without stored digests compute them from their columns
+            store._tree_digest = None
+            self.assertEqual([store.get_tree_digest(i) for i in range(len(self.trees))],
+                             digests[::-1])
+
+    def test_not_a_store(self):
+        path = os.path.join(self.tmpdir, "trees.nw")
+        with open(path, "w") as handle:
+            handle.write("(a,b);\n")
+        self.assertRaises(ValueError, TreeStore, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,17 @@
 import unittest
+import operator
 from ete3 import  Tree
-from treematcher.treematcher import TreePattern
+import random
+from ete3 import PhyloTree
+from treematcher.treematcher import (TreePattern, PatternSyntax, TreePatternCache,
+                                     TreeAggregateIndex, TreeAttributeIndex,
+                                     TreeAncestorIndex, MatchMatrix, compute_match_matrix,
+                                     children_match, combine_loose_matches, PatternSet,
+                                     get_vector_constraint, numpy, SearchStats,
+                                     SearchBudget, SearchBudgetExceeded,
+                                     IncompleteMatches, IncrementalMatcher)
+import itertools
+import pickle
 from copy import deepcopy
 #class Test_strict_match():
 class Test_strict_match(unittest.TestCase):
@@ -320,5 +331,620 @@ class Test_basic_tests(unittest.TestCase):
         self.assertTrue(test)
 
 
+class Test_compiled_constraints(unittest.TestCase):
+    def test_reuse_compiled_pattern(self):
+        pattern = TreePattern(""" ('@.dist > 0.5', 'b')'c' ;""", format=1,
+                              quoted_node_names=True)
+        t1 = Tree("((a:0.6, b)c, d);", format=1)
+        t2 = Tree("((a:0.1, b)c, (b, e:0.9)c);", format=1)
+
+        self.assertEqual(len(list(pattern.find_match(t1))), 1)
+        compiled = [n.compiled_constraint for n in pattern.traverse()]
+
+        self.assertEqual(len(list(pattern.find_match(t2))), 1)
+        self.assertEqual(len(list(pattern.find_match(t1))), 1)
+        for n, code in zip(pattern.traverse(), compiled):
+            self.assertTrue(n.compiled_constraint is code)
+
+    def test_root_syntax_scope(self):
+        class MySyntax(PatternSyntax):
+            def is_b(self, node):
+                return node.name == "b"
+
+        pattern = TreePattern(""" ('is_b(@)', 'a')'c' ;""", format=1,
+                              quoted_node_names=True, syntax=MySyntax())
+        tree = Tree("((a, b)c, d);", format=1)
+        self.assertEqual(len(list(pattern.find_match(tree))), 1)
+
+        scope = pattern.constraint_scope
+        for n in pattern.traverse():
+            self.assertTrue(n.constraint_scope is scope)
+        self.assertRaises(TypeError, operator.setitem, scope, "is_b", None)
+        self.assertNotIn("__builtins__", scope)
+
+        one_use = deepcopy(pattern)
+        self.assertTrue(one_use.constraint_scope.syntax is one_use.syntax)
+        self.assertEqual(len(list(one_use.find_match(tree))), 1)
+
+    def test_pickle_compiled_pattern(self):
+        pattern = TreePattern(""" ('@.dist > 0.5', 'b')'c' ;""", format=1,
+                              quoted_node_names=True)
+        tree = Tree("((a:0.6, b)c, (b, e:0.1)c);", format=1)
+        self.assertEqual(len(list(pattern.find_match(tree))), 1)
+
+        for other in (pickle.loads(pickle.dumps(pattern)), pattern.copy()):
+            self.assertFalse(hasattr(other, 'compiled_constraint'))
+            self.assertEqual(len(list(other.find_match(tree))), 1)
+            self.assertTrue(other.children[0].is_local_match(tree & "a", None))
+        self.assertEqual(len(list(pattern.find_match(tree))), 1)
+
+class Test_cache(unittest.TestCase):
+    def test_automatic_cache(self):
+        class MySyntax(PatternSyntax):
+            def n_leaves(self, target_node):
+                assert isinstance(self.cache, TreeAggregateIndex)
+                return super(MySyntax, self).n_leaves(target_node)
+
+        tree = Tree("(((a, b), (c, d, e)), f);")
+        syntax = MySyntax()
+        pattern = TreePattern(""" (('a', 'b')'n_leaves(@) == 2', ('c', 'd', 'e')'n_leaves(@) == 3') ;""",
+                              quoted_node_names=True, syntax=syntax)
+        self.assertEqual(len(list(pattern.find_match(tree))), 1)
+        # the cache is never set on the syntax shared by the pattern
+        self.assertFalse(isinstance(syntax.cache, TreeAggregateIndex))
+
+    def test_provided_cache(self):
+        tree = Tree("(((a, b), (c, d, e)), (f, g));")
+        cache = TreePatternCache(tree)
+        pattern = TreePattern(""" ('@', '@')'n_leaves(@) == 2 and contains_leaves(@, "f")' ;""",
+                              quoted_node_names=True)
+        self.assertEqual(list(pattern.find_match(tree, cache=cache)),
+                         [(tree&'f').up])
+        self.assertEqual(list(pattern.find_match(tree)), [(tree&'f').up])
+
+    def test_aggregate_index_consistency(self):
+        random.seed(7)
+        tree = PhyloTree()
+        tree.populate(60, names_library=["%s_%d" %(sp, i) for i, sp in
+                                         enumerate(["Hsa", "Ptr", "Mmu", "Dme"] * 20)])
+        for n in tree.traverse():
+            if n.children:
+                n.add_feature("evoltype", random.choice("DS"))
+
+        species = sorted(tree.get_species())
+        fake = PatternSyntax()
+        # species found in many leaves are still contained only once
+        self.assertTrue(fake.contains_species(tree, species))
+        syntaxes = []
+        for cache in (TreePatternCache(tree), TreeAggregateIndex(tree),
+                      TreeAggregateIndex(tree, species_bitsets=True)):
+            syntax = PatternSyntax()
+            syntax.cache = cache
+            syntaxes.append(syntax)
+
+        for node in tree.traverse():
+            leaf_names = node.get_leaf_names()
+            for syntax in syntaxes:
+                self.assertEqual(syntax.leaves(node), fake.leaves(node))
+                self.assertEqual(syntax.descendants(node), fake.descendants(node))
+                self.assertEqual(syntax.species(node), fake.species(node))
+                self.assertEqual(syntax.n_species(node), fake.n_species(node))
+                self.assertEqual(syntax.n_leaves(node), fake.n_leaves(node))
+                self.assertEqual(syntax.n_duplications(node), fake.n_duplications(node))
+                self.assertEqual(syntax.n_speciations(node), fake.n_speciations(node))
+                for sp in (species[:1], species[1:3], species):
+                    self.assertEqual(syntax.contains_species(node, sp),
+                                     fake.contains_species(node, sp))
+                for names in (leaf_names[:1], leaf_names[-2:], ["Hsa_0", "Dme_3"]):
+                    self.assertEqual(syntax.contains_leaves(node, names),
+                                     fake.contains_leaves(node, names))
+
+    def test_species_bitsets(self):
+        tree = PhyloTree("(((Hsa_1, Ptr_1), (Hsa_2, Mmu_1)), Dme_1);")
+        syntax = PatternSyntax(species_bitsets=True)
+        cache = syntax.build_cache(tree)
+        self.assertEqual(len(cache.species2bit), 4)
+        self.assertEqual(cache.n_species(tree), 4)
+        self.assertFalse(cache.contains_species(tree, ["Hsa", "Xla"]))
+
+        pattern = TreePattern(""" (('@', '@')'contains_species(@, ["Hsa", "Ptr"])', ('@', '@'))'n_species(@) == 3' ;""",
+                              quoted_node_names=True, syntax=syntax)
+        self.assertEqual(list(pattern.find_match(tree)), [(tree&'Ptr_1').up.up])
+
+class Test_planner(unittest.TestCase):
+    def test_structural_constraints(self):
+        pattern = TreePattern(""" ('a', '@.dist > 1 and "b" == @.name', 'c+')'@.support > 0.5' ;""",
+                              quoted_node_names=True)
+        for n in pattern.traverse("postorder"):
+            n.init_controller()
+        a, b, c = pattern.children
+        self.assertEqual((a.expects_leaf, a.expected_values), (True, {"name": "a"}))
+        self.assertEqual((b.expects_leaf, b.expected_values), (True, {"name": "b"}))
+        self.assertEqual((pattern.expects_leaf, pattern.expected_values), (False, {}))
+        self.assertEqual((pattern.min_children, pattern.max_children), (3, 2 + 9999999))
+
+    def test_only_candidates_evaluated(self):
+        # the children[0] constraint would fail if evaluated on leaves
+        tree = Tree("((a, b)x, (c, (a, d)y));", format=1)
+        pattern = TreePattern(""" ('a', '@.name in "bd"')'@.children[0].name == "a"' ;""",
+                              quoted_node_names=True)
+        self.assertEqual(set(pattern.find_match(tree)), set([tree&'x', tree&'y']))
+
+    def test_number_of_children(self):
+        tree = Tree("((a, a, b), (a, b), (a, a, a, a, b));")
+        pattern = TreePattern(""" ('b', 'a{2,3}') ;""", quoted_node_names=True)
+        self.assertEqual(list(pattern.find_match(tree)), [(tree&'b').up])
+
+    def test_shared_attribute_index(self):
+        tree = PhyloTree("((Hsa_1, Ptr_1)x, ((Hsa_2, Mmu_1)y, Hsa_3)z);", format=1)
+        index = TreeAttributeIndex(tree)
+        self.assertEqual(index.get_nodes("name", "y"), [tree&'y'])
+
+        patterns = [(TreePattern("(Hsa_1, Ptr_1)x;"), [tree&'x']),
+                    (TreePattern(""" ('@.species == "Hsa"', 'Mmu_1')'@' ;""",
+                                 quoted_node_names=True), [tree&'y']),
+                    (TreePattern(""" (('@', 'Mmu_1')'y', '@.species == "Hsa"')'z' ;""",
+                                 quoted_node_names=True), [tree&'z'])]
+        for pattern, expected in patterns:
+            self.assertEqual(list(pattern.find_match(tree, index=index)), expected)
+        self.assertEqual(len(index.get_nodes("species", "Hsa")), 3)
+
+        # as many internal nodes named x as leaves, but only leaves returned
+        tree = Tree("((x, y)x);", format=1)
+        index = TreeAttributeIndex(tree)
+        self.assertEqual(index.get_candidates(True, {"name": "x"}),
+                         [tree.children[0].children[0]])
+        self.assertEqual(index.get_candidates(False, {"name": "x"}), [tree.children[0]])
+
+class Test_children_match(unittest.TestCase):
+    def test_memo(self):
+        tree = Tree("(((a, b), (a, b), c), ((a, b), c));")
+        pattern = TreePattern(" ((a, b)'@+', c) ;", quoted_node_names=True)
+        for n in pattern.traverse("postorder"):
+            n.init_controller()
+        c2nodes = compute_match_matrix(pattern, tree)
+
+        memo = {}
+        roots = [n for n in c2nodes[pattern.constraint]
+                 if children_match(n, pattern, c2nodes, memo=memo)]
+        self.assertEqual(set(roots), set([(tree&'c').up, tree.children[1]]))
+        self.assertEqual(roots, [n for n in c2nodes[pattern.constraint]
+                                 if children_match(n, pattern, c2nodes)])
+
+        # cached results are reused
+        for key in memo:
+            memo[key] = False
+        self.assertFalse(any(children_match(n, pattern, c2nodes, memo=memo)
+                             for n in roots))
+
+
+class Test_plan(unittest.TestCase):
+    def test_reused_plan(self):
+        tree = Tree("((a, b)x, ((c, d)y, e)z)r;", format=1)
+        pattern = TreePattern(""" ((a, b)x, (c, d)y)'^r' ; """, quoted_node_names=True)
+        nw = pattern.write(format=1)
+
+        self.assertEqual(list(pattern.find_match(tree)), [tree])
+        plan = pattern.get_plan()
+        self.assertEqual(set(n.name for n in plan.roots), set(['x', 'y']))
+        self.assertEqual(len(plan.expected_groups), 1)
+
+        # the pattern is not modified and the plan is reused
+        self.assertEqual(pattern.write(format=1), nw)
+        self.assertEqual(list(pattern.find_match(tree)), [tree])
+        self.assertIs(pattern.get_plan(), plan)
+
+        # copies and modified patterns build their own plan
+        pattern2 = deepcopy(pattern)
+        self.assertEqual(list(pattern2.find_match(tree)), [tree])
+        self.assertIsNot(pattern2.get_plan(), plan)
+        (pattern&'y').name = 'z'
+        self.assertIsNot(pattern.get_plan(), plan)
+        self.assertEqual(list(pattern.find_match(tree)), [])
+
+
+def brute_force_loose(tree, root2matches, groups):
+    '''Reference implementation of combine_loose_matches testing all
+    combinations'''
+    roots = list(root2matches)
+    ancestors = set()
+    for nodes in itertools.product(*root2matches.values()):
+        if len(nodes) != len(set(nodes)):
+            continue
+        lcas = [tree.get_common_ancestor([nodes[roots.index(r)] for r in g])
+                for g in groups]
+        if len(lcas) == len(set(lcas)):
+            ancestors.add(lcas[-1])
+    return ancestors
+
+def caterpillar_tree(n_leaves):
+    t = Tree()
+    node = t
+    for i in range(n_leaves - 1):
+        node.add_child(name="l%d" % i)
+        node = node.add_child()
+    node.name = "l%d" % (n_leaves - 1)
+    return t
+
+
+class Test_loose_combinations(unittest.TestCase):
+    def test_ancestor_index(self):
+        t = Tree()
+        t.populate(50)
+        index = TreeAncestorIndex(t)
+        nodes = list(t.traverse())
+        random.seed(0)
+        fake = PatternSyntax()
+        syntax = PatternSyntax()
+        syntax.cache = TreeAggregateIndex(t)
+        for _ in range(200):
+            a, b = random.choice(nodes), random.choice(nodes)
+            self.assertIs(index.lca(a, b), t.get_common_ancestor(a, b))
+            self.assertEqual(index.is_ancestor(a, b), a is b or a in b.get_ancestors())
+            (pre_a, post_a), (pre_b, post_b) = index.get_interval(a), index.get_interval(b)
+            self.assertEqual(index.is_ancestor(a, b), pre_a <= pre_b and post_a >= post_b)
+            self.assertEqual(index.depth(a), len(a.get_ancestors()))
+
+            some_nodes = random.sample(nodes, random.randint(1, 5))
+            self.assertIs(index.lca(*some_nodes), fake.lca(*some_nodes))
+
+            # syntax functions give the same results with or without cache
+            for func in ('depth', 'is_ancestor', 'lca', 'distance'):
+                args = (a,) if func == 'depth' else (a, b)
+                self.assertEqual(getattr(syntax, func)(*args), getattr(fake, func)(*args))
+        self.assertEqual(index.distance(nodes[-1], nodes[-1]), 0)
+        self.assertEqual(index.distance(t, nodes[-1]), index.depth(nodes[-1]))
+
+    def test_ancestor_syntax(self):
+        t = Tree("((a, (b, c)x)y, d)r;", format=1)
+        pattern = TreePattern(""" 'depth(@) == 2 and distance(@, @.get_tree_root().children[1]) == 3' ; """,
+                              quoted_node_names=True)
+        self.assertEqual(set(n.name for n in pattern.find_match(t)), set(['a']))
+        pattern = TreePattern(""" 'lca(@, @.get_tree_root()&"c").name == "x"' ; """,
+                              quoted_node_names=True)
+        self.assertEqual(set(n.name for n in pattern.find_match(t)), set(['b']))
+
+    def test_random_equivalence(self):
+        groups = [[frozenset('ab')],
+                  [frozenset('ab'), frozenset('cd'), frozenset('abcd')],
+                  [frozenset('ab'), frozenset('abc'), frozenset('abcd')],
+                  [frozenset('bc'), frozenset('abcd')]]
+        random.seed(0)
+        for _ in range(100):
+            t = Tree()
+            t.populate(random.randint(2, 15))
+            nodes = list(t.traverse())
+            index = TreeAncestorIndex(t)
+            for g in groups:
+                root2matches = {r: random.sample(nodes, random.randint(1, min(4, len(nodes))))
+                                for r in sorted(g[-1])}
+                result = list(combine_loose_matches(root2matches, g, index))
+                self.assertEqual(len(result), len(set(result)))
+                self.assertEqual(set(result), brute_force_loose(t, root2matches, g))
+
+    def test_nested_loose_caterpillar(self):
+        # Combinations of nested groups are pruned as soon as the remaining
+        # sub-patterns can't be placed under the children allowed by their
+        # groups
+        groups = [[frozenset('ab'), frozenset('abc'), frozenset('abcd')],
+                  [frozenset('ab'), frozenset('cd'), frozenset('abcd')],
+                  [frozenset('bc'), frozenset('abc'), frozenset('abcd')]]
+        random.seed(0)
+        for _ in range(30):
+            t = caterpillar_tree(random.randint(3, 15))
+            nodes = list(t.traverse())
+            index = TreeAncestorIndex(t)
+            for g in groups:
+                root2matches = {r: random.sample(nodes, random.randint(1, min(5, len(nodes))))
+                                for r in sorted(g[-1])}
+                result = list(combine_loose_matches(root2matches, g, index))
+                self.assertEqual(len(result), len(set(result)))
+                self.assertEqual(set(result), brute_force_loose(t, root2matches, g))
+
+        # Nested loose sub-patterns on caterpillars try a quadratic number of
+        # combinations (cubic without pruning)
+        n_leaves = 400
+        t = caterpillar_tree(n_leaves)
+        pattern = TreePattern(""" (('@.name.endswith("1")', '@.name.endswith("3")')^, '@.name.endswith("7")')^ ;""",
+                              quoted_node_names=True)
+        stats = SearchStats()
+        matches = list(pattern.find_match(t, stats=stats))
+        self.assertEqual(len(matches), 39)
+        self.assertLess(stats.loose_combinations, n_leaves ** 2 / 10)
+
+
+class Test_lazy_search(unittest.TestCase):
+    def test_first_match(self):
+        class CountingSyntax(PatternSyntax):
+            n_calls = 0
+            def visit(self, node):
+                CountingSyntax.n_calls += 1
+                return True
+
+        tree = Tree()
+        tree.populate(500)
+        pattern = TreePattern(""" 'visit(@)' ;""", quoted_node_names=True,
+                              syntax=CountingSyntax())
+        first_leaf = next(n for n in tree.traverse("preorder") if n.is_leaf())
+        self.assertIs(pattern.first_match(tree), first_leaf)
+        # internal nodes are discarded without evaluating the constraint, and
+        # the search stops at the first leaf
+        self.assertEqual(CountingSyntax.n_calls, 1)
+        self.assertTrue(pattern.exists(tree))
+        self.assertEqual(len(list(pattern.find_match(tree))), 500)
+
+        pattern = TreePattern(" (x, y) ;")
+        self.assertIsNone(pattern.first_match(tree))
+        self.assertFalse(pattern.exists(tree))
+
+    def test_lazy_matrix(self):
+        tree = Tree("((a, b)x, (c, (a, d)y)z);", format=1)
+        pattern = TreePattern(""" ('a', '@.name in "bd"')'@' ;""", quoted_node_names=True)
+        plan = pattern.get_plan()
+        c2nodes = compute_match_matrix(pattern, tree)
+        matrix = MatchMatrix(pattern, tree)
+        for pnode in pattern.traverse():
+            self.assertEqual(set(matrix.iter_matches(pnode)), c2nodes[pnode.constraint])
+            for n in tree.traverse():
+                self.assertEqual(matrix.is_match(pnode, n), n in c2nodes[pnode.constraint])
+
+
+class Test_pattern_set(unittest.TestCase):
+    def test_same_results(self):
+        tree = PhyloTree("((Hsa_1, Ptr_1)x, ((Hsa_2, Mmu_1)y, (Hsa_3, (Ptr_2, Mmu_2))w)z);", format=1)
+        patterns = [""" (Hsa_1, Ptr_1)x ;""",
+                    """ ('@.species == "Hsa"', '@')'@' ;""",
+                    """ ('@.species == "Hsa"', '@')'@+' ;""",
+                    """ ('@.species == "Ptr"', '@.species == "Mmu"')'^' ;""",
+                    """ ('contains_species(@, ["Hsa", "Mmu"])', '@')'n_leaves(@) > 3' ;""",
+                    """ (a, b) ;"""]
+        pattern_set = PatternSet(patterns)
+        self.assertEqual(len(pattern_set), len(patterns))
+
+        expected = [list(TreePattern(p).find_match(tree)) for p in patterns]
+        results = pattern_set.find_matches(tree)
+        self.assertEqual([set(r) for r in results], [set(r) for r in expected])
+        self.assertEqual([len(r) for r in results], [len(r) for r in expected])
+        self.assertEqual(pattern_set.find_matches(tree, first_match=True),
+                         [r[:1] for r in results])
+
+    def test_shared_constraints(self):
+        class CountingSyntax(PatternSyntax):
+            n_calls = 0
+            def visit(self, node):
+                CountingSyntax.n_calls += 1
+                return True
+
+        tree = Tree()
+        tree.populate(50)
+        syntax = CountingSyntax()
+        patterns = [TreePattern(""" ('visit(@)', 'visit(@)')'@' ;""", syntax=syntax),
+                    TreePattern(""" ('visit(@)', '@')'@' ;""", syntax=syntax)]
+        patterns += [""" 'visit(@)' ;"""] * 3
+        pattern_set = PatternSet(patterns, syntax=syntax)
+        results = pattern_set.find_matches(tree)
+        self.assertEqual([len(r) for r in results], [len(results[0]), len(results[0]), 50, 50, 50])
+        # every leaf is evaluated only once
+        self.assertEqual(CountingSyntax.n_calls, 50)
+
+
+class Test_search_stats(unittest.TestCase):
+    def setUp(self):
+        self.tree = PhyloTree("((Hsa_1, Ptr_1)x, ((Hsa_2, Mmu_1)y, (Hsa_3, (Ptr_2, Mmu_2))w)z);",
+                              format=1)
+
+    def test_counters(self):
+        pattern = TreePattern(""" ('@.species == "Hsa"', '@')'n_leaves(@) == 2' ;""",
+                              quoted_node_names=True)
+        stats = SearchStats()
+        self.assertEqual(list(pattern.find_match(self.tree, stats=stats)),
+                         list(pattern.find_match(self.tree)))
+        self.assertEqual(stats.searches, 1)
+        # all nodes are tested as root (leaves are discarded before evaluating
+        # the constraint), and children constraints in the children of roots
+        self.assertEqual(stats.evaluations["n_leaves(@) == 2"], 13)
+        self.assertEqual(stats.evaluations['@.species == "Hsa"'], 6)
+        self.assertEqual(stats.evaluations['@'], 4)
+        # 3 roots and 6 children, and the children of one root don't match
+        self.assertEqual(stats.children_match_calls, 9)
+        self.assertEqual(stats.children_match_subproblems, 3)
+        self.assertEqual(stats.assignments, 2)
+        self.assertEqual(stats.augmenting_paths, 4)
+        self.assertEqual(stats.loose_candidates, 0)
+        self.assertEqual(set(stats.times), set(["cache", "constraints", "search"]))
+
+    def test_loose_and_pattern_set(self):
+        patterns = PatternSet([""" ('@.species == "Ptr"', '@.species == "Mmu"')'^' ;""",
+                               """ ('@.species == "Hsa"', '@')'@' ;"""])
+        stats = SearchStats()
+        self.assertEqual(patterns.find_matches(self.tree, stats=stats),
+                         patterns.find_matches(self.tree))
+        self.assertEqual(stats.searches, 2)
+        self.assertEqual(stats.loose_candidates, 4)
+        self.assertGreater(stats.loose_combinations, stats.loose_rejected)
+        self.assertIn("combine_loose", stats.times)
+
+        # stats can be sent between processes and merged
+        total = pickle.loads(pickle.dumps(stats))
+        total.merge(stats)
+        self.assertEqual(total.searches, 4)
+        self.assertEqual(total.evaluations, {k: 2 * v for k, v in stats.evaluations.items()})
+        self.assertAlmostEqual(total.times["search"], 2 * stats.times["search"])
+        self.assertIn("Loose ancestors tested: 8", str(total))
+
+
+class Test_search_budget(unittest.TestCase):
+    def setUp(self):
+        random.seed(3)
+        self.tree = Tree()
+        self.tree.populate(200, random_branches=True)
+        self.pattern = TreePattern(""" ('@.dist > 0.2', '@*')'@' ;""", quoted_node_names=True)
+        self.expected = list(self.pattern.find_match(self.tree))
+
+    def test_limits(self):
+        for budget, limit in [(SearchBudget(max_combinations=20), 'combinations'),
+                              (SearchBudget(max_evaluations=50), 'evaluations'),
+                              (SearchBudget(max_time=0), 'time')]:
+            found = []
+            with self.assertRaises(SearchBudgetExceeded) as cm:
+                for match in self.pattern.find_match(self.tree, budget=budget):
+                    found.append(match)
+            self.assertEqual(cm.exception.limit, limit)
+            # matches found before stopping are returned
+            self.assertEqual(cm.exception.matches, found)
+            self.assertEqual(found, self.expected[:len(found)])
+
+        # the budget is reset by every search
+        budget = SearchBudget(max_combinations=10**6, max_evaluations=10**6, max_time=60)
+        for _ in range(3):
+            self.assertEqual(list(self.pattern.find_match(self.tree, budget=budget)),
+                             self.expected)
+        self.assertRaises(SearchBudgetExceeded, self.pattern.exists, self.tree,
+                          budget=SearchBudget(max_evaluations=1))
+
+    def test_pattern_set(self):
+        patterns = PatternSet([self.pattern, """ ('@.dist > 0.2', '@*')x ;"""])
+        budget = SearchBudget(max_combinations=30)
+        results = patterns.find_matches(self.tree, budget=budget)
+        self.assertIsInstance(results[0], IncompleteMatches)
+        self.assertEqual(results[0].limit, 'combinations')
+        self.assertTrue(results[0] and set(results[0]) < set(self.expected))
+        # the second pattern gets its own budget
+        self.assertNotIsInstance(results[1], IncompleteMatches)
+        self.assertEqual(results[1], [])
+
+
+class Test_incremental_matcher(unittest.TestCase):
+    patterns = [""" ('@.species == "Hsa"', '@.species == "Ptr"') ;""",
+                """ ('@.species == "Hsa"+', '@*')'@.dist > 0.3' ;""",
+                """ ('@.species == "Hsa"', '@.species == "Mmu"')^ ;""",
+                """ (('@', '@')'@', '@')'contains_species(@, ["Hsa", "Mmu"])' ;""",
+                """ ('@', '@')'depth(@) > 2' ;"""]
+
+    def setUp(self):
+        random.seed(4)
+        self.tree = PhyloTree()
+        self.tree.populate(100, names_library=["%s_%d" %(random.choice(["Hsa", "Ptr", "Mmu"]), i)
+                                               for i in range(100)],
+                           random_branches=True)
+        self.tree.set_species_naming_function(lambda name: name.split("_")[0])
+
+    def edit(self, tree):
+        # Applies a random edit to tree, returning the edited nodes
+        nodes = list(tree.traverse())[1:]
+        node = random.choice(nodes)
+        edit = random.choice(["detach", "collapse", "move", "dist"])
+        if edit == "detach" or (edit == "collapse" and node.is_leaf()):
+            parent = node.up
+            node.detach()
+            return [parent]
+        elif edit == "collapse":
+            parent = node.up
+            node.delete(prevent_nondicotomic=False)
+            return [parent]
+        elif edit == "move":
+            descendants = set(node.traverse())
+            target = random.choice([n for n in nodes if n not in descendants])
+            parent = node.up
+            target.add_child(node.detach())
+            return [parent, target]
+        node.dist = random.random()
+        return [node]
+
+    def test_same_results(self):
+        for pattern in self.patterns:
+            pattern = TreePattern(pattern, quoted_node_names=True)
+            tree = deepcopy(self.tree)
+            matcher = IncrementalMatcher(pattern, tree)
+            self.assertEqual(matcher.matches, set(pattern.find_match(tree)))
+            for _ in range(30):
+                old_matches = set(matcher.matches)
+                new, lost = matcher.update(*self.edit(tree))
+                expected = set(pattern.find_match(tree))
+                self.assertEqual(matcher.matches, expected)
+                self.assertEqual(new, expected - old_matches)
+                self.assertEqual(lost, old_matches - expected)
+
+    def test_find_changes(self):
+        pattern = TreePattern(self.patterns[1], quoted_node_names=True)
+        matcher = IncrementalMatcher(pattern, self.tree)
+        # without nodes, changed children are found traversing the tree
+        for leaf in random.sample(self.tree.get_leaves(), 5):
+            self.tree.set_outgroup(leaf)
+            leaf.up.children[0].detach()
+            matcher.update()
+            self.assertEqual(matcher.matches, set(pattern.find_match(self.tree)))
+
+    def test_evaluated_nodes(self):
+        pattern = TreePattern(self.patterns[0], quoted_node_names=True)
+        stats = SearchStats()
+        matcher = IncrementalMatcher(pattern, self.tree, stats=stats)
+        root_constraint = pattern.name
+        evaluations = len(list(self.tree.traverse()))
+        self.assertEqual(stats.evaluations[root_constraint], evaluations)
+
+        # only the parent of the removed leaf and its ancestors are evaluated
+        leaf = self.tree.get_leaves()[0]
+        parent = leaf.up
+        leaf.detach()
+        matcher.update(parent)
+        self.assertEqual(stats.evaluations[root_constraint] - evaluations,
+                         len(parent.get_ancestors()) + 1)
+
+
+@unittest.skipIf(numpy is None, "numpy is not available")
+class Test_vector_constraints(unittest.TestCase):
+    def test_vectorizable(self):
+        for constraint in ['__target_node.support > 0.9 and __target_node.dist < 0.5',
+                           '(True) and not __target_node.children',
+                           '0.1 < __target_node.dist <= 0.5 or __target_node.name != "a"',
+                           'len(__target_node.children) == 2 and not __target_node.is_leaf()']:
+            self.assertIsNotNone(get_vector_constraint(constraint), constraint)
+        for constraint in ['n_leaves(__target_node) > 2',
+                           '__target_node.name.startswith("a")',
+                           '__target_node.up.name == "a"',
+                           '__target_node.name in ["a", "b"]',
+                           '__target_node.dist + 1 > 2']:
+            self.assertIsNone(get_vector_constraint(constraint), constraint)
+
+    def test_same_results(self):
+        random.seed(0)
+        tree = PhyloTree()
+        tree.populate(200, random_branches=True)
+        for n in tree.traverse():
+            n.support = random.choice([0.5, 0.95, 1])
+            if not n.children:
+                n.add_feature("score", random.randint(0, 5))
+
+        patterns = [""" ('@.support > 0.9 and @.dist < 0.5', '@'); """,
+                    """ ('0.1 < @.dist <= 0.5 or @.name == "aaaaaaaaaa"', '@.support >= 1')'@.support != 0.5'; """,
+                    """ ('len(@.children) == 2 and @.dist > 0.2', '@.is_leaf()'); """,
+                    """ ('@.is_leaf() and @.score > 2', '@.is_leaf() and @.score < 2')'@'; """,
+                    """ '@.support < 0.9 and n_leaves(@) > 10'; """]
+        for p in patterns:
+            pattern = TreePattern(p)
+            c2nodes = compute_match_matrix(pattern, tree)
+            for cn in pattern.get_plan().constraint_nodes:
+                expected = set(n for n in tree.traverse() if cn.is_local_match(n, None))
+                self.assertEqual(c2nodes[cn.constraint], expected, cn.constraint)
+
+            expected = set(pattern.find_match(tree))
+            self.assertEqual(set(pattern.find_match(tree, index=TreeAttributeIndex(tree))),
+                             expected)
+
+    def test_fallback(self):
+        tree = Tree()
+        tree.populate(100)
+        for leaf in tree.iter_leaves():
+            leaf.add_feature("score", 3)
+        index = TreeAttributeIndex(tree)
+        # score is missing in internal nodes, so it can't be vectorized but
+        # evaluated node by node
+        vector_constraint = get_vector_constraint('__target_node.score > 2')
+        self.assertIsNone(vector_constraint(index))
+        pattern = TreePattern(""" '@.score > 2' ;""")
+        self.assertEqual(len(list(pattern.find_match(tree, index=index))), 100)
+
+
 if __name__ == '__main__':
     unittest.main()
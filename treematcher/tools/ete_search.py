@@ -1,12 +1,25 @@
 #!/usr/bin/env python
+from __future__ import print_function
 
 import sys
 import logging
 import os.path
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from copy import copy
+
+import six
 from argparse import ArgumentParser
 from ete3.tools.common import src_tree_iterator
 from ete3.phylo import PhyloTree
-from treematcher.treematcher import TreePattern
+from treematcher.treematcher import (TreePattern, PatternSet, SearchStats, SearchBudget,
+                                     IncompleteMatches)
+from treematcher.tools.tree_reader import iter_trees
+from treematcher.tools.tree_store import TreeStore
+from treematcher.tools.result_cache import (ResultCache, DEFAULT_MAX_ENTRIES,
+                                            get_pattern_digest, get_tree_digest)
 
 class match_stats(object):
     def __init__(self, name=""):
@@ -17,6 +30,9 @@ class match_stats(object):
         self.matched = 0
         self.not_matched = 0
         self.errors = 0
+        self.budget_exceeded = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def __str__(self):
         printable = "{}\n".format(self.name)
@@ -29,8 +45,16 @@ class match_stats(object):
             printable += "Number of trees: {}\n".format(self.num_of_trees)
 
         printable +="Errors: {}\n".format(self.errors)
+        if self.budget_exceeded > 0:
+            printable += "Searches exceeding their budget: {}\n".format(self.budget_exceeded)
+        if self.cache_hits > 0 or self.cache_misses > 0:
+            printable += "Result cache hits: {}\n".format(self.cache_hits)
+            printable += "Result cache misses: {}\n".format(self.cache_misses)
         return printable
 
+# Number of trees sent at once to each worker process
+TREE_CHUNK_SIZE = 20
+
 DESC='Search for strict or relax described (using regexp logic) patterns in newick trees.\n'
 
 #ete3 treematcher --pattern "(hello, kk);" --pattern-format 8 --tree-format 8 --trees "(hello,(1,2,3)kk);" --quoted-node-names
@@ -59,13 +83,25 @@ def populate_args(treematcher_args_p):
     treematcher_args.add_argument("--target_tree_list", dest="src_tree_list",
                               type=str,
                               help=("path to a file containing many pattern trees, one per line"))
+    treematcher_args.add_argument("--target_tree_file", dest="src_tree_file",
+                              type=str,
+                              help=("path to a file containing many target trees, read as a stream.\
+                              Files can be compressed (gzip or bzip2), contain trees spanning\
+                              multiple lines, or rows with a tree ID and a newick separated by a\
+                              tab. Results are prefixed by the tree ID or number. Use - for stdin."))
+    treematcher_args.add_argument("--tree_store", dest="tree_store",
+                              type=str,
+                              help=("path to a tree store created with\
+                              treematcher.tools.tree_store, searched without parsing\
+                              newick. Results are prefixed by the tree ID."))
     treematcher_args.add_argument("-p", dest='pattern_trees',
                               type=str, nargs="*",
                               help=("a list of trees in newick format (filenames or"
                               "quoted strings) to be used as pattern tree(s)"))
     treematcher_args.add_argument("--pattern_tree_list", dest="pattern_tree_list",
                               type=str,
-                              help=("path to a file containing many pattern trees, one per line"))
+                              help=("path to a file containing many pattern trees, one per line.\
+                              Use - for stdin."))
     treematcher_args.add_argument("-o", "--output", dest="output", type=str,
                                 help=("specify an output file"))
     treematcher_args.add_argument("--render", dest="render",
@@ -74,37 +110,79 @@ def populate_args(treematcher_args_p):
     treematcher_args.add_argument("-r", "--root", dest="whole_tree", action="store_true",
                                     help=("Returns the tree from root if match found. Is used as\
                                     flag to indicate match presence rather than match it self."))
+    treematcher_args.add_argument("--first", dest="first_match", action="store_true",
+                                    help=("Stop searching each tree at the first match of\
+                                    each pattern. Useful to filter trees containing a pattern."))
+    treematcher_args.add_argument("--max_combinations", dest="max_combinations", type=int,
+                                    help=("Stop the search of a pattern in a tree after exploring\
+                                    this number of combinations of target nodes."))
+    treematcher_args.add_argument("--max_time", dest="max_time", type=float,
+                                    help=("Stop the search of a pattern in a tree after this\
+                                    number of seconds."))
+    treematcher_args.add_argument("--max_evaluations", dest="max_evaluations", type=int,
+                                    help=("Stop the search of a pattern in a tree after evaluating\
+                                    this number of target nodes. Matches found before\
+                                    reaching any limit are reported, and the search is\
+                                    counted as exceeding its budget."))
+    treematcher_args.add_argument("--result_cache", dest="result_cache", type=str,
+                                    help=("path to a result cache (created if needed) keeping\
+                                    the matches of every pattern in every tree. Pairs of\
+                                    pattern and tree found in the cache are not searched\
+                                    again, and trees without cached matches are not\
+                                    parsed. Searches exceeding their budget are not cached."))
+    treematcher_args.add_argument("--cache_max_entries", dest="cache_max_entries", type=int,
+                                    default=DEFAULT_MAX_ENTRIES,
+                                    help=("Maximum number of results kept in the result\
+                                    cache. The least recently used ones are evicted."))
+    treematcher_args.add_argument("--cache_max_size", dest="cache_max_size", type=float,
+                                    help=("Maximum size in MB of the results kept in the\
+                                    result cache. The least recently used ones are evicted."))
+    treematcher_args.add_argument("--cpu", dest="cpu", type=int, default=1,
+                                    help=("Number of processes used to search trees in parallel."))
+    treematcher_args.add_argument("--unordered", dest="unordered", action="store_true",
+                                    help=("With --cpu, write the results of each tree as soon\
+                                    as it is searched instead of following the input order."))
     treematcher_args.add_argument("-v", "--verbosity", dest="verbosity",
                                     type=int, nargs=1,
-                                    help=("A number between 1-4. The verbosity level.\
+                                    help=("A number between 1-5. The verbosity level.\
                                     1: print matches (default), 2: print statistsics, \
                                     3: print the pattern, 4: print statistsics for \
-                                    each pattern."))
+                                    each pattern, 5: print search counters and \
+                                    time per phase."))
 
 def run(args):
-    # a list of stats objects. one for every pattern
-    all_stats = []
-
-    if vars(args)["src_trees"] is None and vars(args)["src_tree_list"] is None:
+    if (vars(args)["src_trees"] is None and vars(args)["src_tree_list"] is None and
+        not vars(args).get("src_tree_file") and not vars(args).get("tree_store")):
         logging.error('Please specify a tree to search (i.e. -t) ')
         sys.exit(-1)
     if not vars(args)["pattern_trees"] and not vars(args)["pattern_tree_list"]:
         logging.error('Please specify a pattern to search for. (i.e. -p)')
         sys.exit(-1)
+    if vars(args).get("src_tree_file") == '-' and vars(args)["pattern_tree_list"] == '-':
+        logging.error('Only one of --target_tree_file and --pattern_tree_list can '
+                      'read from the standard input (-)')
+        sys.exit(-1)
 
+    pattern_trees = list(pattern_tree_iterator(args))
+    pattern_length = len(pattern_trees)
+    verbosity = vars(args)["verbosity"][0] if vars(args)["verbosity"] else 0
 
-    pattern_length = len(list(pattern_tree_iterator(args)))
-
-    for pattern_num, p in enumerate(pattern_tree_iterator(args)):
+    # Patterns are compiled once and all of them searched in every tree, so
+    # target trees are read and parsed only once
+    pattern_nums, patterns, all_stats, outputfiles, streams = [], [], [], [], []
+    for pattern_num, p in enumerate(pattern_trees):
         try :
             pattern = TreePattern(p, quoted_node_names=vars(args)["quoted_node_names"])
         except:
             logging.error("Could not create pattern from newick.")
             continue
 
-        stats = match_stats("pattern_" + str(pattern_num))
+        pattern_nums.append(pattern_num)
+        patterns.append(pattern)
+        all_stats.append(match_stats("pattern_" + str(pattern_num)))
 
         # handle file creation
+        outputfile = None
         if vars(args)["output"]:
             filename = vars(args)["output"]
             if pattern_length > 1:
@@ -114,98 +192,90 @@ def run(args):
                     filename += str(pattern_num)
 
             outputfile = open(filename, 'w')
-
-        if vars(args)["verbosity"] and int(vars(args)["verbosity"][0]) > 2:
-            print("pattern_{} is: ".format(pattern_num))
-            print(pattern)
-
-        # for every tree
-        if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 2 and not vars(args)["output"]:
-            print("match(es) for pattern_{}:".format(pattern_num))
-
-        for n, nw in enumerate(src_tree_iterator(args)):
-            stats.total += 1
-            try:
-                t = PhyloTree(nw, format=args.tree_format)
-            except:
-                logging.error("Could not creat tree from newick format.")
-                stats.errors += 1
+        outputfiles.append(outputfile)
+
+        # The printed results of each pattern are kept apart until all trees
+        # are processed, so they are shown one pattern after the other
+        stream = sys.stdout if pattern_length == 1 else tempfile.TemporaryFile(mode='w+')
+        streams.append(stream)
+
+        if verbosity > 2:
+            print("pattern_{} is: ".format(pattern_num), file=stream)
+            print(pattern, file=stream)
+
+        if verbosity > 2 and not vars(args)["output"]:
+            print("match(es) for pattern_{}:".format(pattern_num), file=stream)
+
+    # for every tree
+    trees = target_tree_iterator(args)
+    result_cache = open_result_cache(args)
+    if result_cache is not None:
+        pattern_digests = [get_pattern_digest(pattern, vars(args)["first_match"])
+                           for pattern in patterns]
+        trees = iter_cached_results(args, result_cache, pattern_digests, all_stats, trees)
+    cpu = vars(args).get("cpu") or 1
+    pool = None
+    if cpu > 1:
+        # Trees are sent to the workers in chunks, and each worker compiles
+        # the patterns only once
+        worker_args = copy(args)
+        worker_args.src_trees = worker_args.pattern_trees = None
+        pool = multiprocessing.Pool(cpu, init_worker,
+                                    (worker_args, [pattern_trees[i] for i in pattern_nums],
+                                     pattern_nums, pattern_length))
+        imap = pool.imap_unordered if vars(args).get("unordered") else pool.imap
+        results = imap_bounded(imap, search_tree_worker, trees, TREE_CHUNK_SIZE,
+                               TREE_CHUNK_SIZE * cpu * 4)
+    else:
+        pattern_set = PatternSet(patterns)
+        results = (search_target_tree(args, pattern_set, pattern_nums, pattern_length, tree)
+                   for tree in trees)
+
+    search_stats = SearchStats()
+    try:
+        for result in results:
+            for stats in all_stats:
+                stats.total += 1
+            if result is None:
+                for stats in all_stats:
+                    stats.errors += 1
                 continue
 
-            matches = list(pattern.find_match(t))
-            match_length=len(matches)
-            if match_length > 0:
-                stats.matched += 1
-            else:
-                stats.not_matched += 1
-
-            if args.render:
-                image = args.render
-                if pattern_length > 1:  # multiple patterns
-                    if match_length > 1:  # one file per match on each pattern
-                        for m, match in enumerate(matches):
-                            if '.' in image:
-                                image = image.replace('.', str(pattern_num) + '_' + str(m) + '.')
-                            else:
-                                image += str(pattern_num) + str(m)
-                            match.render(image)
-                    elif match_length == 1:  # One match on multiple patterns
-                        if '.' in image:
-                            image = image.replace('.', str(pattern_num) + '.')
-                        else:
-                            image += str(pattern_num)
-                        matches[0].render(image)
-                    else:
-                        if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
-                            print("No matches for pattern {} tree {}".format(pattern_num, n))
-                else:  # one pattern
-                    if match_length > 1:  # one file per match on one pattern
-                        for m, match in enumerate(matches):
-                            if '.' in image:
-                                image = image.replace('.', '_' + str(m) + '.')
-                            else:
-                                image += str(m)
-                            match.render(image)
-                    elif match_length == 1:  # one file for one match
-                        matches[0].render(image)
-                    else:
-                        if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
-                            print("No matches for tree {}".format(n))
-
-            if vars(args)["output"]:
-                if vars(args)["asciioutput"]:
-                    if vars(args)["whole_tree"] and match_length > 0:
-                        outputfile.write(str(t))
-                    else:
-                        for match in matches:
-                            outputfile.write(str(match) + '\n')
-                else:  #args.taboutput
-                    if vars(args)["whole_tree"]:
-                        outputfile.whrite(t.write(features=[]))
-                    else:
-                        outputfile.write('\t'.join([match.write(features=[]) for match in matches]))
-
-            if not vars(args)["output"] and not args.render:
-                if vars(args)["asciioutput"]:
-                    if vars(args)["whole_tree"] and match_length > 0:
-                        print(t)
-                    else:
-                        for match in matches:
-                            print(match)
+            tree_results, tree_search_stats, tree_digest = result
+            if tree_search_stats is not None:
+                search_stats.merge(tree_search_stats)
+            for i, (matched, printed, written, budget_exceeded,
+                    positions) in enumerate(tree_results):
+                if positions is not None:
+                    result_cache.put(tree_digest, pattern_digests[i], positions)
+                if matched:
+                    all_stats[i].matched += 1
                 else:
-                    if vars(args)["whole_tree"] and match_length > 0:
-                        print(t.write(features=[]))
-                    else:
-                        for match in matches:
-                            print(match.write(features=[]))
-
-        all_stats += [stats]
-        if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 3:
-            print("{}".format(stats))
-
-        if vars(args)["output"]:
+                    all_stats[i].not_matched += 1
+                if budget_exceeded:
+                    all_stats[i].budget_exceeded += 1
+                streams[i].write(printed)
+                if outputfiles[i]:
+                    outputfiles[i].write(written)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if result_cache is not None:
+            result_cache.close()
+
+    for stats, outputfile, stream in zip(all_stats, outputfiles, streams):
+        if verbosity > 3:
+            print("{}".format(stats), file=stream)
+
+        if outputfile:
             outputfile.close()
 
+        if stream is not sys.stdout:
+            stream.seek(0)
+            shutil.copyfileobj(stream, sys.stdout)
+            stream.close()
+
     concentrated = match_stats("\nSummarize")
     concentrated.total = sum([ stat.total for stat in all_stats])
     concentrated.num_of_patterns = len(all_stats)
@@ -213,18 +283,295 @@ def run(args):
     concentrated.matched = sum([stat.matched for stat in all_stats])
     concentrated.not_matched = sum([stat.not_matched for stat in all_stats])
     concentrated.errors = sum([stat.errors for stat in all_stats])
+    concentrated.budget_exceeded = sum([stat.budget_exceeded for stat in all_stats])
+    concentrated.cache_hits = sum([stat.cache_hits for stat in all_stats])
+    concentrated.cache_misses = sum([stat.cache_misses for stat in all_stats])
 
-    if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
+    if verbosity > 1:
         print("{}".format(concentrated))
 
+    if verbosity > 4:
+        print("Search statistics\n{}".format(search_stats))
+
+def target_tree_iterator(args):
+    """ Iterates over the number, ID (None if not read from a tree file) and
+    newick of the target trees. Trees in a tree store have no newick, and are
+    read by search_tree from the store. """
+    if vars(args).get("tree_store"):
+        store = get_tree_store(vars(args)["tree_store"])
+        for n in range(len(store)):
+            yield n, store.get_tree_id(n), None
+    elif vars(args).get("src_tree_file"):
+        for n, (tree_id, nw) in enumerate(iter_trees(vars(args)["src_tree_file"])):
+            yield n, tree_id, nw
+    elif not vars(args)["src_trees"] and vars(args)["src_tree_list"]:
+        # Read here, as src_tree_iterator prefers the standard input to the
+        # tree list when it is not a terminal
+        n = 0
+        for line in open(vars(args)["src_tree_list"]):
+            line = line.strip()
+            if line:
+                yield n, None, line
+                n += 1
+    else:
+        for n, nw in enumerate(src_tree_iterator(args)):
+            yield n, None, nw
+
+def open_result_cache(args):
+    """ Returns the ResultCache given by the command line, or None """
+    path = vars(args).get("result_cache")
+    if not path:
+        return None
+    max_size = vars(args).get("cache_max_size")
+    try:
+        return ResultCache(path, vars(args).get("cache_max_entries") or DEFAULT_MAX_ENTRIES,
+                           int(max_size * 1e6) if max_size is not None else None)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(-1)
+
+def iter_cached_results(args, result_cache, pattern_digests, all_stats, trees):
+    """ Adds to the number, ID and newick of every target tree its digest and
+    the matches of every pattern found in the result cache (None if missing),
+    counting cache hits and misses per pattern. """
+    for n, tree_id, nw in trees:
+        if nw is None:
+            # Trees in a tree store are identified by the digest of their
+            # content kept in the store, so they are not read
+            store_digest = get_tree_store(vars(args)["tree_store"]).get_tree_digest(n)
+            tree_digest = get_tree_digest(store_digest, "tree_store")
+        else:
+            tree_digest = get_tree_digest(nw, args.tree_format)
+        cached = result_cache.get(tree_digest, pattern_digests)
+        for stats, matches in zip(all_stats, cached):
+            if matches is None:
+                stats.cache_misses += 1
+            else:
+                stats.cache_hits += 1
+        yield n, tree_id, nw, tree_digest, cached
+
+# Tree stores opened by this process, by path
+_tree_stores = {}
+
+def get_tree_store(path):
+    store = _tree_stores.get(path)
+    if store is None:
+        store = _tree_stores[path] = TreeStore(path)
+    return store
+
+def imap_bounded(imap, func, items, chunksize, window):
+    """ Same as imap(func, items, chunksize), but items are consumed in
+    windows, so no more than window items are read ahead from the input. """
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, window))
+        if not batch:
+            break
+        for result in imap(func, batch, chunksize):
+            yield result
+
+def search_tree(args, pattern_set, pattern_nums, pattern_length, n, nw, tree_id=None,
+                tree_digest=None, cached=None):
+    """ Searches all patterns in tree number n, given in newick format (or
+    read from the tree store if nw is None). Returns None if the tree can't be
+    read, otherwise a list with a tuple per pattern (whether it matched, the
+    text to print and to write to its output file, whether its search
+    exceeded the budget, and the preorder positions of its matches to store
+    in the result cache, or None), the SearchStats of the search if verbosity
+    is above 4 (otherwise None), and the digest of the tree.
+
+    :param cached: With a result cache, a list with the cached matches of
+        every pattern (see ResultCache.get). Only patterns without cached
+        matches are searched, and the tree isn't read if no pattern is
+        searched and there are no matches to write.
+    """
+    searched = list(range(len(pattern_nums)))
+    if cached is not None:
+        searched = [i for i, positions in enumerate(cached) if positions is None]
+    if searched or (cached is not None and any(cached)):
+        if nw is None:
+            t = get_tree_store(vars(args)["tree_store"])[n]
+        else:
+            try:
+                t = PhyloTree(nw, format=args.tree_format)
+            except:
+                logging.error("Could not creat tree from newick format.")
+                return None
+    else:
+        t = None
+
+    verbosity = vars(args)["verbosity"][0] if vars(args)["verbosity"] else 0
+    search_stats = SearchStats() if verbosity > 4 else None
+    all_matches = [None] * len(pattern_nums)
+    if searched:
+        if len(searched) < len(pattern_nums):
+            pattern_set = PatternSet([pattern_set.patterns[i] for i in searched])
+        found = pattern_set.find_matches(t, first_match=vars(args)["first_match"],
+                                         stats=search_stats,
+                                         budget=get_search_budget(args))
+        for i, matches in zip(searched, found):
+            all_matches[i] = matches
+
+    nodes, node2position = None, None
+    tree_results = []
+    for i, (pattern_num, matches) in enumerate(zip(pattern_nums, all_matches)):
+        positions = None
+        if matches is None:
+            # Matches read from the result cache
+            if cached[i] and nodes is None:
+                nodes = list(t.traverse("preorder"))
+            matches = [nodes[position] for position in cached[i]]
+        elif cached is not None and not isinstance(matches, IncompleteMatches):
+            if matches and node2position is None:
+                node2position = dict((node, position) for position, node
+                                     in enumerate(t.traverse("preorder")))
+            positions = [node2position[match] for match in matches]
+
+        budget_exceeded = isinstance(matches, IncompleteMatches)
+        if budget_exceeded:
+            logging.warning("Search of pattern_%s in tree %s stopped: %s limit reached, "
+                            "%d match(es) found so far." %(pattern_num,
+                            tree_id if tree_id is not None else n, matches.limit,
+                            len(matches)))
+        stream = six.StringIO()
+        outputfile = six.StringIO() if vars(args)["output"] else None
+        write_matches(args, t, n, matches, pattern_num, pattern_length, outputfile,
+                      stream, tree_id)
+        tree_results.append((len(matches) > 0, stream.getvalue(),
+                             outputfile.getvalue() if outputfile else None,
+                             budget_exceeded, positions))
+    return tree_results, search_stats, tree_digest
+
+def search_target_tree(args, pattern_set, pattern_nums, pattern_length, tree):
+    """ search_tree() of a tree given by target_tree_iterator, followed by its
+    digest and cached matches when a result cache is used. """
+    n, tree_id, nw = tree[:3]
+    return search_tree(args, pattern_set, pattern_nums, pattern_length, n, nw, tree_id,
+                       *tree[3:])
+
+def get_search_budget(args):
+    """ Returns the SearchBudget given by the command line limits, or None """
+    limits = dict((limit, vars(args).get(limit)) for limit in
+                  ("max_combinations", "max_time", "max_evaluations"))
+    if all(value is None for value in limits.values()):
+        return None
+    return SearchBudget(**limits)
+
+# Patterns compiled in each worker process (see init_worker)
+_worker = {}
+
+def init_worker(args, pattern_trees, pattern_nums, pattern_length):
+    _worker["args"] = args
+    _worker["pattern_set"] = PatternSet(pattern_trees,
+                                        quoted_node_names=vars(args)["quoted_node_names"])
+    _worker["pattern_nums"] = pattern_nums
+    _worker["pattern_length"] = pattern_length
+
+def search_tree_worker(tree):
+    return search_target_tree(_worker["args"], _worker["pattern_set"],
+                              _worker["pattern_nums"], _worker["pattern_length"], tree)
+
+def write_matches(args, t, n, matches, pattern_num, pattern_length, outputfile, stream,
+                  tree_id=None):
+    """ Renders, writes or prints the matches of a pattern in tree number n.
+    If the tree ID is given, results are written one per line prefixed by the
+    ID, so they can be joined back to the input trees. """
+    verbosity = vars(args)["verbosity"][0] if vars(args)["verbosity"] else 0
+    match_length = len(matches)
+    if tree_id is not None:
+        n = tree_id
+        write_tree_matches(args, t, tree_id, matches, outputfile, stream)
+
+    if args.render:
+        image = args.render
+        if pattern_length > 1:  # multiple patterns
+            if match_length > 1:  # one file per match on each pattern
+                for m, match in enumerate(matches):
+                    if '.' in image:
+                        image = image.replace('.', str(pattern_num) + '_' + str(m) + '.')
+                    else:
+                        image += str(pattern_num) + str(m)
+                    match.render(image)
+            elif match_length == 1:  # One match on multiple patterns
+                if '.' in image:
+                    image = image.replace('.', str(pattern_num) + '.')
+                else:
+                    image += str(pattern_num)
+                matches[0].render(image)
+            else:
+                if verbosity > 1:
+                    print("No matches for pattern {} tree {}".format(pattern_num, n),
+                          file=stream)
+        else:  # one pattern
+            if match_length > 1:  # one file per match on one pattern
+                for m, match in enumerate(matches):
+                    if '.' in image:
+                        image = image.replace('.', '_' + str(m) + '.')
+                    else:
+                        image += str(m)
+                    match.render(image)
+            elif match_length == 1:  # one file for one match
+                matches[0].render(image)
+            else:
+                if verbosity > 1:
+                    print("No matches for tree {}".format(n), file=stream)
+
+    if tree_id is not None:
+        return
+
+    if outputfile:
+        if vars(args)["asciioutput"]:
+            if vars(args)["whole_tree"] and match_length > 0:
+                outputfile.write(str(t))
+            else:
+                for match in matches:
+                    outputfile.write(str(match) + '\n')
+        else:  #args.taboutput
+            if vars(args)["whole_tree"]:
+                outputfile.write(t.write(features=[]))
+            else:
+                outputfile.write('\t'.join([match.write(features=[]) for match in matches]))
+
+    if not vars(args)["output"] and not args.render:
+        if vars(args)["asciioutput"]:
+            if vars(args)["whole_tree"] and match_length > 0:
+                print(t, file=stream)
+            else:
+                for match in matches:
+                    print(match, file=stream)
+        else:
+            if vars(args)["whole_tree"] and match_length > 0:
+                print(t.write(features=[]), file=stream)
+            else:
+                for match in matches:
+                    print(match.write(features=[]), file=stream)
+
+def write_tree_matches(args, t, tree_id, matches, outputfile, stream):
+    """ Writes the matches of a pattern in a tree read from a tree file, one
+    per line and prefixed by the tree ID. """
+    if not matches:
+        return
+    if vars(args)["whole_tree"]:
+        matches = [t]
+    out = outputfile if vars(args)["output"] else stream
+    if not out or (args.render and not vars(args)["output"]):
+        return
+    for match in matches:
+        if vars(args)["asciioutput"]:
+            out.write("{}\n{}\n".format(tree_id, match))
+        else:
+            out.write("{}\t{}\n".format(tree_id, match.write(features=[])))
+
 def pattern_tree_iterator(args):
-    if not vars(args)["pattern_trees"] and not sys.stdin.isatty():
-        vars(args)["pattern_trees"] = sys.stdin
+    """ Iterates over the patterns given with -p, or read from the pattern
+    list. The standard input is only read with --pattern_tree_list -, as it
+    may contain the target trees. """
     if vars(args)["pattern_trees"]:
         for p_tree in vars(args)["pattern_trees"]:
             yield p_tree.strip()
     elif vars(args)["pattern_tree_list"]:
-        for line in open(vars(args)["pattern_tree_list"]):
+        path = vars(args)["pattern_tree_list"]
+        for line in (sys.stdin if path == '-' else open(path)):
             line = line.strip()
             if line:
                 yield line
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''Persistent cache of search results, kept in a SQLite database.
+
+Searching the same patterns again in mostly unchanged trees (e.g. a pattern
+library run every night over a corpus) can skip the pairs of pattern and
+tree already searched. Results are keyed by a digest of the compiled
+pattern and the search options changing its matches (see
+get_pattern_digest), and a digest of the target tree newick (see
+get_tree_digest). The preorder positions of the matches in the tree are
+stored, so they can be written in any output format.
+
+The cache keeps a maximum number of results, and optionally of bytes of
+stored results. The least recently used results are evicted when the cache
+is closed.
+
+Used by ete_search with --result_cache results.db.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import six
+
+# Version of the stored results. Results of other versions are discarded when
+# the cache is opened.
+CACHE_VERSION = 1
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+# Number of stored results written at once to the database
+COMMIT_INTERVAL = 1000
+
+
+def _digest(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(six.text_type(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get_pattern_digest(pattern, first_match=False):
+    ''' Returns a digest of the compiled constraints and structure of a
+    pattern, and the search options changing its matches. Patterns written
+    differently but compiled to the same constraints (e.g. with different
+    spaces) have the same digest. Changes in the code of custom syntax
+    functions are not detected. '''
+    # Initializes the controllers of all pattern nodes
+    pattern.get_plan()
+    syntax = type(pattern.syntax)
+    parts = ["%s.%s" %(syntax.__module__, syntax.__name__), bool(first_match)]
+    for n in pattern.traverse("preorder"):
+        parts.append((n.constraint, n.min_occur, n.max_occur, n.loose_children,
+                      len(n.children)))
+    return _digest(*parts)
+
+
+def get_tree_digest(newick, tree_format=0):
+    ''' Returns a digest of a target tree given as newick, or as the path of
+    a newick file, read with the given format. '''
+    if os.path.isfile(newick):
+        with open(newick) as handle:
+            newick = handle.read()
+    return _digest(tree_format, newick.strip())
+
+
+class ResultCache(object):
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, max_size=None):
+        """ Opens the result cache at path, creating it if needed.
+
+        :param max_entries: Maximum number of results kept in the cache.
+        :param max_size: Maximum number of bytes of stored results (keys and
+            matches), or None for no limit.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path)
+        try:
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta "
+                             "(key TEXT PRIMARY KEY, value TEXT)")
+            version = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        except sqlite3.DatabaseError:
+            self._db.close()
+            raise ValueError('Not a result cache: %s' % path)
+        if version is None or version[0] != str(CACHE_VERSION):
+            self._db.execute("DROP TABLE IF EXISTS results")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                             (str(CACHE_VERSION),))
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (tree TEXT, pattern TEXT, "
+                         "matches TEXT, size INTEGER, used INTEGER, "
+                         "PRIMARY KEY (tree, pattern))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self._db.commit()
+
+        # Results are ordered by last use with an increasing counter. Uses of
+        # cached results are written with the next commit.
+        self._clock = self._db.execute("SELECT MAX(used) FROM results").fetchone()[0] or 0
+        self._used = {}
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def get(self, tree, patterns):
+        """ Returns a list with the cached matches of every pattern digest in
+        the tree with the given digest: a list of preorder positions of the
+        matches in the tree, or None if the pair is not cached. """
+        rows = dict(self._db.execute("SELECT pattern, matches FROM results WHERE tree = ?",
+                                     (tree,)))
+        results = []
+        for pattern in patterns:
+            matches = rows.get(pattern)
+            if matches is None:
+                self.misses += 1
+                results.append(None)
+            else:
+                self.hits += 1
+                self._clock += 1
+                self._used[(tree, pattern)] = self._clock
+                results.append(json.loads(matches))
+        return results
+
+    def put(self, tree, pattern, matches):
+        """ Stores the preorder positions of the matches of a pattern in a
+        tree, given their digests. """
+        matches = json.dumps(list(matches))
+        self._clock += 1
+        self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                         (tree, pattern, matches, len(tree) + len(pattern) + len(matches),
+                          self._clock))
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self._db.executemany("UPDATE results SET used = ? WHERE tree = ? AND pattern = ?",
+                             [(used,) + key for key, used in six.iteritems(self._used)])
+        self._used = {}
+        self._pending = 0
+        self._db.commit()
+
+    def evict(self):
+        """ Removes the least recently used results until the cache is within
+        its limits. Returns the number of removed results. """
+        self.commit()
+        n_entries, size = self._db.execute("SELECT COUNT(*), TOTAL(size) FROM results").fetchone()
+        excess_entries = n_entries - self.max_entries
+        excess_size = size - self.max_size if self.max_size is not None else 0
+        if excess_entries <= 0 and excess_size <= 0:
+            return 0
+
+        evicted = []
+        rows = self._db.execute("SELECT rowid, size FROM results ORDER BY used")
+        for rowid, row_size in rows:
+            if excess_entries <= 0 and excess_size <= 0:
+                break
+            evicted.append((rowid,))
+            excess_entries -= 1
+            excess_size -= row_size
+        rows.close()
+        self._db.executemany("DELETE FROM results WHERE rowid = ?", evicted)
+        self._db.commit()
+        return len(evicted)
+
+    def close(self):
+        """ Writes pending changes, evicts results over the limits and closes
+        the cache. """
+        if self._db is None:
+            return
+        self.evict()
+        self._db.close()
+        self._db = None
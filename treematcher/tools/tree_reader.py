@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+'''Streaming reader of large files containing many target trees.
+
+Files can be compressed with gzip or bzip2, contain trees spanning multiple
+lines or several trees per line, and rows with a tree ID and a newick
+separated by a tab. Files are read in blocks of a fixed size and only the
+tree being read is kept in memory.
+'''
+
+import bz2
+import codecs
+import gzip
+import io
+import re
+import sys
+
+import six
+
+# Number of characters read at once from tree files
+READ_SIZE = 1 << 16
+
+# Maximum number of characters of a tree
+MAX_TREE_SIZE = 1 << 28
+
+# Characters changing the state of the reader. Any other character is part of
+# the current newick
+_SPECIAL_CHARS = re.compile(r"[\t\r\n;'\[\]()]")
+
+
+def open_tree_file(path):
+    '''Opens a tree file for reading text. Files compressed with gzip or
+    bzip2 are detected by their first bytes and decompressed on the fly. Use
+    "-" to read from the standard input.'''
+    if path == '-':
+        return sys.stdin
+    with open(path, 'rb') as handle:
+        magic = handle.read(3)
+    if magic[:2] == b'\x1f\x8b':
+        return io.TextIOWrapper(gzip.GzipFile(path, 'rb'))
+    if magic == b'BZh':
+        if six.PY2:
+            # BZ2File is not an io stream on python 2
+            return codecs.getreader('utf-8')(bz2.BZ2File(path, 'rb'))
+        return io.TextIOWrapper(bz2.BZ2File(path, 'rb'))
+    return io.open(path, 'r')
+
+
+def iter_trees(source, read_size=READ_SIZE, max_tree_size=MAX_TREE_SIZE):
+    '''Iterates over the (tree_id, newick) pairs in a tree file.
+
+    A tree ends at a semicolon, or at the end of a line when all its
+    parentheses are closed, so rows without a final semicolon are also
+    accepted. Quoted names and comments (e.g. NHX tags) may contain any
+    character. If the text before a tab at the beginning of a tree contains
+    no parentheses, it is used as the tree ID. Otherwise, the ID is the
+    position of the tree in the file, starting at 0.
+
+    In files with tree IDs, a line starting with an ID and a tab always
+    starts a new tree, so a row with unbalanced parentheses is returned alone
+    (and fails to be parsed) instead of being joined with the next rows.
+
+    :param source: path to the tree file (see open_tree_file), or a file
+        object opened for reading text.
+    :param read_size: number of characters read at once.
+    :param max_tree_size: maximum number of characters of a tree. A
+        ValueError is raised when a tree is longer (e.g. because its
+        parentheses are not balanced), so the file is not read entirely
+        into memory.
+    '''
+    if isinstance(source, six.string_types):
+        handle = open_tree_file(source)
+    else:
+        handle = source
+
+    n_trees, n_lines = 0, 1
+    parts, size, tree_id = [], 0, None
+    has_content, quoted, comment_depth, parens = False, False, 0, 0
+    # Position in parts of the current line, while the text of the line may
+    # still be the ID of a new tree
+    line_start = None
+    try:
+        while True:
+            chunk = handle.read(read_size)
+            if not chunk:
+                break
+
+            pos = 0
+            for match in _SPECIAL_CHARS.finditer(chunk):
+                text = chunk[pos:match.start()]
+                pos = match.end()
+                if text:
+                    parts.append(text)
+                    size += len(text)
+                    has_content = has_content or bool(text.strip())
+
+                char = match.group()
+                if char == '\n':
+                    n_lines += 1
+                if quoted or comment_depth:
+                    parts.append(char)
+                    size += 1
+                    if quoted and char == "'":
+                        quoted = False
+                    elif not quoted and char == '[':
+                        comment_depth += 1
+                    elif not quoted and char == ']':
+                        comment_depth -= 1
+                    continue
+
+                if char in '\r\n':
+                    # Trees spanning lines are joined, and rows without
+                    # semicolon finish with the line
+                    if char == '\n' and parens and tree_id is not None:
+                        line_start = len(parts)
+                    if char == '\r' or parens or not has_content:
+                        continue
+                elif char == '\t':
+                    if tree_id is None and not parens and has_content:
+                        tree_id = ''.join(parts).strip()
+                        parts, size, has_content = [], 0, False
+                    elif line_start is not None and ''.join(parts[line_start:]).strip():
+                        # Row with ID following a tree with unbalanced
+                        # parentheses
+                        new_id = ''.join(parts[line_start:]).strip()
+                        yield _get_tree(parts[:line_start], tree_id, n_trees)
+                        n_trees += 1
+                        parts, size, tree_id = [], 0, new_id
+                        has_content, parens = False, 0
+                    line_start = None
+                    continue
+                else:
+                    parts.append(char)
+                    size += 1
+                    has_content = True
+                    line_start = None
+                    if char == "'":
+                        quoted = True
+                    elif char == '[':
+                        comment_depth = 1
+                    elif char == '(':
+                        parens += 1
+                    elif char == ')':
+                        parens -= 1
+                    if char != ';':
+                        continue
+
+                yield _get_tree(parts, tree_id, n_trees)
+                n_trees += 1
+                parts, size, tree_id = [], 0, None
+                has_content, parens, line_start = False, 0, None
+
+            text = chunk[pos:]
+            if text:
+                parts.append(text)
+                size += len(text)
+                has_content = has_content or bool(text.strip())
+            if size > max_tree_size:
+                raise ValueError("Tree %s is longer than %d characters at line %d. "
+                                 "Check that its parentheses are balanced." %(
+                                 tree_id if tree_id is not None else n_trees,
+                                 max_tree_size, n_lines))
+
+        if has_content:
+            yield _get_tree(parts, tree_id, n_trees)
+    finally:
+        # The standard input is never closed
+        if handle is not source and handle is not sys.stdin:
+            handle.close()
+
+
+def _get_tree(parts, tree_id, n_trees):
+    newick = ''.join(parts).strip()
+    if not newick.endswith(';'):
+        newick += ';'
+    if tree_id is None:
+        tree_id = str(n_trees)
+    return tree_id, newick
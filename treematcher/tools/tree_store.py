@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+'''Binary store of target trees, searched without parsing newick.
+
+A tree store keeps a corpus of trees in a single file of flat columns, which
+is opened with mmap, so a corpus converted once can be searched again with
+new patterns skipping newick parsing completely. Trees are stored in
+preorder, and each node has the size of its subtree (its children and
+descendants are found from it), the position of its parent, its distance,
+support and name, and a column per stored feature (by default, species and
+evoltype), with a bit mask of the features listed by the node. Strings are
+kept in a string table shared by all columns. A digest of the content of
+every tree is also stored, so trees can be identified (e.g. in a result
+cache) without reading them.
+
+Trees in the store are read as StoredNode instances, a lightweight view of a
+node with the attributes and methods used by the matcher (name, dist,
+support, features, children, up, traverse(), get_leaves(), etc.)
+
+Convert a tree file (see tree_reader) with:
+
+    python -m treematcher.tools.tree_store trees.nw.gz trees.tms
+
+and search it with ete_search --tree_store trees.tms.
+'''
+
+from __future__ import print_function
+
+import array
+import binascii
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import six
+from ete3.phylo import PhyloTree
+from treematcher.compact_tree import NodeView, BASE_FEATURES
+from treematcher.treematcher import numpy, get_value_column
+from treematcher.tools.tree_reader import iter_trees
+
+MAGIC = b'TMSTORE1'
+VERSION = 1
+
+# String features stored by default, besides node names
+DEFAULT_FEATURES = ('species', 'evoltype')
+
+# Index of missing values in the string columns
+MISSING = -1
+
+# Maximum number of distinct strings kept in memory to be written only once
+# to the string table, or decoded only once when reading it
+STRING_CACHE_SIZE = 1 << 16
+
+# Columns with one value per tree and per node, and their array typecodes
+TREE_COLUMNS = (('tree_start', 'q'), ('tree_id', 'q'))
+NODE_COLUMNS = (('size', 'i'), ('parent', 'i'), ('dist', 'd'), ('support', 'd'),
+                ('name', 'q'), ('feature_mask', 'q'))
+
+# Maximum number of stored features (one bit per feature in feature_mask)
+MAX_FEATURES = 63
+
+# Number of bytes per tree in the tree_digest column
+DIGEST_SIZE = hashlib.sha1().digest_size
+
+
+def _feature_column(feature):
+    return 'feature:' + feature
+
+
+def _get_tree_digest(columns, strings):
+    ''' Returns the sha1 digest of the content of a tree, given the values of
+    its numeric node columns, as (typecode, values) pairs, and of its string
+    columns (None if missing). '''
+    digest = hashlib.sha1()
+    for typecode, values in columns:
+        digest.update(_to_bytes(array.array(typecode, values)))
+    for values in strings:
+        for value in values:
+            if value is None:
+                digest.update(struct.pack('<q', MISSING))
+            else:
+                data = six.text_type(value).encode('utf-8')
+                digest.update(struct.pack('<q', len(data)))
+                digest.update(data)
+    return digest.digest()
+
+
+class TreeStoreWriter(object):
+    def __init__(self, path, features=DEFAULT_FEATURES):
+        """ Writes trees to a new tree store file. Columns are written to
+        temporary files as trees are added, so the memory used doesn't grow
+        with the number of trees, and joined in the store when it is closed.
+
+        :param path: path of the tree store file.
+        :param features: string features stored for every node, if present.
+        """
+        if len(features) > MAX_FEATURES:
+            raise ValueError('At most %d features can be stored' % MAX_FEATURES)
+        self.path = path
+        self.features = list(features)
+        self.n_trees = 0
+        self.n_nodes = 0
+
+        self._tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        self._columns = OrderedDict()
+        columns = list(TREE_COLUMNS) + list(NODE_COLUMNS)
+        columns += [(_feature_column(f), 'q') for f in self.features]
+        columns += [('tree_digest', 'B'), ('string_offsets', 'q'), ('string_data', 'B')]
+        for name, typecode in columns:
+            handle = open(os.path.join(self._tmpdir, str(len(self._columns))), 'wb')
+            self._columns[name] = (typecode, handle)
+
+        self._n_strings = 0
+        self._string_size = 0
+        self._string2index = {}
+        self._write('string_offsets', [0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._cleanup()
+
+    def _write(self, column, values):
+        typecode, handle = self._columns[column]
+        array.array(typecode, values).tofile(handle)
+
+    def _add_string(self, value):
+        if value is None:
+            return MISSING
+        index = self._string2index.get(value)
+        if index is not None:
+            return index
+
+        data = six.text_type(value).encode('utf-8')
+        self._columns['string_data'][1].write(data)
+        self._string_size += len(data)
+        self._write('string_offsets', [self._string_size])
+        index = self._n_strings
+        self._n_strings += 1
+        if len(self._string2index) < STRING_CACHE_SIZE:
+            self._string2index[value] = index
+        return index
+
+    def add(self, tree, tree_id=None):
+        """ Adds a tree (any ETE tree instance) to the store. The tree ID
+        defaults to the position of the tree in the store. """
+        nodes = list(tree.traverse("preorder"))
+        node2index = {n: i for i, n in enumerate(nodes)}
+        size = [1] * len(nodes)
+        parent = [MISSING] * len(nodes)
+        for i in range(len(nodes) - 1, 0, -1):
+            parent[i] = node2index[nodes[i].up]
+            size[parent[i]] += size[i]
+
+        dist = [n.dist for n in nodes]
+        support = [n.support for n in nodes]
+        # Values of features that are not listed by a node (e.g. species of
+        # internal nodes of PhyloTrees) are stored, but not written
+        feature_mask = [sum(1 << k for k, f in enumerate(self.features)
+                            if f in n.features) for n in nodes]
+        strings = [[n.name for n in nodes]]
+        strings += [[getattr(n, feature, None) for n in nodes] for feature in self.features]
+
+        if tree_id is None:
+            tree_id = str(self.n_trees)
+        self._write('tree_start', [self.n_nodes])
+        self._write('tree_id', [self._add_string(tree_id)])
+        self._write('tree_digest', bytearray(_get_tree_digest(
+            [('i', size), ('i', parent), ('d', dist), ('d', support),
+             ('q', feature_mask)], strings)))
+        self._write('size', size)
+        self._write('parent', parent)
+        self._write('dist', dist)
+        self._write('support', support)
+        self._write('name', [self._add_string(name) for name in strings[0]])
+        self._write('feature_mask', feature_mask)
+        for feature, values in zip(self.features, strings[1:]):
+            self._write(_feature_column(feature),
+                        [self._add_string(value) for value in values])
+        self.n_trees += 1
+        self.n_nodes += len(nodes)
+
+    def close(self):
+        """ Joins all columns in the tree store file. """
+        if self._tmpdir is None:
+            return
+
+        columns, offset = OrderedDict(), 0
+        for name, (typecode, handle) in six.iteritems(self._columns):
+            handle.close()
+            size = os.path.getsize(handle.name)
+            itemsize = array.array(typecode).itemsize
+            columns[name] = [offset, typecode, size // itemsize]
+            offset += size + (-size % 8)
+
+        header = json.dumps({'version': VERSION, 'byteorder': sys.byteorder,
+                             'n_trees': self.n_trees, 'n_nodes': self.n_nodes,
+                             'features': self.features,
+                             'columns': columns}).encode('utf-8')
+        header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+        try:
+            with open(self.path, 'wb') as output:
+                output.write(MAGIC)
+                output.write(struct.pack('<Q', len(header)))
+                output.write(header)
+                for typecode, handle in self._columns.values():
+                    with open(handle.name, 'rb') as column:
+                        shutil.copyfileobj(column, output)
+                    output.write(b'\0' * (-output.tell() % 8))
+        finally:
+            self._cleanup()
+
+    def _cleanup(self):
+        if self._tmpdir is None:
+            return
+        for typecode, handle in self._columns.values():
+            handle.close()
+        shutil.rmtree(self._tmpdir)
+        self._tmpdir = None
+
+
+def _typed_view(buf, typecode, count):
+    ''' Returns a sequence of count values of the given array typecode,
+    without copying the buffer if possible. '''
+    if hasattr(buf, 'cast'):
+        return buf.cast(typecode)
+    values = array.array(typecode)
+    values.fromstring(buf.tobytes())
+    return values
+
+
+def _to_bytes(values):
+    ''' Returns the bytes of a memoryview, or of an array on python 2. '''
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+class TreeStore(object):
+    def __init__(self, path):
+        """ Opens a tree store created by TreeStoreWriter. Columns are
+        memory-mapped, so only the trees that are read are loaded from disk,
+        and processes opening the same store share its pages.
+
+        Trees are accessed by position (store[i] returns the root node of
+        tree i) or iterated as (tree_id, root node) pairs.
+
+        :param path: path of the tree store file.
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError('Not a tree store: %s' % path)
+
+        try:
+            if self._mmap[:len(MAGIC)] != MAGIC:
+                raise ValueError('Not a tree store: %s' % path)
+            start = len(MAGIC) + 8
+            header_size = struct.unpack('<Q', self._mmap[len(MAGIC):start])[0]
+            header = json.loads(self._mmap[start:start + header_size].decode('utf-8'))
+            if header['version'] != VERSION:
+                raise ValueError('Unsupported tree store version: %s' % header['version'])
+            if header['byteorder'] != sys.byteorder:
+                raise ValueError('Tree store written with %s byte order' %
+                                 header['byteorder'])
+        except:
+            self._mmap.close()
+            self._file.close()
+            raise
+
+        self.n_trees = header['n_trees']
+        self.n_nodes = header['n_nodes']
+        self.features = header['features']
+
+        data_start = start + header_size
+        self._buffer = memoryview(self._mmap)
+        self._views = []
+        columns = {}
+        for name, (offset, typecode, count) in six.iteritems(header['columns']):
+            itemsize = array.array(typecode).itemsize
+            offset += data_start
+            view = self._buffer[offset:offset + count * itemsize]
+            columns[name] = _typed_view(view, typecode, count)
+            # Views are released, last ones first, before closing the store
+            self._views.extend([view, columns[name]])
+
+        self._tree_start = columns['tree_start']
+        self._tree_id = columns['tree_id']
+        self._size = columns['size']
+        self._parent = columns['parent']
+        self._dist = columns['dist']
+        self._support = columns['support']
+        self._name = columns['name']
+        self._feature_mask = columns['feature_mask']
+        self._feature_columns = {f: columns[_feature_column(f)] for f in self.features}
+        self._string_offsets = columns['string_offsets']
+        self._string_data = columns['string_data']
+        # Missing in stores written before digests were stored
+        self._tree_digest = columns.get('tree_digest')
+        # Decoded strings, mostly repeated values such as species
+        self._strings = {MISSING: None}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.n_trees
+
+    def __getitem__(self, i):
+        """ Returns the root node of tree number i. Every call returns a new
+        view of the tree, so nodes read in separate calls are different
+        objects. """
+        if i < 0:
+            i += self.n_trees
+        if not 0 <= i < self.n_trees:
+            raise IndexError('tree store index out of range')
+        start = self._tree_start[i]
+        return _StoredTree(self, start, self._size[start]).get_node(0)
+
+    def __iter__(self):
+        for i in range(self.n_trees):
+            yield self.get_tree_id(i), self[i]
+
+    def get_tree_id(self, i):
+        return self.get_string(self._tree_id[i])
+
+    def get_tree_digest(self, i):
+        """ Returns the hex digest of the content of tree number i (its
+        topology, and the values of all stored attributes and features), read
+        from the store. """
+        if self._tree_digest is not None:
+            digest = _to_bytes(self._tree_digest[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+        else:
+            start = self._tree_start[i]
+            end = start + self._size[start]
+            strings = [[self.get_string(k) for k in self._name[start:end]]]
+            strings += [[self.get_string(k) for k in self._feature_columns[f][start:end]]
+                        for f in self.features]
+            digest = _get_tree_digest(
+                [('i', self._size[start:end]), ('i', self._parent[start:end]),
+                 ('d', self._dist[start:end]), ('d', self._support[start:end]),
+                 ('q', self._feature_mask[start:end])], strings)
+        return binascii.hexlify(digest).decode('ascii')
+
+    def get_string(self, index):
+        """ Returns a string of the string table, or None if missing. """
+        value = self._strings.get(index)
+        if value is None and index != MISSING:
+            start, end = self._string_offsets[index], self._string_offsets[index + 1]
+            value = _to_bytes(self._string_data[start:end]).decode('utf-8')
+            if len(self._strings) > STRING_CACHE_SIZE:
+                self._strings = {MISSING: None}
+            self._strings[index] = value
+        return value
+
+    def close(self):
+        """ Closes the store. Nodes read from it can't be used after. """
+        if self._mmap is None:
+            return
+        for view in reversed(self._views):
+            if hasattr(view, 'release'):
+                view.release()
+        if hasattr(self._buffer, 'release'):
+            self._buffer.release()
+        self._views = []
+        self._mmap.close()
+        self._file.close()
+        self._mmap = None
+
+
+class _StoredTree(object):
+    ''' Nodes of a tree read from a tree store. Node views are created once,
+    the first time they are requested, so the same node is always
+    represented by the same object. '''
+    def __init__(self, store, start, n_nodes):
+        self.store = store
+        self.start = start
+        self.nodes = [None] * n_nodes
+        self.columns = {}
+
+    def get_node(self, i):
+        node = self.nodes[i]
+        if node is None:
+            node = self.nodes[i] = StoredNode(self, i)
+        return node
+
+    def get_column(self, attr_name):
+        """ Returns a numpy array with the values of an attribute in all nodes
+        of the tree, in preorder, or None (see NodeView). Columns are copied,
+        so the store can be closed while they are used. """
+        if numpy is None:
+            return None
+        if attr_name not in self.columns:
+            store = self.store
+            start, end = self.start, self.start + len(self.nodes)
+            if attr_name == ('children', len):
+                parents = numpy.array(store._parent[start + 1:end])
+                column = numpy.bincount(parents, minlength=len(self.nodes))
+            elif attr_name in ('dist', 'support'):
+                column = numpy.array(getattr(store, '_' + attr_name)[start:end])
+            elif attr_name == 'name':
+                column = get_value_column([store.get_string(k)
+                                           for k in store._name[start:end]])
+            elif attr_name in store._feature_columns:
+                column = get_value_column([store.get_string(k) for k in
+                                           store._feature_columns[attr_name][start:end]])
+            else:
+                column = None
+            self.columns[attr_name] = column
+        return self.columns[attr_name]
+
+
+class StoredNode(NodeView):
+    ''' Read-only view of a node in a tree store, with the attributes and
+    methods of ETE nodes used by the matcher. Attributes (name, dist,
+    support, up, children and stored features) are read from the store the
+    first time they are requested, and kept as regular attributes of the
+    view. The size of its subtree is used to find its children and
+    descendants, which come after it in preorder. Use to_tree() to get a copy
+    of the subtree as a PhyloTree. '''
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._index = index
+
+    def __repr__(self):
+        return "Stored node '%s' (%s)" % (self.name, hex(id(self)))
+
+    def __getattr__(self, attr_name):
+        if attr_name.startswith('_'):
+            raise AttributeError(attr_name)
+        tree = self._tree
+        i = tree.start + self._index
+        store = tree.store
+        if attr_name == 'name':
+            value = store.get_string(store._name[i])
+        elif attr_name == 'dist':
+            value = store._dist[i]
+        elif attr_name == 'support':
+            value = store._support[i]
+        elif attr_name == 'up':
+            parent = store._parent[i]
+            value = None if parent == MISSING else tree.get_node(parent)
+        elif attr_name == 'children':
+            value = []
+            ich, end = self._index + 1, self._index + store._size[i]
+            while ich < end:
+                value.append(tree.get_node(ich))
+                ich += store._size[tree.start + ich]
+        else:
+            # String features (e.g. species)
+            column = store._feature_columns.get(attr_name)
+            value = None if column is None else store.get_string(column[i])
+            if value is None:
+                raise AttributeError("'StoredNode' object has no attribute '%s'" %
+                                     attr_name)
+        self.__dict__[attr_name] = value
+        return value
+
+    @property
+    def features(self):
+        tree = self._tree
+        mask = tree.store._feature_mask[tree.start + self._index]
+        features = set(BASE_FEATURES)
+        for k, feature in enumerate(tree.store.features):
+            if mask & (1 << k):
+                features.add(feature)
+        return features
+
+    def _get_size(self):
+        return self._tree.store._size[self._tree.start + self._index]
+
+    def get_column(self, attr_name):
+        return self._tree.get_column(attr_name)
+
+    def get_children_counts(self):
+        return self._tree.get_column(('children', len))
+
+    def is_leaf(self):
+        return self._tree.store._size[self._tree.start + self._index] == 1
+
+
+def convert(source, path, tree_format=0, features=DEFAULT_FEATURES):
+    """ Converts the trees in a tree file (see tree_reader.iter_trees) to a
+    tree store. Trees that can't be read are skipped. Returns the number of
+    trees stored. """
+    with TreeStoreWriter(path, features) as writer:
+        for tree_id, nw in iter_trees(source):
+            try:
+                tree = PhyloTree(nw, format=tree_format)
+            except Exception:
+                logging.error("Could not create tree %s from newick format.", tree_id)
+                continue
+            writer.add(tree, tree_id)
+        return writer.n_trees
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Converts a file of newick trees to a tree store.')
+    parser.add_argument("source", help=("tree file, as read by ete_search\
+                        --target_tree_file (compressed or not, one tree or an\
+                        ID and a tree per row). Use - for stdin."))
+    parser.add_argument("output", help="path of the new tree store")
+    parser.add_argument("--tree_format", dest="tree_format", type=int, default=0,
+                        help="A number 0-8 designating Newick format.")
+    parser.add_argument("--features", dest="features", nargs="*",
+                        default=list(DEFAULT_FEATURES),
+                        help="node features stored besides name, dist and support")
+    args = parser.parse_args(sys.argv[1:])
+    n_trees = convert(args.source, args.output, args.tree_format, args.features)
+    print("{} trees stored in {}".format(n_trees, args.output))
@@ -1,14 +1,94 @@
 import re
-import itertools
+import ast
+import operator
+from bisect import bisect_left, bisect_right
 from collections import defaultdict, OrderedDict
+from itertools import compress
+from timeit import default_timer as timer
 
 import six
-from copy import deepcopy
+from six.moves.collections_abc import Mapping
+from copy import copy
 from ete3 import PhyloTree, Tree, NCBITaxa
 
 from pprint import pprint
 
-class TreePatternCache(object):
+# numpy is optional, and only used to evaluate simple constraints on all
+# nodes of a tree at once (see get_vector_constraint)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Minimum number of nodes in a target tree to evaluate vectorized constraints
+VECTOR_MIN_NODES = 64
+
+# Attributes of target nodes depending on nodes out of their subtree, which
+# prevent updating matches incrementally (see IncrementalMatcher)
+ANCESTOR_ATTRIBUTES = frozenset(['up', 'is_root', 'get_tree_root', 'get_ancestors',
+                                 'iter_ancestors', 'get_sisters', 'get_distance',
+                                 'get_common_ancestor', 'get_farthest_node',
+                                 'get_closest_leaf'])
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(mask):
+        return bin(mask).count('1')
+
+
+class _CacheAggregates(object):
+    """ Aggregated values over the descendants of a node, computed from the
+    attributes returned by get_cached_attr(). Used by PatternSyntax functions
+    through the cache of the syntax controller. """
+
+    def leaf_names(self, node):
+        return sorted(self.get_cached_attr('name', node, leaves_only=True))
+
+    def descendant_names(self, node):
+        return sorted(self.get_cached_attr('name', node))
+
+    def species(self, node):
+        return set(self.get_cached_attr('species', node, leaves_only=True))
+
+    def contains_species(self, node, species_names):
+        return set(species_names).issubset(self.species(node))
+
+    def contains_leaves(self, node, node_names):
+        leaf_names = self.get_cached_attr('name', node, leaves_only=True)
+        return set(node_names).issubset(leaf_names)
+
+    def n_species(self, node):
+        return len(self.species(node))
+
+    def n_leaves(self, node):
+        return len(self.get_leaves(node))
+
+    def n_events(self, node, evoltype):
+        return self.get_cached_attr('evoltype', node).count(evoltype)
+
+    def get_ancestor_index(self):
+        """ Returns a TreeAncestorIndex of the cached tree, built the first
+        time it is requested. """
+        index = getattr(self, '_ancestor_index', None)
+        if index is None:
+            index = self._ancestor_index = TreeAncestorIndex(self.tree)
+        return index
+
+    def depth(self, node):
+        return self.get_ancestor_index().depth(node)
+
+    def is_ancestor(self, node_a, node_b):
+        return self.get_ancestor_index().is_ancestor(node_a, node_b)
+
+    def lca(self, nodes):
+        return self.get_ancestor_index().lca(*nodes)
+
+    def distance(self, node_a, node_b):
+        return self.get_ancestor_index().distance(node_a, node_b)
+
+
+class TreePatternCache(_CacheAggregates):
     def __init__(self, tree):
         """ Creates a cache for attributes that require multiple tree
         traversal when using complex TreePattern queries.
@@ -16,6 +96,7 @@ class TreePatternCache(object):
         :param tree: a regular ETE tree instance
          """
         # Initialize cache (add more stuff as needed)
+        self.tree = tree
         self.leaves_cache = tree.get_cached_content()
         self.all_node_cache = tree.get_cached_content(leaves_only=False)
 
@@ -46,7 +127,366 @@ class TreePatternCache(object):
         return self.all_node_cache[node]
 
 
-class _FakeCache(object):
+class TreeAggregateIndex(_CacheAggregates):
+    def __init__(self, tree, species_bitsets=False):
+        """ Creates a lightweight alternative to TreePatternCache, in which
+        aggregated values (number of leaves, species, duplication and
+        speciation events) are precomputed for all nodes in a single
+        bottom-up traversal.
+
+        Nodes are stored in preorder, so the descendants and leaves of any
+        node are contiguous ranges of two flat lists, and no per node copy of
+        its content is kept.
+
+        :param tree: a regular ETE tree instance
+        :param species_bitsets: If True, each species in the tree is mapped to
+            a bit and species under each node are stored as an integer mask,
+            so species containment is a mask AND and the number of species a
+            popcount. Recommended for trees with hundreds of species.
+        """
+        self.tree = tree
+        self.nodes = nodes = list(tree.traverse("preorder"))
+        self.node2index = node2index = {n: i for i, n in enumerate(nodes)}
+        self.leaves = leaves = []
+
+        size = [1] * len(nodes)
+        leaf_start = [0] * len(nodes)
+        n_leaves = [0] * len(nodes)
+        n_dups = [0] * len(nodes)
+        n_specs = [0] * len(nodes)
+        species = [None] * len(nodes)
+        self.species2bit = species2bit = {} if species_bitsets else None
+
+        for i, n in enumerate(nodes):
+            leaf_start[i] = len(leaves)
+            if not n.children:
+                leaves.append(n)
+
+        # Children are always visited before their parents in reverse preorder
+        for i in range(len(nodes) - 1, -1, -1):
+            n = nodes[i]
+            evoltype = getattr(n, 'evoltype', None)
+            n_dups[i] = 1 if evoltype == 'D' else 0
+            n_specs[i] = 1 if evoltype == 'S' else 0
+            if not n.children:
+                n_leaves[i] = 1
+                sp = getattr(n, 'species', None)
+                if species_bitsets:
+                    species[i] = species2bit.setdefault(sp, 1 << len(species2bit))
+                else:
+                    species[i] = frozenset([sp])
+                continue
+
+            ch_species = []
+            for ch in n.children:
+                ich = node2index[ch]
+                size[i] += size[ich]
+                n_leaves[i] += n_leaves[ich]
+                n_dups[i] += n_dups[ich]
+                n_specs[i] += n_specs[ich]
+                ch_species.append(species[ich])
+
+            if species_bitsets:
+                mask = 0
+                for ch_mask in ch_species:
+                    mask |= ch_mask
+                species[i] = mask
+                continue
+
+            # Reuse the largest species set of the children if it already
+            # contains all species under this node
+            ch_species.sort(key=len, reverse=True)
+            sp = ch_species[0].union(*ch_species[1:])
+            species[i] = ch_species[0] if len(sp) == len(ch_species[0]) else sp
+
+        self._size = size
+        self._leaf_start = leaf_start
+        self._n_leaves = n_leaves
+        self._n_events = {'D': n_dups, 'S': n_specs}
+        self._species = species
+        if species_bitsets:
+            self.bit2species = [None] * len(species2bit)
+            for sp, bit in six.iteritems(species2bit):
+                self.bit2species[bit.bit_length() - 1] = sp
+        self._leaf_name2pos = defaultdict(list)
+        for pos, leaf in enumerate(leaves):
+            self._leaf_name2pos[leaf.name].append(pos)
+
+    def get_cached_attr(self, attr_name, node, leaves_only=False):
+        """ Same as TreePatternCache.get_cached_attr() """
+        nodes = self.get_leaves(node) if leaves_only else self.get_descendants(node)
+        return [getattr(n, attr_name, None) for n in nodes]
+
+    def get_leaves(self, node):
+        i = self.node2index[node]
+        start = self._leaf_start[i]
+        return self.leaves[start:start + self._n_leaves[i]]
+
+    def get_descendants(self, node):
+        i = self.node2index[node]
+        return self.nodes[i:i + self._size[i]]
+
+    def species(self, node):
+        species = self._species[self.node2index[node]]
+        if self.species2bit is None:
+            return species
+
+        names = set()
+        while species:
+            bit = species & -species
+            names.add(self.bit2species[bit.bit_length() - 1])
+            species ^= bit
+        return names
+
+    def contains_species(self, node, species_names):
+        if self.species2bit is None:
+            return super(TreeAggregateIndex, self).contains_species(node, species_names)
+
+        query = 0
+        for sp in species_names:
+            bit = self.species2bit.get(sp)
+            if bit is None:
+                return False
+            query |= bit
+        return self._species[self.node2index[node]] & query == query
+
+    def contains_leaves(self, node, node_names):
+        i = self.node2index[node]
+        start = self._leaf_start[i]
+        end = start + self._n_leaves[i]
+        for name in set(node_names):
+            positions = self._leaf_name2pos.get(name, ())
+            k = bisect_left(positions, start)
+            if k == len(positions) or positions[k] >= end:
+                return False
+        return True
+
+    def n_species(self, node):
+        species = self._species[self.node2index[node]]
+        if self.species2bit is None:
+            return len(species)
+        return _popcount(species)
+
+    def n_leaves(self, node):
+        return self._n_leaves[self.node2index[node]]
+
+    def n_events(self, node, evoltype):
+        events = self._n_events.get(evoltype)
+        if events is None:
+            return super(TreeAggregateIndex, self).n_events(node, evoltype)
+        return events[self.node2index[node]]
+
+
+class TreeAttributeIndex(object):
+    def __init__(self, tree, attributes=('name',)):
+        """ Creates an index of the nodes in a target tree by the value of
+        their attributes, so pattern nodes requiring a literal value (e.g. a
+        node name) are resolved with dictionary lookups instead of evaluating
+        their constraint in every node. The same index can be built once and
+        shared by all the patterns searched in the tree.
+
+        :param tree: a regular ETE tree instance
+        :param attributes: attributes indexed in advance. Other attributes
+            are indexed the first time they are requested.
+        """
+        self.tree = tree
+        self.nodes = list(tree.traverse())
+        self.leaves = [n for n in self.nodes if not n.children]
+        self.internal_nodes = [n for n in self.nodes if n.children]
+        self._attr2index = {}
+        self._columns = {}
+        for attr_name in attributes:
+            self.add_attribute(attr_name)
+
+    def add_attribute(self, attr_name):
+        """ Indexes all nodes by the value of an attribute. Nodes with
+        unhashable values are not indexed. """
+        if attr_name in self._attr2index:
+            return
+        value2nodes = defaultdict(list)
+        for n in self.nodes:
+            try:
+                value2nodes[getattr(n, attr_name, None)].append(n)
+            except TypeError:
+                pass
+        self._attr2index[attr_name] = dict(value2nodes)
+
+    def get_nodes(self, attr_name, value):
+        """ Returns the list of nodes whose attribute is equal to value. """
+        self.add_attribute(attr_name)
+        return self._attr2index[attr_name].get(value, [])
+
+    def get_candidates(self, expects_leaf=None, expected_values=None):
+        """ Returns the nodes satisfying the structural conditions extracted
+        from a constraint (see get_structural_constraints). """
+        if expects_leaf is None:
+            nodes = self.nodes
+        else:
+            nodes = self.leaves if expects_leaf else self.internal_nodes
+        if not expected_values:
+            return nodes
+
+        # Use the less populated of the requested attribute values
+        by_value = min((self.get_nodes(attr_name, value)
+                        for attr_name, value in sorted(expected_values.items())),
+                       key=len)
+        if expects_leaf is None:
+            return by_value
+        return [n for n in by_value if expects_leaf != bool(n.children)]
+
+    def get_column(self, attr_name):
+        """ Returns a numpy array with the value of an attribute in all the
+        indexed nodes (in the order of self.nodes), used to evaluate
+        vectorized constraints. Returns None if numpy is not available, or
+        the attribute is missing in any node or its values are not all
+        numbers or all strings.
+
+        Trees keeping their nodes in columns (e.g. CompactTree) provide
+        get_column() and get_positions() methods, so values are read from
+        their columns instead of from every node. """
+        if attr_name in self._columns:
+            return self._columns[attr_name]
+
+        column = None
+        if numpy is not None:
+            if hasattr(self.tree, 'get_column'):
+                column = self.tree.get_column(attr_name)
+                if column is not None:
+                    column = column[self._get_positions()]
+            else:
+                try:
+                    values = list(map(operator.attrgetter(attr_name), self.nodes))
+                except AttributeError:
+                    values = None
+                column = get_value_column(values)
+        self._columns[attr_name] = column
+        return column
+
+    def get_children_counts(self):
+        """ Returns a numpy array with the number of children of all the
+        indexed nodes, or None if numpy is not available. """
+        if numpy is None:
+            return None
+        counts = self._columns.get(('children', len))
+        if counts is None:
+            if hasattr(self.tree, 'get_children_counts'):
+                counts = self.tree.get_children_counts()[self._get_positions()]
+            else:
+                counts = numpy.fromiter(map(len, map(operator.attrgetter('children'),
+                                                     self.nodes)),
+                                        dtype=int, count=len(self.nodes))
+            self._columns[('children', len)] = counts
+        return counts
+
+    def _get_positions(self):
+        positions = self._columns.get(('positions',))
+        if positions is None:
+            positions = self._columns[('positions',)] = self.tree.get_positions(self.nodes)
+        return positions
+
+
+class TreeAncestorIndex(object):
+    def __init__(self, tree):
+        """ Creates an index of a target tree answering ancestor queries
+        without walking up to the root. Every node gets its preorder and
+        postorder positions and its depth, and lowest common ancestors are
+        found in constant time using a sparse table over the Euler tour of the
+        tree.
+
+        The same index is used by the matcher to combine loose connections,
+        and by syntax functions through the cache of the target tree (see
+        get_ancestor_index).
+
+        :param tree: a regular ETE tree instance
+        """
+        self.nodes = nodes = [tree]
+        self.node2index = node2index = {tree: 0}
+        self._parent = parent = [None]
+        self._depth = depth = [0]
+        self._size = size = [1]
+        self._post = post = [0]
+        self._first = first = [0]
+
+        # Preorder indexes of the nodes visited in the Euler tour
+        euler = [0]
+        stack = [(0, iter(tree.children))]
+        n_visited = 0
+        while stack:
+            index, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                size[index] = len(nodes) - index
+                post[index] = n_visited
+                n_visited += 1
+                if stack:
+                    euler.append(stack[-1][0])
+                continue
+            ich = len(nodes)
+            nodes.append(child)
+            node2index[child] = ich
+            parent.append(index)
+            depth.append(depth[index] + 1)
+            size.append(1)
+            post.append(0)
+            first.append(len(euler))
+            euler.append(ich)
+            stack.append((ich, iter(child.children)))
+
+        # table[k][i] is the shallowest node in euler[i:i + 2**k]
+        self._table = table = [euler]
+        k = 1
+        while 2 ** k <= len(euler):
+            prev, half = table[-1], 2 ** (k - 1)
+            table.append([a if depth[a] <= depth[b] else b
+                          for a, b in zip(prev, prev[half:])])
+            k += 1
+
+    def _lca(self, i, j):
+        fi, fj = self._first[i], self._first[j]
+        if fi > fj:
+            fi, fj = fj, fi
+        k = (fj - fi + 1).bit_length() - 1
+        a, b = self._table[k][fi], self._table[k][fj - 2 ** k + 1]
+        return a if self._depth[a] <= self._depth[b] else b
+
+    def _is_ancestor(self, i, j):
+        return i <= j < i + self._size[i]
+
+    def get_interval(self, node):
+        """ Returns the preorder and postorder positions of a node. A node is
+        an ancestor of another one if it comes first in preorder and last in
+        postorder. """
+        i = self.node2index[node]
+        return i, self._post[i]
+
+    def depth(self, node):
+        """ Returns the number of edges from the root to a node. """
+        return self._depth[self.node2index[node]]
+
+    def is_ancestor(self, node_a, node_b):
+        """ True if node_a is node_b or any of its ancestors. """
+        return self._is_ancestor(self.node2index[node_a], self.node2index[node_b])
+
+    def lca(self, *nodes):
+        """ Returns the lowest common ancestor of one or more nodes, in O(k)
+        for k nodes. """
+        # The common ancestor of all nodes is the one of the first and last
+        # nodes visited in the Euler tour
+        node2index, first = self.node2index, self._first
+        indexes = [node2index[n] for n in nodes]
+        i = min(indexes, key=first.__getitem__)
+        j = max(indexes, key=first.__getitem__)
+        return self.nodes[self._lca(i, j)]
+
+    def distance(self, node_a, node_b):
+        """ Returns the number of edges in the path between two nodes. """
+        i, j = self.node2index[node_a], self.node2index[node_b]
+        depth = self._depth
+        return depth[i] + depth[j] - 2 * depth[self._lca(i, j)]
+
+
+class _FakeCache(_CacheAggregates):
     """TreePattern cache emulator."""
     def __init__(self):
         pass
@@ -69,13 +509,52 @@ class _FakeCache(object):
     def get_descendants(self, node):
         return node.get_descendants()
 
+    def depth(self, node):
+        return len(node.get_ancestors())
+
+    def is_ancestor(self, node_a, node_b):
+        return node_a is node_b or node_a in node_b.iter_ancestors()
+
+    def lca(self, nodes):
+        nodes = list(nodes)
+        if len(nodes) == 1:
+            return nodes[0]
+        return nodes[0].get_common_ancestor(nodes)
+
+    def distance(self, node_a, node_b):
+        anc = self.lca([node_a, node_b])
+        dist = 0
+        for node in (node_a, node_b):
+            while node is not anc:
+                node = node.up
+                dist += 1
+        return dist
+
 
 class PatternSyntax(object):
-    def __init__(self):
+    # Syntax functions relying on a cache to avoid traversing the target
+    # tree for every node. Custom syntax classes can extend this set.
+    cached_functions = frozenset(['leaves', 'descendants', 'species',
+                                  'contains_species', 'contains_leaves',
+                                  'n_species', 'n_leaves', 'n_duplications',
+                                  'n_speciations', 'depth', 'is_ancestor',
+                                  'lca', 'distance'])
+
+    # Syntax functions whose result depends on the ancestors of target nodes,
+    # not only on their subtree (see IncrementalMatcher)
+    ancestor_functions = frozenset(['depth', 'is_ancestor', 'lca', 'distance'])
+
+    def __init__(self, species_bitsets=False):
+        """
+        :param species_bitsets: If True, caches built for this syntax store
+            species as integer bitsets (see TreeAggregateIndex), speeding up
+            species related functions in trees with many species.
+        """
         # Creates a fake cache to ensure all functions below are functioning
         # event if no real cache is provided
         self.__fake_cache = _FakeCache()
         self.__cache = None
+        self.species_bitsets = species_bitsets
 
     def __get_cache(self):
         if self.__cache:
@@ -88,17 +567,19 @@ class PatternSyntax(object):
 
     cache = property(__get_cache, __set_cache)
 
+    def build_cache(self, tree):
+        """ Returns a new cache of the target tree for the functions in this
+        syntax. Used when searching with patterns that require a cache. """
+        return TreeAggregateIndex(tree, species_bitsets=self.species_bitsets)
+
     def leaves(self, target_node):
-        return sorted([name for name in self.cache.get_cached_attr(
-            'name', target_node, leaves_only=True)])
+        return self.cache.leaf_names(target_node)
 
     def descendants(self, target_node):
-        return sorted([name for name in self.cache.get_cached_attr(
-            'name', target_node)])
+        return self.cache.descendant_names(target_node)
 
     def species(self, target_node):
-        return set([name for name in self.cache.get_cached_attr(
-            'species', target_node, leaves_only=True)])
+        return set(self.cache.species(target_node))
 
     def contains_species(self, target_node, species_names):
         """
@@ -109,11 +590,7 @@ class PatternSyntax(object):
         else:
             species_names = set(species_names)
 
-        found = 0
-        for sp in self.cache.get_cached_attr('species', target_node, leaves_only=True):
-            if sp in species_names:
-                found += 1
-        return found == len(species_names)
+        return self.cache.contains_species(target_node, species_names)
 
     def contains_leaves(self, target_node, node_names):
         """ Shortcut function to find if a node contains at least one of the
@@ -124,23 +601,18 @@ class PatternSyntax(object):
         else:
             node_names = set(node_names)
 
-        found = 0
-        for name in self.cache.get_cached_attr('name', target_node, leaves_only=True):
-            if name in node_names:
-                found += 1
-        return found == len(node_names)
+        return self.cache.contains_leaves(target_node, node_names)
 
     def n_species(self, target_node):
         """ Shortcut function to find the number of species within a node and
         any of it's descendants. """
 
-        species = self.cache.get_cached_attr('species', target_node, leaves_only=True)
-        return len(set(species))
+        return self.cache.n_species(target_node)
 
     def n_leaves(self, target_node):
         """ Shortcut function to find the number of leaves within a node and any
                 of it's descendants. """
-        return len(self.cache.get_leaves(target_node))
+        return self.cache.n_leaves(target_node)
 
     def n_duplications(self, target_node):
         """
@@ -148,15 +620,103 @@ class PatternSyntax(object):
             :param target_node: Node to be evaluated, given as @.
             :return: True if node is a duplication, otherwise False.
         """
-        events = self.cache.get_cached_attr('evoltype', target_node)
-        return(events.count('D'))
+        return self.cache.n_events(target_node, 'D')
 
     def n_speciations(self, target_node):
         """
             Shortcut function to find the number of speciation events at or below a node.
         """
-        events = self.cache.get_cached_attr('evoltype', target_node)
-        return(events.count('S'))
+        return self.cache.n_events(target_node, 'S')
+
+    def depth(self, target_node):
+        """ Shortcut function to find the number of edges from the root of the
+        tree to a node. """
+        return self.cache.depth(target_node)
+
+    def is_ancestor(self, node_a, node_b):
+        """ Shortcut function to find if node_a is node_b or any of its
+        ancestors. """
+        return self.cache.is_ancestor(node_a, node_b)
+
+    def lca(self, *nodes):
+        """ Shortcut function to find the lowest common ancestor of one or more
+        nodes. """
+        return self.cache.lca(nodes)
+
+    def distance(self, node_a, node_b):
+        """ Shortcut function to find the number of edges between two nodes. """
+        return self.cache.distance(node_a, node_b)
+
+class ConstraintScope(Mapping):
+    """ Read-only namespace in which pattern constraints are evaluated.
+
+    It exposes all the functions and attributes of a syntax controller. It is
+    built only once per pattern and shared by all its nodes, so evaluating a
+    constraint only requires binding the target node.
+
+    :param syntax: Syntax controller instance (e.g. PatternSyntax)
+    """
+    def __init__(self, syntax):
+        self.syntax = syntax
+        self._namespace = {attr_name: getattr(syntax, attr_name)
+                           for attr_name in dir(syntax)}
+        # Globals of the constraint functions. eval() adds __builtins__ to
+        # them, so they are kept apart from the read-only namespace.
+        self._globals = dict(self._namespace)
+
+    def __getitem__(self, key):
+        return self._namespace[key]
+
+    def __iter__(self):
+        return iter(self._namespace)
+
+    def __len__(self):
+        return len(self._namespace)
+
+    def with_cache(self, cache):
+        """ Returns a new scope in which syntax functions use the provided
+        cache. The syntax controller is copied, so the cache is never set on
+        the syntax instance shared by the pattern. """
+        syntax = copy(self.syntax)
+        syntax.cache = cache
+        return ConstraintScope(syntax)
+
+    def bind(self, code):
+        """ Returns the function resulting from evaluating a compiled lambda
+        expression within this namespace. """
+        return eval(code, self._globals)
+
+
+class PatternPlan(object):
+    """ Read-only search plan of a pattern, built once and reused by all the
+    searches of the pattern (see TreePattern.get_plan), so the pattern doesn't
+    need to be copied and split for every target tree.
+
+    :param pattern: Root of the pattern, with initialized controllers.
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.structure = get_pattern_structure(pattern)
+
+        # One pattern node per distinct constraint, which is evaluated only
+        # once per tree
+        constraint_nodes = OrderedDict()
+        for n in pattern.traverse():
+            constraint_nodes.setdefault(n.constraint, n)
+        self.constraint_nodes = list(constraint_nodes.values())
+        self.uses_cache = any(n.uses_cache for n in self.constraint_nodes)
+        self.uses_ancestors = any(n.uses_ancestors for n in self.constraint_nodes)
+
+        # Strict sub-patterns connected through loose connections
+        self.roots, self.expected_groups = split_by_loose_nodes(pattern)
+
+
+# Pattern node attributes built by TreePattern.init_controller and
+# TreePattern.get_plan, which are not kept in pickled or copied patterns
+_COMPILED_ATTRIBUTES = ('compiled_constraint', 'constraint_func',
+                        'vector_constraint', '_constraint_scope', '_plan',
+                        '_controller_key')
+
 
 class TreePattern(Tree):
     def __str__(self):
@@ -186,6 +746,40 @@ class TreePattern(Tree):
         # Set a default syntax controller if a custom one is not provided
         self.syntax = syntax if syntax else PatternSyntax()
 
+    def __getstate__(self):
+        # Compiled constraints, bound functions and search plans can't be
+        # pickled (e.g. by copy() or when sending patterns to other
+        # processes). They are dropped and rebuilt on first use.
+        state = self.__dict__.copy()
+        for attr in _COMPILED_ATTRIBUTES:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def constraint_scope(self):
+        """ Namespace used to evaluate the constraints of this pattern. It is
+        always built from the syntax of the root pattern node and shared by
+        all nodes in the pattern. """
+        root = self.get_tree_root()
+        scope = getattr(root, '_constraint_scope', None)
+        if scope is None or scope.syntax is not root.syntax:
+            scope = ConstraintScope(root.syntax)
+            root._constraint_scope = scope
+        return scope
+
+    def get_plan(self):
+        """ Returns the search plan of this pattern (see PatternPlan). It is
+        built only once and cached in the pattern, unless its nodes, their
+        names or the syntax changed. """
+        for n in self.traverse("postorder"):
+            n.init_controller()
+        plan = getattr(self, '_plan', None)
+        if plan is None or plan.structure != get_pattern_structure(self):
+            plan = self._plan = PatternPlan(self)
+        return plan
 
     def parse_metacharacters(self, raw_constraint):
         """Takes a string as node name, extracts metacharacters and interpret them as
@@ -253,26 +847,84 @@ class TreePattern(Tree):
         That information is about how a node interacts with the tree topology.
         It describes how the metacharacter connects with the rest of nodes and
         if it is leaf or root.
+
+        The resulting python expression is compiled only once into a function
+        bound to the pattern's constraint scope and cached in the pattern
+        node, so it can be reused across target nodes and trees. Calling this
+        method again is a no-op unless the node name, the names of its
+        children or the pattern syntax changed.
+
+        Structural conditions that can be tested without evaluating the
+        constraint are also extracted (see get_structural_constraints), as
+        well as the number of children expected in target nodes. Children
+        nodes must be initialized first (i.e. init in postorder).
         """
+        scope = self.constraint_scope
+        controller_key = (self.name, tuple(ch.name for ch in self.children),
+                          id(scope))
+        if getattr(self, '_controller_key', None) == controller_key:
+            return
+
         # Interpret node name to python expression
         self.constraint = self.parse_node_name()
+        self.compiled_constraint = compile('lambda __target_node: ' + self.constraint,
+                                           '<pattern node %s>' % self.name,
+                                           'eval')
+        self.constraint_func = scope.bind(self.compiled_constraint)
+        self.constraint_names = frozenset(
+            n.id for n in ast.walk(ast.parse(self.constraint, mode='eval'))
+            if isinstance(n, ast.Name))
+        cached_functions = getattr(scope.syntax, 'cached_functions', ())
+        self.uses_cache = bool(self.constraint_names & cached_functions)
+        ancestor_functions = getattr(scope.syntax, 'ancestor_functions', ())
+        self.uses_ancestors = bool(
+            self.constraint_names & ancestor_functions or
+            any(isinstance(n, ast.Attribute) and n.attr in ANCESTOR_ATTRIBUTES
+                for n in ast.walk(ast.parse(self.constraint, mode='eval'))))
+        self.expects_leaf, self.expected_values = get_structural_constraints(
+            self.constraint)
+        self.vector_constraint = get_vector_constraint(self.constraint, scope)
+
+        # Range of number of children that target nodes can have to match
+        # this node's children, given their min and max occurrences
+        if self.children and not self.loose_children:
+            self.min_children = sum(ch.min_occur for ch in self.children)
+            self.max_children = sum(ch.max_occur for ch in self.children)
+        else:
+            self.min_children, self.max_children = 0, float('inf')
+        self._controller_key = controller_key
+
+    def get_constraint_func(self, scope=None):
+        """ Returns the constraint of this node as a function bound to the
+        provided constraint scope (by default, the pattern's scope). """
+        if getattr(self, '_controller_key', None) is None:
+            self.init_controller()
+        if scope is None or scope is self.constraint_scope:
+            return self.constraint_func
+        return scope.bind(self.compiled_constraint)
+
+
+    def is_local_match(self, target_node, cache, constraint_func=None):
+        """ Evaluate if a tree nodes matches the constraints in this pattern node.
+
+        :param cache: A cache of the target tree used by syntax functions, or
+            None.
+        :param constraint_func: Optional constraint function already bound to
+            a scope using the same cache (see get_constraint_func), so
+            multiple evaluations don't need to bind it again.
+        """
 
-
-    def is_local_match(self, target_node, cache):
-        """ Evaluate if a tree nodes matches the constraints in this pattern node.  """
-
-        # Creates a local scope containing function names, variables and other
-        # stuff referred within the pattern expressions. We use Syntax() as a
-        # container of those custom functions and shortcuts.
-        constraint_scope = {attr_name: getattr(self.syntax, attr_name)
-                            for attr_name in dir(self.syntax)}
-        constraint_scope.update({"__target_node": target_node})
+        # Constraint functions are evaluated within the constraint scope of
+        # the pattern, which contains function names, variables and other
+        # stuff referred within the pattern expressions.
+        if constraint_func is None:
+            scope = None
+            if cache is not None:
+                scope = self.constraint_scope.with_cache(cache)
+            constraint_func = self.get_constraint_func(scope)
 
         try:
-            if self.constraint:
-                st = eval(self.constraint, constraint_scope)
-            else:
-                st = True
+            return constraint_func(target_node)
 
         except ValueError:
             raise ValueError("not a boolean result: . Check quoted_node_names.")
@@ -280,198 +932,1198 @@ class TreePattern(Tree):
         except (AttributeError, IndexError) as err:
             raise ValueError('Constraint evaluation failed at %s: %s' %
                              (target_node, err))
-        except NameError:
-            try:
-                # temporary fix. Can not access custom syntax on all nodes. Get it from the root node.
-                root_syntax = self.get_tree_root().syntax
-                constraint_scope = {attr_name: getattr(root_syntax, attr_name)
-                                    for attr_name in dir(root_syntax)}
-                constraint_scope.update({"__target_node": target_node})
-
-                st = True
-                for constraint in constraints:
-                    if constraint:
-                        st &= eval(constraint, constraint_scope)
-                    else: st &= True
-                return st
-            except NameError as err:
-                raise NameError('Constraint evaluation failed at %s: %s' %
-                         (target_node, err))
-        else:
-            return st
-
-    def find_match(self, t):
-        return find_matches(t, self)
-
-
+        except NameError as err:
+            raise NameError('Constraint evaluation failed at %s: %s' %
+                            (target_node, err))
+
+    def find_match(self, t, cache=None, index=None, ancestor_index=None,
+                   stats=None, budget=None):
+        return find_matches(t, self, cache=cache, index=index,
+                            ancestor_index=ancestor_index, stats=stats,
+                            budget=budget)
+
+    def first_match(self, t, cache=None, index=None, ancestor_index=None,
+                    stats=None, budget=None):
+        """ Returns the first match of the pattern in tree t, or None. The
+        search stops as soon as a match is found. """
+        return next(self.find_match(t, cache=cache, index=index,
+                                    ancestor_index=ancestor_index,
+                                    stats=stats, budget=budget), None)
+
+    def exists(self, t, cache=None, index=None, ancestor_index=None,
+               stats=None, budget=None):
+        """ True if the pattern matches anywhere in tree t. """
+        return self.first_match(t, cache=cache, index=index,
+                                ancestor_index=ancestor_index,
+                                stats=stats, budget=budget) is not None
+
+
+
+def get_pattern_structure(pattern):
+    '''Returns a tuple identifying the nodes of a pattern and their
+    initialized controllers, used to detect changes in the pattern.'''
+    return tuple((n, n._controller_key) for n in pattern.traverse())
+
+def _is_target_attr(node, attr_name):
+    '''True if node is an access to an attribute of the target node (any
+    attribute if attr_name is None).'''
+    return (isinstance(node, ast.Attribute) and
+            attr_name in (None, node.attr) and
+            isinstance(node.value, ast.Name) and node.value.id == '__target_node')
+
+def _get_literal(node):
+    '''Returns a tuple (True, value) if node is a string or number literal,
+    otherwise (False, None).'''
+    # literals are parsed as ast.Str/ast.Num in python < 3.8 and ast.Constant
+    # after
+    node_type = type(node).__name__
+    if node_type == 'Constant':
+        value = node.value
+    elif node_type == 'Str':
+        value = node.s
+    elif node_type == 'Num':
+        value = node.n
+    else:
+        return False, None
+    is_literal = isinstance(value, six.string_types + six.integer_types + (float,))
+    return is_literal, value
+
+def get_structural_constraints(constraint):
+    '''Extracts from a constraint expression the conditions that can be tested
+    without evaluating it. Returns a tuple (expects_leaf, expected_values),
+    where expects_leaf is True or False if target nodes must be leaves or
+    internal nodes (None if unknown), and expected_values a dictionary of
+    attributes that must be equal to a literal value (e.g. node names).'''
+
+    # Only top level conjunctions (a and b and c) are considered
+    conjuncts = [ast.parse(constraint, mode='eval').body]
+    expects_leaf, expected_values = None, {}
+    while conjuncts:
+        node = conjuncts.pop()
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            conjuncts.extend(node.values)
+        elif _is_target_attr(node, 'children'):
+            expects_leaf = False
+        elif (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not)
+              and _is_target_attr(node.operand, 'children')):
+            expects_leaf = True
+        elif (isinstance(node, ast.Compare) and len(node.ops) == 1 and
+              isinstance(node.ops[0], ast.Eq)):
+            left, right = node.left, node.comparators[0]
+            if _is_target_attr(right, None):
+                left, right = right, left
+            is_literal, value = _get_literal(right)
+            if _is_target_attr(left, None) and is_literal:
+                expected_values[left.attr] = value
+    return expects_leaf, expected_values
+
+def get_value_column(values):
+    '''Returns a numpy array with the values of an attribute in a list of
+    nodes, if they are all numbers or all strings, otherwise None.'''
+    if numpy is None or not values:
+        return None
+    types = set(map(type, values))
+    if types.issubset(six.string_types):
+        column = numpy.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+    elif types.issubset((bool, float) + six.integer_types):
+        column = numpy.array(values)
+        if column.dtype.kind in 'biuf':
+            return column
+    return None
+
+# Comparisons supported by vectorized constraints
+_VECTOR_OPERATORS = {ast.Eq: operator.eq, ast.NotEq: operator.ne,
+                     ast.Lt: operator.lt, ast.LtE: operator.le,
+                     ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+def get_vector_constraint(constraint, scope=None):
+    '''Returns a function evaluating a constraint expression in all the nodes
+    of a TreeAttributeIndex at once, as a numpy boolean mask, or None if the
+    constraint can't be vectorized or numpy is not available.
+
+    Only constraints combining (and, or, not) comparisons between attributes
+    of the target node (e.g. dist, support, name or numeric features),
+    len(@.children) and literal values, and tests on @.children and
+    @.is_leaf() can be vectorized. The returned function returns None if the
+    attributes used have missing or mixed type values in the target tree, so
+    the constraint is then evaluated node by node.'''
+    if numpy is None:
+        return None
+    # len() must be the builtin function
+    if scope is not None and 'len' in scope:
+        return None
+    mask_func = _vectorize_condition(ast.parse(constraint, mode='eval').body)
+    if mask_func is None:
+        return None
+
+    def vector_constraint(index):
+        try:
+            mask = mask_func(index)
+        except Exception:
+            return None
+        if mask is None:
+            return None
+        mask = numpy.asarray(mask, dtype=bool)
+        if mask.shape != (len(index.nodes),):
+            return None
+        return mask
+    return vector_constraint
+
+def _vectorize_condition(node):
+    '''Returns a function building the boolean mask of a condition, or None
+    if it can't be vectorized.'''
+    if isinstance(node, ast.BoolOp):
+        operands = [_vectorize_condition(value) for value in node.values]
+        if any(f is None for f in operands):
+            return None
+        combine = numpy.logical_and if isinstance(node.op, ast.And) else numpy.logical_or
+        def bool_op(index):
+            masks = [f(index) for f in operands]
+            if any(mask is None for mask in masks):
+                return None
+            return combine.reduce(masks)
+        return bool_op
+
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        operand = _vectorize_condition(node.operand)
+        if operand is None:
+            return None
+        def not_op(index):
+            mask = operand(index)
+            return None if mask is None else numpy.logical_not(mask)
+        return not_op
+
+    elif _is_target_attr(node, 'children'):
+        return lambda index: index.get_children_counts() > 0
+
+    elif (isinstance(node, ast.Call) and not node.args and not node.keywords and
+          _is_target_attr(node.func, 'is_leaf')):
+        return lambda index: index.get_children_counts() == 0
+
+    elif isinstance(node, ast.Compare):
+        operands = [_vectorize_value(value) for value in [node.left] + node.comparators]
+        ops = [_VECTOR_OPERATORS.get(type(op)) for op in node.ops]
+        if any(f is None for f in operands + ops):
+            return None
+        def compare(index):
+            # Chained comparisons (a < b < c) are combined with and
+            values = [f(index) for f in operands]
+            if any(v is None for v in values):
+                return None
+            mask = True
+            for op, left, right in zip(ops, values, values[1:]):
+                mask = numpy.logical_and(mask, op(left, right))
+            return mask
+        return compare
+
+    is_literal, value = _get_literal(node)
+    if is_literal or type(node).__name__ == 'NameConstant':
+        value = value if is_literal else node.value
+        if isinstance(value, bool):
+            return lambda index: numpy.full(len(index.nodes), value, dtype=bool)
+    return None
+
+def _vectorize_value(node):
+    '''Returns a function returning the values of an operand of a
+    comparison in all nodes (a numpy array or a literal), or None if it
+    can't be vectorized.'''
+    if _is_target_attr(node, None) and node.attr not in ('children', 'up'):
+        attr_name = node.attr
+        return lambda index: index.get_column(attr_name)
+    elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+          node.func.id == 'len' and len(node.args) == 1 and not node.keywords and
+          _is_target_attr(node.args[0], 'children')):
+        return lambda index: index.get_children_counts()
+
+    is_literal, value = _get_literal(node)
+    if is_literal:
+        return lambda index: value
+    return None
 
 # NEW APPROACH
-def compute_match_matrix(pattern, tree):
+def compute_match_matrix(pattern, tree, cache=None, index=None):
     '''Computes a dictionary where keys are all the constraints observed in a
-    pattern and values all nodes matching those patterns.'''
+    pattern and values all nodes matching those patterns.
+
+    Constraints are only evaluated on candidate nodes satisfying the
+    structural conditions extracted from them (leaf or internal nodes, and
+    literal values such as names, which are resolved using a
+    TreeAttributeIndex of the tree). Simple constraints on node attributes
+    are evaluated in all nodes at once if numpy is available (see
+    get_vector_constraint).
+    '''
+
+    # Constraints are bound once to a scope using the provided cache
+    scope = pattern.constraint_scope
+    if cache is not None:
+        scope = scope.with_cache(cache)
+    if index is None:
+        index = TreeAttributeIndex(tree)
 
+    # the same constraint is evaluated only once
     c2nodes = defaultdict(set)
-    for n in tree.traverse():
-        for cn in pattern.traverse():
-            if cn.is_local_match(n, None):
-                c2nodes[cn.constraint].add(n)
+    for cn in pattern.get_plan().constraint_nodes:
+        matches = c2nodes[cn.constraint]
+        mask = get_vector_mask(cn, index)
+        if mask is not None:
+            matches.update(compress(index.nodes, mask))
+            continue
+
+        constraint_func = cn.get_constraint_func(scope)
+
+        for n in index.get_candidates(cn.expects_leaf, cn.expected_values):
+            if cn.is_local_match(n, cache, constraint_func):
+                matches.add(n)
     return c2nodes
 
-def children_match(tnode, pnode, c2nodes, loose_constraint=None):
+def get_vector_mask(pnode, index):
+    '''Returns a numpy mask of the nodes of a TreeAttributeIndex matching the
+    constraint of pnode, or None if it must be evaluated node by node (the
+    constraint can't be vectorized, or the tree is too small to benefit from
+    it).'''
+    vector_constraint = getattr(pnode, 'vector_constraint', None)
+    if vector_constraint is None or len(index.nodes) < VECTOR_MIN_NODES:
+        return None
+    return vector_constraint(index)
+
+class SearchStats(object):
+    def __init__(self):
+        """ Counters and timers of the work done by searches, collected when
+        passed to find_matches() (or TreePattern.find_match(),
+        PatternSet.find_matches(), etc.). Searches without it only test
+        whether it was provided.
+
+        Times are wall seconds per phase: 'cache' (building the cache of
+        syntax functions), 'constraints' (evaluating constraints, also while
+        matching children lazily), 'combine_loose' (combining the matches of
+        sub-patterns connected through loose connections) and 'search' (the
+        whole search, including the other phases except 'cache').
+        """
+        self.searches = 0
+        # Target nodes evaluated per pattern node (by name), node by node and
+        # as part of vectorized evaluations
+        self.evaluations = defaultdict(int)
+        self.vector_evaluations = defaultdict(int)
+        # children_match calls, and subproblems solved (not read from a memo)
+        self.children_match_calls = 0
+        self.children_match_subproblems = 0
+        # Assignments of target children to pattern children, and augmenting
+        # paths searched to solve them (see assign_children)
+        self.assignments = 0
+        self.augmenting_paths = 0
+        # Common ancestors tested to combine loose matches, and target nodes
+        # tried and rejected while building combinations under them
+        self.loose_candidates = 0
+        self.loose_combinations = 0
+        self.loose_rejected = 0
+        self.times = defaultdict(float)
+
+    def __str__(self):
+        printable = "Searches: {}\n".format(self.searches)
+        printable += "Constraint evaluations: {}\n".format(sum(self.evaluations.values()))
+        printable += "Vectorized evaluations: {}\n".format(
+            sum(self.vector_evaluations.values()))
+        for name in sorted(set(self.evaluations) | set(self.vector_evaluations)):
+            printable += "  {}: {} ({} vectorized)\n".format(
+                name, self.evaluations[name], self.vector_evaluations[name])
+        printable += "children_match calls: {} ({} subproblems)\n".format(
+            self.children_match_calls, self.children_match_subproblems)
+        printable += "Children assignments: {} ({} augmenting paths)\n".format(
+            self.assignments, self.augmenting_paths)
+        printable += "Loose ancestors tested: {}\n".format(self.loose_candidates)
+        printable += "Loose combinations tried: {} ({} rejected)\n".format(
+            self.loose_combinations, self.loose_rejected)
+        for phase in sorted(self.times):
+            printable += "Time in {}: {:.4f}s\n".format(phase, self.times[phase])
+        return printable
+
+    def merge(self, other):
+        """ Adds the counters and times of other SearchStats to this one (e.g.
+        collected in other processes). """
+        for attr_name, value in six.iteritems(vars(other)):
+            if isinstance(value, dict):
+                counters = getattr(self, attr_name)
+                for key, count in six.iteritems(value):
+                    counters[key] += count
+            else:
+                setattr(self, attr_name, getattr(self, attr_name) + value)
+
+    def iter_timed(self, iterator, phase):
+        """ Iterates over iterator, adding the time spent producing its items
+        to phase (but not the time spent by the caller between them). """
+        iterator = iter(iterator)
+        while True:
+            t1 = timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.times[phase] += timer() - t1
+                return
+            self.times[phase] += timer() - t1
+            yield item
+
+class SearchBudgetExceeded(Exception):
+    def __init__(self, limit, matches=None):
+        """ Raised when a search reaches one of the limits of its SearchBudget.
+
+        :param limit: name of the limit reached ('combinations', 'time' or
+            'evaluations').
+        :param matches: the matches found before stopping the search.
+        """
+        Exception.__init__(self, "Search budget exceeded: %s" % limit)
+        self.limit = limit
+        self.matches = matches if matches is not None else []
+
+class IncompleteMatches(list):
+    ''' Matches of a search stopped by its SearchBudget, returned by
+    PatternSet.find_matches(). limit is the name of the limit reached. '''
+    def __init__(self, matches, limit):
+        list.__init__(self, matches)
+        self.limit = limit
+
+class SearchBudget(object):
+    def __init__(self, max_combinations=None, max_time=None, max_evaluations=None):
+        """ Limits of the work done by a single search, so pathological
+        patterns can't stall a batch of searches. When passed to
+        find_matches() (or TreePattern.find_match(), etc.), the search raises
+        SearchBudgetExceeded after yielding the matches found so far once any
+        limit is reached. PatternSet.find_matches() applies the limits to the
+        search of every pattern, and returns IncompleteMatches for the ones
+        reaching them.
+
+        :param max_combinations: maximum number of combinations explored:
+            children_match subproblems, augmenting paths searched to assign
+            children, and target nodes tried to combine loose matches.
+        :param max_time: maximum wall time of a search, in seconds.
+        :param max_evaluations: maximum number of target nodes evaluated
+            against constraints (vectorized evaluations count every node).
+        """
+        self.max_combinations = max_combinations
+        self.max_time = max_time
+        self.max_evaluations = max_evaluations
+        self.start()
+
+    def start(self):
+        """ Resets the counters, at the start of every search. """
+        self.combinations = 0
+        self.evaluations = 0
+        self.deadline = timer() + self.max_time if self.max_time is not None else None
+
+    def spend_combinations(self, n=1):
+        self.combinations += n
+        if self.max_combinations is not None and self.combinations > self.max_combinations:
+            raise SearchBudgetExceeded('combinations')
+        self.check_time()
+
+    def spend_evaluations(self, n=1):
+        self.evaluations += n
+        if self.max_evaluations is not None and self.evaluations > self.max_evaluations:
+            raise SearchBudgetExceeded('evaluations')
+        self.check_time()
+
+    def check_time(self):
+        if self.deadline is not None and timer() > self.deadline:
+            raise SearchBudgetExceeded('time')
+
+class MatchMatrix(object):
+    def __init__(self, pattern, tree, cache=None, index=None, stats=None, budget=None):
+        """ Lazy alternative to compute_match_matrix(). Constraints are only
+        evaluated on the target nodes reached while searching the pattern top
+        down, and results are kept for the rest of the search, so a search
+        stopping at the first match only pays for the nodes visited.
+
+        :param cache: A cache of the target tree used by syntax functions, or
+            None.
+        :param index: Optional TreeAttributeIndex of the target tree, used to
+            find candidate nodes of the pattern roots. If not provided, the
+            target tree is traversed lazily.
+        :param stats: Optional SearchStats collecting the evaluations done by
+            this matrix and the searches using it.
+        :param budget: Optional SearchBudget limiting the evaluations and
+            combinations of the search using this matrix.
+        """
+        self.tree = tree
+        self.cache = cache
+        self.index = index
+        self.stats = stats
+        self.budget = budget
+        self._pattern = pattern
+        self._scope = pattern.constraint_scope
+        if cache is not None:
+            self._scope = self._scope.with_cache(cache)
+        self._constraint_funcs = {}
+        self._results = {}
+
+    def is_match(self, pnode, target_node):
+        """ True if target_node matches the constraint of pattern node pnode
+        (local conditions only). """
+        results = self._results.get(pnode.constraint)
+        if results is None:
+            results = self._results[pnode.constraint] = self._evaluate_all(pnode)
+        result = results.get(target_node)
+        if result is None:
+            if self.budget is not None:
+                self.budget.spend_evaluations()
+            if self.stats is None:
+                result = self._evaluate(pnode, target_node)
+            else:
+                t1 = timer()
+                result = self._evaluate(pnode, target_node)
+                self.stats.times['constraints'] += timer() - t1
+                self.stats.evaluations[pnode.name] += 1
+            results[target_node] = result
+        return result
+
+    def _evaluate_all(self, pnode):
+        # Vectorized constraints are evaluated in all nodes of the index the
+        # first time they are needed. Others are evaluated node by node.
+        if self.index is None:
+            return {}
+        t1 = timer() if self.stats is not None else None
+        mask = get_vector_mask(pnode, self.index)
+        if mask is None:
+            return {}
+        results = dict.fromkeys(self.index.nodes, False)
+        results.update(dict.fromkeys(compress(self.index.nodes, mask), True))
+        if self.budget is not None:
+            self.budget.spend_evaluations(len(results))
+        if self.stats is not None:
+            self.stats.times['constraints'] += timer() - t1
+            self.stats.vector_evaluations[pnode.name] += len(results)
+        return results
+
+    def _evaluate(self, pnode, target_node):
+        # Structural conditions are checked before evaluating the constraint
+        if (pnode.expects_leaf is not None and
+            pnode.expects_leaf == bool(target_node.children)):
+            return False
+        for attr_name, value in six.iteritems(pnode.expected_values):
+            if getattr(target_node, attr_name, None) != value:
+                return False
+
+        constraint_func = self._constraint_funcs.get(pnode.constraint)
+        if constraint_func is None:
+            constraint_func = pnode.get_constraint_func(self._scope)
+            self._constraint_funcs[pnode.constraint] = constraint_func
+        return bool(pnode.is_local_match(target_node, self.cache, constraint_func))
+
+    def set_cache(self, cache):
+        """ Replaces the cache used by syntax functions, keeping the results
+        already computed. """
+        self.cache = cache
+        self._scope = self._pattern.constraint_scope
+        if cache is not None:
+            self._scope = self._scope.with_cache(cache)
+        self._constraint_funcs = {}
+
+    def discard(self, target_nodes):
+        """ Forgets the results of all constraints in the given target nodes,
+        which are evaluated again when needed. """
+        for results in six.itervalues(self._results):
+            for target_node in target_nodes:
+                results.pop(target_node, None)
+
+    def iter_matches(self, pnode):
+        """ Iterates over the target nodes matching the constraint of pnode,
+        evaluating it only as nodes are requested. """
+        if self.index is not None:
+            candidates = self.index.get_candidates(pnode.expects_leaf,
+                                                   pnode.expected_values)
+        else:
+            candidates = self.tree.traverse("preorder")
+        for target_node in candidates:
+            if self.is_match(pnode, target_node):
+                yield target_node
+
+def children_match(tnode, pnode, c2nodes, loose_constraint=None, memo=None):
     '''returns True if a subtree (tnode) matches recursively a given pattern
     (pnode), handling min and max number of occurrences. pnode should not
     contain loose connections
-    '''
 
+    :param c2nodes: dictionary of matching target nodes per constraint (see
+        compute_match_matrix), or a MatchMatrix evaluating them on demand.
+    :param memo: optional dictionary with the results already computed,
+        keyed by (tnode, pnode), kept when results are reused across calls
+        (e.g. by IncrementalMatcher after tree edits). A single search reaches
+        every subproblem at most once, so searches don't use it. Results must
+        be removed when the target nodes or the constraint results change.
+    '''
+    if memo is None:
+        return _children_match(tnode, pnode, c2nodes, memo)
+    key = (tnode, pnode)
+    result = memo.get(key)
+    if result is None:
+        result = memo[key] = _children_match(tnode, pnode, c2nodes, memo)
+    return result
+
+def _children_match(tnode, pnode, c2nodes, memo):
     # If no children expected in pattern node, return True, as local
-    # conditions have already been checked
-    if not pnode.children:
+    # conditions have already been checked. Children of loose nodes are
+    # matched as separate sub-patterns.
+    if not pnode.children or pnode.loose_children:
         return True
 
-    t_children = set(tnode.children)
+    # Discard target nodes with a number of children that can't be matched
+    if not pnode.min_children <= len(tnode.children) <= pnode.max_children:
+        return False
 
-    matches = []
+    # Every target child must be assigned to a pattern child, and every
+    # pattern child receive between min and max occurrences of target
+    # children matching it (locally and recursively)
+    t_children = tnode.children
+    t_children_set = set(t_children)
+    is_match = getattr(c2nodes, 'is_match', None)
+    stats = getattr(c2nodes, 'stats', None)
+    if stats is not None:
+        stats.children_match_subproblems += 1
+    budget = getattr(c2nodes, 'budget', None)
+    if budget is not None:
+        budget.spend_combinations()
     matched_children = set()
-    constraint2max_occur = defaultdict(lambda: [set(), 0, 0])
+    candidates = []
     for pnode_ch in pnode.children:
-        match_nodes = c2nodes[pnode_ch.constraint] & t_children
-        constraint2max_occur[pnode_ch.constraint][1] += pnode_ch.min_occur
-        constraint2max_occur[pnode_ch.constraint][2] += pnode_ch.max_occur
-        constraint2max_occur[pnode_ch.constraint][0].update(match_nodes)
-
-        # check min nodes each pattern constraint
-        if pnode_ch.min_occur > 0 and len(match_nodes) < pnode_ch.min_occur:
-            #print 1
+        if is_match is None:
+            match_nodes = c2nodes[pnode_ch.constraint] & t_children_set
+        else:
+            match_nodes = set(n for n in t_children if is_match(pnode_ch, n))
+        if len(match_nodes) < pnode_ch.min_occur:
             return False
-
-        # Keep track all children nodes with matches
         matched_children.update(match_nodes)
+        candidates.append(match_nodes)
 
-        # And prepare all permutations of matches in node with minimum occurrences
-        if not match_nodes and pnode_ch.min_occur == 0:
-            matches.append([[None]])
-        else:
-            matches.append(list(itertools.permutations(match_nodes, max(pnode_ch.min_occur, 1))))
-
-    # there should be nodes without a match
+    # there should be no nodes without a match
     if len(matched_children) < len(t_children):
-        #print 2
         return False
 
-    # Let's check if there is a non-overlapping combination of nodes matches
-    # satisfying patterns. For instance, avoid cases where one node matches the
-    # two required patterns
-    for comb in itertools.product(*matches):
-        valid = set()
-        potential_match = comb
-        for x in comb:
-            x = set(x)
-            inter = valid & set(x)
-            if not inter:
-                valid.update(x)
-            else:
-                potential_match = None
-                # let's check next comb
-                break
-
-        # Validate max number of occurrences assuming current valid combination
-        if potential_match:
-            for k, (matches, mino, maxo) in constraint2max_occur.items():
-                remain_match_nodes = matches - valid
-                if len(remain_match_nodes) > (maxo - mino):
-                    potential_match = None
-                    break
+    t2index = {tnode_ch: i for i, tnode_ch in enumerate(t_children)}
+    for i, pnode_ch in enumerate(pnode.children):
+        if stats is not None:
+            stats.children_match_calls += len(candidates[i])
+        candidates[i] = [t2index[tnode_ch] for tnode_ch in candidates[i]
+                         if children_match(tnode_ch, pnode_ch, c2nodes, memo=memo)]
+        if len(candidates[i]) < pnode_ch.min_occur:
+            return False
 
-        # Validate descendants
-        if potential_match:
-            match = True
-            # Let's check inside the node
-            for i, pnode_ch in enumerate(pnode.children):
-                for tnode_ch in potential_match[i]:
-                    if tnode_ch is None:
-                        continue
-                    if not children_match(tnode_ch, pnode_ch, c2nodes):
-                        match = False
-                        break
-                if not match:
-                    break
-            if match:
-                return True
+    return assign_children(candidates,
+                           [pnode_ch.min_occur for pnode_ch in pnode.children],
+                           [pnode_ch.max_occur for pnode_ch in pnode.children],
+                           len(t_children), stats, budget)
+
+def assign_children(candidates, min_occur, max_occur, n_targets, stats=None,
+                    budget=None):
+    '''Solves the assignment of target children to pattern children as a
+    bipartite matching with capacities. Returns True if every target child can
+    be assigned to exactly one pattern child and every pattern child i gets
+    between min_occur[i] and max_occur[i] target children among
+    candidates[i] (a list of target children indexes).
+
+    Augmenting paths are used first to satisfy min occurrences and then to
+    cover the remaining target children up to max occurrences, so the
+    problem is solved in O(n_targets * edges) instead of enumerating
+    combinations.
+
+    :param stats: Optional SearchStats counting assignments and augmenting
+        paths searched.
+    :param budget: Optional SearchBudget, spending a combination per
+        augmenting path.
+    '''
+    owner = [None] * n_targets
+    count = [0] * len(candidates)
+    if stats is not None:
+        stats.assignments += 1
+
+    def augment(source):
+        if stats is not None:
+            stats.augmenting_paths += 1
+        if budget is not None:
+            budget.spend_combinations()
+        # Breadth first search of a path from pattern child source to a free
+        # target child, alternating assigned target children
+        came_from = {source: None}
+        prev_pattern = {}
+        queue = [source]
+        for p in queue:
+            for t in candidates[p]:
+                if t in prev_pattern:
+                    continue
+                prev_pattern[t] = p
+                if owner[t] is None:
+                    # Reassign target children along the path
+                    while t is not None:
+                        p = prev_pattern[t]
+                        owner[t] = p
+                        t = came_from[p]
+                    count[source] += 1
+                    return True
+                if owner[t] not in came_from:
+                    came_from[owner[t]] = t
+                    queue.append(owner[t])
+        return False
 
-    #print 3
-    return False
+    for p in range(len(candidates)):
+        for _ in range(min_occur[p]):
+            if not augment(p):
+                return False
+
+    unassigned = n_targets - sum(count)
+    for p in range(len(candidates)):
+        while unassigned and count[p] < max_occur[p] and augment(p):
+            unassigned -= 1
+    return unassigned == 0
 
 def split_by_loose_nodes(pattern):
     '''split a pattern tree into all subpatterns connected through loose connections
-    (allowing multiple intermediate between them). '''
+    (allowing multiple intermediate between them). Returns the roots of the
+    subpatterns and the groups of them expected to be under the same node.
+
+    The pattern is not modified: loose nodes are handled as leaves when
+    matching the subpatterns containing them (see children_match).'''
 
     pnode2content = pattern.get_cached_content(leaves_only=False)
 
-    # split pattern by loose nodes and store a list of partitions that can be
-    # used for strict matches
-    to_visit = set()
-    for n in list(pattern.traverse()):
-        if n.loose_children:
-            for ch in n.get_children():
-                if not ch.loose_children:
-                    to_visit.add(ch.detach())
-                else:
-                    ch.detach()
-        elif n is pattern:
-            to_visit.add(pattern)
+    # partitions that can be used for strict matches start at the root and at
+    # the children of loose nodes
+    roots = [n for n in pattern.traverse("preorder") if not n.loose_children and
+             (n is pattern or n.up.loose_children)]
 
     # Calculate expected groupings of the split partitions
     expected_groups = set()
     for p, content in six.iteritems(pnode2content):
-        c = frozenset(content & to_visit)
+        c = frozenset(content.intersection(roots))
         if len(c) > 1:
             expected_groups.add(c)
 
-    return to_visit, sorted(expected_groups, key=lambda x: len(x))
-
-
-def find_matches(tree, pattern):
-    '''Iterate over all possible matches of pattern in tree'''
-    pattern = deepcopy(pattern)
-    for n in pattern.traverse():
-        n.init_controller()
+    return roots, sorted(expected_groups, key=lambda x: len(x))
+
+
+def find_matches(tree, pattern, cache=None, index=None, ancestor_index=None,
+                 stats=None, budget=None):
+    '''Iterate over all possible matches of pattern in tree.
+
+    :param cache: A TreeAggregateIndex or TreePatternCache of the target tree.
+        If not provided and the pattern uses syntax functions relying on a
+        cache, a new one is built for this search by the pattern syntax.
+    :param index: A TreeAttributeIndex of the target tree, which can be shared
+        by many patterns searched in the same tree. If not provided, the
+        target tree is traversed to find candidate nodes.
+    :param ancestor_index: A TreeAncestorIndex of the target tree, used to
+        combine the matches of loose connections. If not provided, the one of
+        the cache is used, or a new one is built.
+    :param stats: Optional SearchStats instance collecting counters and times
+        of the search.
+    :param budget: Optional SearchBudget limiting the search. When a limit is
+        reached, SearchBudgetExceeded is raised, with the matches found so far
+        (which were already yielded).
+    '''
+    if budget is not None:
+        budget.start()
+
+    # The search plan (compiled constraints and sub-patterns) is built only
+    # once and reused by any further search with the same pattern
+    plan = pattern.get_plan()
+    if cache is None and plan.uses_cache:
+        cache = build_cache(pattern.constraint_scope.syntax, tree, stats)
+
+    # Constraints are evaluated on demand, so matches of patterns without
+    # loose connections are reported as soon as they are found
+    c2nodes = MatchMatrix(pattern, tree, cache, index, stats, budget)
+    matches = search_plan(tree, plan, c2nodes, ancestor_index)
+    if stats is not None:
+        stats.searches += 1
+        matches = stats.iter_timed(matches, 'search')
+    if budget is not None:
+        matches = iter_within_budget(matches)
+    for match in matches:
+        yield match
+
+def iter_within_budget(matches):
+    '''Iterates over matches, adding the ones found so far to the
+    SearchBudgetExceeded exception raised by the search.'''
+    found = []
+    try:
+        for match in matches:
+            found.append(match)
+            yield match
+    except SearchBudgetExceeded as e:
+        e.matches = found
+        raise
+
+def build_cache(syntax, tree, stats=None):
+    '''Returns the cache of tree built by syntax, adding the time spent to
+    stats if provided.'''
+    if stats is None:
+        return syntax.build_cache(tree)
+    t1 = timer()
+    cache = syntax.build_cache(tree)
+    stats.times['cache'] += timer() - t1
+    return cache
+
+def search_plan(tree, plan, c2nodes, ancestor_index=None):
+    '''Iterates over the matches of a pattern plan (see PatternPlan) in tree,
+    using the constraint results of a MatchMatrix, which can be shared by
+    patterns with the same syntax.'''
+    stats = getattr(c2nodes, 'stats', None)
+    if len(plan.roots) == 1:
+        proot = plan.roots[0]
+        for match_node in c2nodes.iter_matches(proot):
+            if stats is not None:
+                stats.children_match_calls += 1
+            if children_match(match_node, proot, c2nodes):
+                yield match_node
+        return
 
-    c2nodes = compute_match_matrix(pattern, tree)
     root2matches = OrderedDict()
-    to_visit, expected_groups = split_by_loose_nodes(pattern)
-
-    for proot in to_visit:
-        matches = []
-        for match_node in c2nodes[proot.constraint]:
-            if children_match(match_node, proot, c2nodes):
-                matches.append(match_node)
+    for proot in plan.roots:
+        candidates = list(c2nodes.iter_matches(proot))
+        if stats is not None:
+            stats.children_match_calls += len(candidates)
+        matches = [match_node for match_node in candidates
+                   if children_match(match_node, proot, c2nodes)]
         if not matches:
-            raise StopIteration
+            return
 
         root2matches[proot]=matches
 
-    if len(root2matches) == 1:
-        for match in root2matches[proot]:
-            yield match
-        raise StopIteration
+    if ancestor_index is None:
+        if hasattr(c2nodes.cache, 'get_ancestor_index'):
+            ancestor_index = c2nodes.cache.get_ancestor_index()
+        else:
+            ancestor_index = TreeAncestorIndex(tree)
+    matches = combine_loose_matches(root2matches, plan.expected_groups,
+                                    ancestor_index, stats,
+                                    getattr(c2nodes, 'budget', None))
+    if stats is not None:
+        matches = stats.iter_timed(matches, 'combine_loose')
+    for match in matches:
+        yield match
+
+def combine_loose_matches(root2matches, expected_groups, ancestor_index,
+                          stats=None, budget=None):
+    '''Iterates over the nodes where the matches of the sub-patterns connected
+    through loose connections can be combined. A combination uses a different
+    target node for every sub-pattern root, and the common ancestors of the
+    target nodes in each of the expected groups must be different. The
+    common ancestor of all of them is reported, only once.
+
+    Instead of testing every combination of matches, each target node with
+    matches of all sub-patterns under it is tested as common ancestor, and the
+    search stops at the first valid combination. Combinations are built one
+    sub-pattern root at a time, checking expected groups as soon as they are
+    complete.
+
+    :param root2matches: dictionary with the matching target nodes of every
+        sub-pattern root.
+    :param expected_groups: groups of sub-pattern roots, as returned by
+        split_by_loose_nodes. The last one contains all sub-pattern roots.
+    :param ancestor_index: TreeAncestorIndex of the target tree.
+    :param stats: Optional SearchStats counting the ancestors tested and the
+        combinations tried.
+    :param budget: Optional SearchBudget, spending a combination per target
+        node tried.
+    '''
+    node2index = ancestor_index.node2index
+    size, parent = ancestor_index._size, ancestor_index._parent
+    roots = list(root2matches)
+    r2pos = {r: i for i, r in enumerate(roots)}
+    positions = [sorted(node2index[n] for n in root2matches[r]) for r in roots]
+
+    # Groups other than the one with all roots, indexed by their last root
+    subgroups = [sorted(r2pos[r] for r in group) for group in expected_groups
+                 if len(group) < len(roots)]
+    r2groups = [[g for g, group in enumerate(subgroups) if i in group]
+                for i in range(len(roots))]
+    r2complete = [[g for g in r2groups[i] if subgroups[g][-1] == i]
+                  for i in range(len(roots))]
+
+    # Candidate common ancestors have matches of all sub-patterns below
+    n_roots_below = defaultdict(int)
+    for pos in positions:
+        visited = set()
+        for i in pos:
+            while i is not None and i not in visited:
+                visited.add(i)
+                n_roots_below[i] += 1
+                i = parent[i]
+    candidates = sorted(i for i, n in six.iteritems(n_roots_below)
+                        if n == len(roots))
+    if stats is not None:
+        stats.loose_candidates += len(candidates)
+
+    for anc in candidates:
+        # Target nodes under the candidate ancestor, and the child of the
+        # ancestor containing them (-1 for the ancestor itself)
+        ch_starts = []
+        ich = anc + 1
+        while ich < anc + size[anc]:
+            ch_starts.append(ich)
+            ich += size[ich]
+        options = []
+        for pos in positions:
+            below = pos[bisect_left(pos, anc):bisect_left(pos, anc + size[anc])]
+            options.append([(i, bisect_right(ch_starts, i) - 1) for i in below])
+        branches = [set(b for _, b in opts) for opts in options]
+
+        if _combine_below(anc, options, branches, subgroups, r2groups,
+                          r2complete, ancestor_index, stats, budget):
+            yield ancestor_index.nodes[anc]
+
+def _combine_below(anc, options, branches, subgroups, r2groups, r2complete,
+                   ancestor_index, stats=None, budget=None):
+    '''Returns True if there is a combination of the target nodes in options
+    (one per sub-pattern root) whose common ancestor is anc. See
+    combine_loose_matches.'''
+    n_roots = len(options)
+    used = set()
+    group_lca = [None] * len(subgroups)
+    group_branch = [None] * len(subgroups)
+    group_lcas = set()
+    used_branches = defaultdict(int)
+
+    def search(r):
+        if r == n_roots:
+            # The common ancestor of all target nodes must be anc
+            return -1 in used_branches or len(used_branches) > 1
+
+        # Children of anc where the remaining sub-patterns can be, given the
+        # children already used by their groups
+        remaining = []
+        for i in range(r, n_roots):
+            allowed = branches[i]
+            for g in r2groups[i]:
+                if group_branch[g] is not None:
+                    allowed = allowed & set([group_branch[g]])
+            if not allowed:
+                return False
+            remaining.append(allowed)
+
+        # The common ancestor can't be anc if no remaining sub-pattern can
+        # leave the only child of anc used so far
+        if len(used_branches) == 1 and -1 not in used_branches:
+            used_branch = set(used_branches)
+            if all(allowed <= used_branch for allowed in remaining):
+                return False
+
+        for i, branch in options[r]:
+            if stats is not None:
+                stats.loose_combinations += 1
+            if budget is not None:
+                budget.spend_combinations()
+            if i in used:
+                continue
+            # The target nodes of other groups must be under the same child of
+            # anc, so their common ancestor is different from anc
+            if any(group_branch[g] not in (None, branch) or branch == -1
+                   for g in r2groups[r]):
+                if stats is not None:
+                    stats.loose_rejected += 1
+                continue
+
+            saved = [(g, group_lca[g], group_branch[g]) for g in r2groups[r]]
+            for g in r2groups[r]:
+                group_branch[g] = branch
+                group_lca[g] = i if group_lca[g] is None else ancestor_index._lca(group_lca[g], i)
+
+            completed = []
+            is_valid = True
+            for g in r2complete[r]:
+                if group_lca[g] in group_lcas:
+                    is_valid = False
+                    if stats is not None:
+                        stats.loose_rejected += 1
+                    break
+                group_lcas.add(group_lca[g])
+                completed.append(g)
+
+            if is_valid:
+                used.add(i)
+                used_branches[branch] += 1
+                if search(r + 1):
+                    return True
+                used.discard(i)
+                used_branches[branch] -= 1
+                if not used_branches[branch]:
+                    del used_branches[branch]
+
+            for g in completed:
+                group_lcas.discard(group_lca[g])
+            for g, lca, group_b in saved:
+                group_lca[g], group_branch[g] = lca, group_b
+        return False
+
+    return search(0)
+
+class PatternSet(object):
+    def __init__(self, patterns, syntax=None, quoted_node_names=True):
+        """ A collection of patterns searched together in the same target
+        trees. The constraints of all patterns are evaluated in a shared
+        match matrix per tree, so identical constraints used by many patterns
+        are evaluated only once per target node, and the cost of a search
+        grows with the number of distinct constraints rather than with the
+        number of patterns.
+
+        Constraints are shared among patterns using the same syntax
+        controller instance, or a plain PatternSyntax, which has no state
+        affecting the result of constraints.
+
+        :param patterns: TreePattern instances, or pattern strings in newick
+            format.
+        :param syntax: Syntax controller used to create the patterns given as
+            strings (by default, a PatternSyntax instance).
+        :param quoted_node_names: Used to create the patterns given as
+            strings (see TreePattern).
+        """
+        self.syntax = syntax if syntax else PatternSyntax()
+        self.patterns = []
+        for pattern in patterns:
+            if not isinstance(pattern, TreePattern):
+                pattern = TreePattern(pattern, quoted_node_names=quoted_node_names,
+                                      syntax=self.syntax)
+            self.patterns.append(pattern)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def find_matches(self, tree, cache=None, index=None, ancestor_index=None,
+                     first_match=False, stats=None, budget=None):
+        '''Returns a list with the matches of every pattern in tree, in the same
+        order as the patterns.
+
+        :param cache: A cache of the target tree for the syntax functions. If
+            not provided, one is built for each syntax if any pattern needs it.
+        :param index: A TreeAttributeIndex of the target tree. If not
+            provided, one is built and shared by all patterns.
+        :param ancestor_index: A TreeAncestorIndex of the target tree. If not
+            provided, one is built if any pattern contains loose connections.
+        :param first_match: If True, the search of each pattern stops at its
+            first match.
+        :param stats: Optional SearchStats instance collecting counters and
+            times of the searches of all patterns.
+        :param budget: Optional SearchBudget limiting the search of every
+            pattern. The matches of patterns reaching a limit are returned as
+            IncompleteMatches, with the matches found before stopping.
+        '''
+        if index is None:
+            index = TreeAttributeIndex(tree)
+
+        plans = [pattern.get_plan() for pattern in self.patterns]
+        keys = [get_syntax_key(pattern.constraint_scope.syntax)
+                for pattern in self.patterns]
+        uses_cache = set(key for key, plan in zip(keys, plans) if plan.uses_cache)
+
+        results = []
+        key2matrix = {}
+        for pattern, plan, key in zip(self.patterns, plans, keys):
+            c2nodes = key2matrix.get(key)
+            if c2nodes is None:
+                syntax_cache = cache
+                if syntax_cache is None and key in uses_cache:
+                    syntax_cache = build_cache(pattern.constraint_scope.syntax,
+                                               tree, stats)
+                c2nodes = key2matrix[key] = MatchMatrix(pattern, tree, syntax_cache,
+                                                        index, stats, budget)
+            if ancestor_index is None and len(plan.roots) > 1:
+                ancestor_index = TreeAncestorIndex(tree)
+
+            if budget is not None:
+                budget.start()
+            matches = search_plan(tree, plan, c2nodes, ancestor_index)
+            if stats is not None:
+                stats.searches += 1
+                matches = stats.iter_timed(matches, 'search')
+            if budget is not None:
+                matches = iter_within_budget(matches)
+            try:
+                if first_match:
+                    match = next(matches, None)
+                    results.append([match] if match is not None else [])
+                else:
+                    results.append(list(matches))
+            except SearchBudgetExceeded as e:
+                results.append(IncompleteMatches(e.matches, e.limit))
+        return results
+
+class IncrementalMatcher(object):
+    def __init__(self, pattern, tree, stats=None):
+        """ Keeps the matches of a pattern in a target tree which is edited
+        between searches, e.g. when clades are pruned, collapsed or moved one
+        at a time while curating a tree.
+
+        The results of constraints and children_match() are kept for every
+        target node. After editing the tree, update() evaluates again only
+        the edited nodes, their ancestors and the new nodes, so matches are
+        updated in time proportional to the depth of the edits rather than
+        to the size of the tree. Matches are kept in the matches set.
+
+        Some patterns are not fully updated incrementally:
+         - Patterns with constraints depending on the ancestors of target
+           nodes (depth(), lca(), @.up, etc.) are searched again in the
+           whole tree on every update.
+         - Patterns using syntax functions rebuild the cache of the tree on
+           every update.
+         - Matches of sub-patterns connected through loose connections are
+           combined again on every update.
+
+        :param stats: Optional SearchStats collecting the evaluations done by
+            the matcher.
+        """
+        self.pattern = pattern
+        self.tree = tree
+        self.stats = stats
+        self.plan = pattern.get_plan()
+        self._pnodes = list(pattern.traverse())
+        self.reset()
+
+    def reset(self):
+        """ Discards all kept results and searches the pattern again in the
+        whole tree. """
+        self._c2nodes = MatchMatrix(self.pattern, self.tree, self._build_cache(),
+                                    stats=self.stats)
+        self._memo = {}
+        # Children of every known target node when it was last evaluated
+        self._children = {}
+        # Target nodes matching every strict sub-pattern
+        self._root_matches = OrderedDict((proot, set()) for proot in self.plan.roots)
+        nodes = list(self.tree.traverse())
+        for node in nodes:
+            self._children[node] = tuple(node.children)
+        self._evaluate(nodes)
+        self.matches = self._combine()
+
+    def update(self, *nodes):
+        """ Updates the matches after editing the target tree. Returns a tuple
+        (new_matches, lost_matches) with the sets of target nodes which
+        started or stopped matching the pattern.
+
+        :param nodes: Target nodes whose children or attributes were edited,
+            including the parents of removed nodes and the new parents of
+            moved ones (e.g. the parent of a collapsed node). Nodes removed
+            from them are forgotten, and new nodes added under them are
+            evaluated. If no node is given, the whole tree is traversed to
+            find the nodes whose children changed, which is slower, but
+            convenient after edits touching many nodes, like rerooting.
+            Edited attributes are only detected in the given nodes.
+        """
+        old_matches = self.matches
+        if self.plan.uses_ancestors:
+            self.reset()
+            return self.matches - old_matches, old_matches - self.matches
+
+        if nodes:
+            edited, removed = self._get_changes(nodes)
+        else:
+            edited, removed = self._find_changes()
+
+        # Edits may change the result of any ancestor of the edited nodes
+        dirty = set(edited)
+        for node in edited:
+            node = node.up
+            while node is not None and node not in dirty:
+                dirty.add(node)
+                node = node.up
+
+        touched = dirty.union(removed)
+        strict_matches = old_matches if len(self.plan.roots) == 1 else None
+        if strict_matches is not None:
+            old_matches = touched.intersection(strict_matches)
+        self._forget(touched)
+        for node in removed:
+            self._children.pop(node, None)
+        for node in dirty:
+            self._children[node] = tuple(node.children)
+
+        if self.plan.uses_cache:
+            self._c2nodes.set_cache(self._build_cache())
+        self._evaluate(dirty)
+        if strict_matches is not None:
+            new_matches = touched.intersection(strict_matches)
+            return new_matches - old_matches, old_matches - new_matches
+        self.matches = self._combine()
+        return self.matches - old_matches, old_matches - self.matches
+
+    def _get_changes(self, nodes):
+        # Nodes added under the edited ones are new if they weren't known
+        # before, and nodes removed from them are forgotten with their
+        # descendants, unless they were attached somewhere else
+        edited, attached = set(), set()
+        pending = list(nodes)
+        while pending:
+            node = pending.pop()
+            if node in edited:
+                continue
+            edited.add(node)
+            for child in node.children:
+                attached.add(child)
+                if child not in self._children:
+                    pending.append(child)
+
+        removed = []
+        pending = [child for node in nodes
+                   for child in self._children.get(node, ())
+                   if child not in attached]
+        while pending:
+            node = pending.pop()
+            removed.append(node)
+            pending.extend(child for child in self._children.get(node, ())
+                           if child not in attached)
+        return edited, removed
+
+    def _find_changes(self):
+        visited, edited = set(), []
+        for node in self.tree.traverse():
+            visited.add(node)
+            if self._children.get(node) != tuple(node.children):
+                edited.append(node)
+        removed = [node for node in self._children if node not in visited]
+        return edited, removed
+
+    def _forget(self, nodes):
+        self._c2nodes.discard(nodes)
+        for node in nodes:
+            for pnode in self._pnodes:
+                self._memo.pop((node, pnode), None)
+        for matches in six.itervalues(self._root_matches):
+            matches.difference_update(nodes)
+
+    def _evaluate(self, nodes):
+        for proot, matches in six.iteritems(self._root_matches):
+            for node in nodes:
+                if not self._c2nodes.is_match(proot, node):
+                    continue
+                if self.stats is not None:
+                    self.stats.children_match_calls += 1
+                if children_match(node, proot, self._c2nodes, memo=self._memo):
+                    matches.add(node)
+
+    def _combine(self):
+        if len(self.plan.roots) == 1:
+            return self._root_matches[self.plan.roots[0]]
+
+        root2matches = OrderedDict()
+        for proot, matches in six.iteritems(self._root_matches):
+            if not matches:
+                return set()
+            root2matches[proot] = list(matches)
+        return set(combine_loose_matches(root2matches, self.plan.expected_groups,
+                                         TreeAncestorIndex(self.tree), self.stats))
+
+    def _build_cache(self):
+        if not self.plan.uses_cache:
+            return None
+        return build_cache(self.pattern.constraint_scope.syntax, self.tree,
+                           self.stats)
+
+def get_syntax_key(syntax):
+    '''Returns a key identifying syntax controllers whose constraint results
+    are interchangeable (see PatternSet).'''
+    if type(syntax) is PatternSyntax:
+        return PatternSyntax
+    return id(syntax)
 
-    p2index = {p:i for i,p in enumerate(root2matches.keys())}
-    to_visit = set(to_visit)
-    for nodes in itertools.product(*root2matches.values()):
-        ancestors = list()
-        if len(nodes) != len(set(nodes)):
-            continue
-        is_match = True
-        for group in expected_groups:
-            observed_group = [nodes[p2index[v]] for v in group]
-            anc = tree.get_common_ancestor(observed_group)
-            if anc not in ancestors:
-                ancestors.append(anc)
-            else:
-                is_match = False
-                break
-        if is_match:
-            yield ancestors[-1]
 
 def expand_loose_connection_aliases(nw):
     def find_first_unmatched_closing_par(string):